@@ -1,6 +1,14 @@
 #%%
 import pandas as pd
 import numpy as np
+from proteome_download import ProteomeDownloader, proteome_fasta_folder
+
+# Set download_proteomes to fetch the FASTA of every proteome into ../Data/proteome_fastas/
+# once the IDs are saved.
+# Proteomes already there are skipped, and interrupted downloads resume where they stopped.
+# keep_bgzipped stores them as .fasta.bgz (4-5x smaller), which the later stages read directly.
+download_proteomes = False
+keep_bgzipped = True
     
 # Pathogen reference data
 pathogen_ref = pd.read_csv("../Data/pathogen_ref.tsv", sep='\t')
@@ -53,6 +61,12 @@ print(unique_merged["Protein count"].sum())
 matching_ids = set(proteome["Genome assembly ID"]) & set(filtered_pathogen_ref["Assembly"])
 print(f"Number of matching Assembly IDs: {len(matching_ids)}")
 
+#%% DOWNLOAD
+if download_proteomes:
+    downloader = ProteomeDownloader(bgzip=keep_bgzipped)
+    downloader.download(unique_merged['Proteome Id'].astype(str).tolist(), proteome_fasta_folder)
+    print(f"Downloaded {downloader.summary()}")
+
 
 
 
@@ -1,83 +1,104 @@
 #%%
-import pandas as pd 
-from Bio import SeqIO
-import re
 import matplotlib.pyplot as plt
 import seaborn as sns
 from tqdm import tqdm
 from pathlib import Path
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from fasta_io import open_fasta
+from fasta_table import parse_batch, stream_records_to_table
+from annotation_store import AnnotationStore
+from sequence_store import build_store_from_table, store_path_for
+from proteome_download import ProteomeDownloader
+from strain_annotation import (
+    annotate_records, fetch_strain_names, iter_proteome_records, load_organism_names,
+    load_protein_proteomes, protein_proteome_path, set_organism, strain_table_path,
+)
+
+fasta_path = "../Data/all_proteomes.fasta"
+output_csv_path = "../Data/wrangled_all_pathogen_prots.csv"
 
-
-# Load combined FASTA
-all_fasta = list(SeqIO.parse("../Data/all_proteomes.fasta", "fasta"))
-
-def extract_genus_species_and_strain(organism_source):
-    """
-    Extracts genus + species as the first two words, and the rest as strain (if present).
-    """
-    cleaned = re.sub(r"\(.*?\)", "", organism_source).strip()
-    parts = cleaned.split()
-
-    if len(parts) >= 2:
-        genus_species = ' '.join(parts[:2])
-        strain = ' '.join(parts[2:]) if len(parts) > 2 else None
-    else:
-        genus_species = cleaned
-        strain = "Unknown strain" 
-
-    return genus_species, strain
-
-
-def parse_fasta_to_df(fasta, dataset_name): 
-    metadata = []
-    
+# Read the per-proteome FASTAs in proteome_fastas/ directly, in proteome_ids.txt order.
+# Any FASTA here may also be gzip or bgzip compressed (.fasta.gz / .fasta.bgz).
+# Organism and strain (the OS= field) come from the sidecar tables strain_extraction.py
+# writes, so no rewritten copies of the FASTAs are needed. With read_proteome_folder = False,
+# fasta_path is parsed instead and the sidecar is applied through its accession map.
+read_proteome_folder = True
+proteome_fasta_folder = Path("../Data/proteome_fastas")
+
+# Download the proteomes of proteome_ids.txt from UniProt (several at a time) and parse them
+# as they arrive, instead of reading proteome_fastas/; the FASTAs are never written to disk.
+# Strain names are fetched per proteome (through the annotation store) rather than read from
+# the sidecar table, which only covers proteomes already on disk.
+download_from_uniprot = False
+proteome_id_path = "../Data/proteome_ids.txt"
+
+# Streaming mode reads records lazily and writes them in batches of batch_size,
+# so memory no longer grows with the number of proteomes.
+# Give output_csv_path a .parquet suffix to write Parquet row groups instead of CSV.
+streaming = True
+batch_size = 50_000
+
+# Also pack the sequences into ../Data/sequence_store/ (one residue buffer + offsets),
+# which stages 4, 6 and 7 memory-map instead of parsing the Sequence column
+write_sequence_store = True
+
+
+def parse_fasta_to_df(records, dataset_name): 
     print(f"Processing {dataset_name}...")
 
-    for seq_record in tqdm(fasta, desc=f"Parsing {dataset_name}", unit=" sequence"):
-        header = seq_record.description
-
-        # Extract the protein ID
-        protein_id_match = re.search(r'\|([^|]+)\|', header)
-        protein_id = protein_id_match.group(1) if protein_id_match else seq_record.id
-
-        # Extract the full organism name
-        organism_source = header.split('OS=')[1].split(' OX=')[0] if "OS=" in header else None
-
-        # Extract genus/species and strain
-        genus_species, strain = extract_genus_species_and_strain(organism_source) if organism_source else (None, "unknown strain")
-
-        # Extract annotation
-        annotation = None
-        header_parts = header.split()
-        if len(header_parts) > 1:
-            possible_annotation = ' '.join(header_parts[1:])
-            annotation = possible_annotation.split('OS=')[0].strip()
-
-        # Extract gene name (GN=...)
-        gene_name_match = re.search(r'GN=([^\s]+)', header)
-        gene_name = gene_name_match.group(1) if gene_name_match else None
-
-        # Add extracted data
-        metadata.append([
-            protein_id, genus_species, strain, annotation,
-            gene_name, str(seq_record.seq)
-        ])
-    
-    # Convert to DataFrame
-    metadata_df = pd.DataFrame(metadata, columns=[
-        "Protein_ID", "Genus_Species", "Strain", "Annotation",
-        "pathogen_gene_name", "Sequence"
-    ])
+    # Parse every (title, sequence) record into one DataFrame
+    metadata_df = parse_batch(list(tqdm(records, desc=f"Parsing {dataset_name}", unit=" sequence")))
     
     return metadata_df
 
 
-# Run the function
-all_df = parse_fasta_to_df(all_fasta, "All Proteins")
-
-# Save to CSV
-output_csv_path = "../Data/wrangled_all_pathogen_prots.csv"
-all_df.to_csv(output_csv_path, index=False)
-print(f"Metadata saved to: {output_csv_path}")
+def read_records():
+    """
+    (title, sequence) records with each proteome's organism name applied.
+    """
+    if download_from_uniprot:
+        with open(proteome_id_path) as f:
+            proteome_ids = [line.strip() for line in f if line.strip()]
+        with AnnotationStore() as annotations:
+            organism_names = annotations.get_many("proteome_strain", proteome_ids, fetch_strain_names)
+        for proteome_id in proteome_ids:
+            if proteome_id not in organism_names:
+                print(f"Strain not found for {proteome_id}")
+
+        downloader = ProteomeDownloader()
+        for proteome_id, records in downloader.iter_records([p for p in proteome_ids if p in organism_names]):
+            for title, seq in records:
+                yield set_organism(title, organism_names[proteome_id]), seq
+        print(f"Downloaded {downloader.summary()}")
+        return
+
+    organism_names = load_organism_names(strain_table_path)
+    if read_proteome_folder:
+        yield from iter_proteome_records(proteome_fasta_folder, organism_names)
+    else:
+        protein_proteomes = load_protein_proteomes(protein_proteome_path)
+        with open_fasta(fasta_path) as handle:
+            yield from annotate_records(SimpleFastaParser(handle), organism_names, protein_proteomes)
+
+
+source = "UniProt" if download_from_uniprot else proteome_fasta_folder if read_proteome_folder else fasta_path
+if streaming:
+    store_dir = store_path_for(output_csv_path) if write_sequence_store else None
+    n_records = stream_records_to_table(read_records(), output_csv_path, batch_size=batch_size,
+                                        store_dir=store_dir, desc=f"Parsing {source}")
+    print(f"Metadata for {n_records} proteins saved to: {output_csv_path}")
+else:
+    # Load all records at once
+    all_df = parse_fasta_to_df(read_records(), "All Proteins")
+
+    # Save to CSV
+    all_df.to_csv(output_csv_path, index=False)
+    print(f"Metadata saved to: {output_csv_path}")
+
+    if write_sequence_store:
+        build_store_from_table(output_csv_path)
+
+if write_sequence_store:
+    print(f"Packed sequences saved to: {store_path_for(output_csv_path)}")
 
 # %%
@@ -1,101 +1,188 @@
 #%% IMPORTS
+import argparse
+import json
+import os
+from pathlib import Path
 import pandas as pd
 import numpy as np
-import ahocorasick
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from tqdm import tqdm
+from epitope_automaton import epitope_set_key, load_or_build_automaton, scan_sequences
+from fasta_io import find_fasta, open_fasta
+from fasta_table import parse_batch
+from strain_annotation import load_organism_names, set_organism, strain_table_path
+from sequence_collapse import CollapsedSequences
+from sequence_store import SequenceStore
+
+# --workers N scans the pathogen proteins in N forked processes
+# --incremental only scans proteomes that are new or changed since the last run
+# --no-collapse scans every protein, even when several strains share the exact sequence
+parser = argparse.ArgumentParser(description="Perfect epitope matches against pathogen proteomes")
+parser.add_argument("--workers", type=int, default=1, help="number of worker processes (default: 1)")
+parser.add_argument("--incremental", action="store_true", help="reuse per-proteome result shards")
+parser.add_argument("--no-collapse", dest="collapse", action="store_false", help="scan duplicate sequences separately")
+args, _ = parser.parse_known_args()
 
 #%% LOAD DATA
 pathogen_data_path = "../Data/wrangled_all_pathogen_prots.csv"
 IEDB_data_path = "../Data/wrangled_IEDB.csv"
 output_path = "../Data/perfect_matches_2_0.csv"
 
-# Load data
-pathogen_data = pd.read_csv(pathogen_data_path)
-IEDB_data = pd.read_csv(IEDB_data_path)
+# With collapsing, every protein's row in wrangled_all_pathogen_prots.csv is mapped to the
+# row whose sequence was scanned in its place
+members_path = "../Data/perfect_matches_2_0_sequence_members.csv"
+
+# Incremental mode reads each proteome's FASTA instead of the combined table, taking
+# organism and strain from the sidecar table written by strain_extraction.py
+proteome_id_path = "../Data/proteome_ids.txt"
+proteome_fasta_folder = Path("../Data/proteome_fastas")
+shard_root = Path("../Data/perfect_match_shards")
 
-IEDB_epitopes = list(zip(
-    IEDB_data["Assay_ID"],
-    IEDB_data["Protein_source"],
-    IEDB_data["Disease"],
-    IEDB_data["Protein_ID"],
-    IEDB_data["Sequence"],
-    IEDB_data["epitope_start_pos"],
-    IEDB_data["epitope_end_pos"]
-))
+# Load data; pathogen sequences are memory-mapped from the packed store written by stage 2
+IEDB_data = pd.read_csv(IEDB_data_path)
+if not args.incremental:
+    pathogen_store = SequenceStore.for_table(pathogen_data_path)
+    pathogen_data = pathogen_store.metadata
 
 #%% BUILD AHO-CORASICK AUTOMATON
-def build_aho_corasick_automaton(epitopes):
-    A = ahocorasick.Automaton()
-    for assay_id, epitope_source, disease, epitope_protein_id, epitope, epitope_start, epitope_end in epitopes:
-        for length in range(len(epitope), 8, -1):  # 15 → 9-mers
-            for i in range(len(epitope) - length + 1):
-                sub_epitope = epitope[i:i + length]
-                A.add_word(sub_epitope, (
-                    assay_id, epitope_source, disease,
-                    epitope_protein_id, sub_epitope, length,
-                    epitope_start, epitope_end
-                ))
-    A.make_automaton()
-    return A
-
-A = build_aho_corasick_automaton(IEDB_epitopes)
+# Reuses the automaton saved for this exact wrangled_IEDB.csv, rebuilding it only when the table changes
+A = load_or_build_automaton(IEDB_data_path, IEDB_data)
 
 #%% FIND MATCHES
-def find_matches(pathogen_data, automaton):
-    matches = []
-
-    seqs = pathogen_data["Sequence"].to_numpy()
-    pids = pathogen_data["Protein_ID"].to_numpy()
-    orgs = pathogen_data["Genus_Species"].to_numpy()
-    annots = pathogen_data["Annotation"].to_numpy()
-    strains = pathogen_data["Strain"].to_numpy()
-    genes = pathogen_data["pathogen_gene_name"].to_numpy()
-
-    with tqdm(total=len(seqs), desc="Matching epitopes") as pbar:
-        for seq, pid, org, strain, annot, gene in zip(seqs, pids, orgs, strains, annots, genes):
-            row_matches = []
-
-            for end_idx, (assay_id, epitope_source, disease,
-                          epitope_protein_id, sub_epitope, match_len,
-                          epitope_start, epitope_end) in automaton.iter(seq):
-                match_start = end_idx - match_len + 2  # 1-based
-                match_end = end_idx + 1
-
-                row_matches.append((assay_id, epitope_source, disease, epitope_protein_id,
-                                    pid, org, strain, annot, gene,
-                                    sub_epitope, match_len,
-                                    match_start, match_end,
-                                    epitope_start, epitope_end))
-
-            if row_matches:
-                row_df = pd.DataFrame(row_matches, columns=[
-                    "Assay_ID", "Epitope_Source", "Disease", "IEDB_Protein_ID",
-                    "Pathogen_Protein_ID", "Organism_Source", "Strain", "Pathogen_Annotation",
-                    "Pathogen_Gene_Name", "Matched_9mer", "Match_Length",
-                    "Pathogen_Protein_Start_Pos", "Pathogen_Protein_End_Pos",
-                    "Epitope_Start_Pos", "Epitope_End_Pos"
-                ])
-                row_df = row_df.sort_values("Match_Length", ascending=False)
-                row_df = row_df.drop_duplicates(subset=["Assay_ID", "Pathogen_Protein_ID", "Strain"])
-                matches.extend(row_df.to_records(index=False))
-
-            pbar.update(1)
-
-    match_df = pd.DataFrame.from_records(matches, columns=[
-        "Assay_ID", "Epitope_Source", "Disease", "IEDB_Protein_ID",
-        "Pathogen_Protein_ID", "Organism_Source", "Strain", "Pathogen_Annotation",
-        "Pathogen_Gene_Name", "Matched_9mer", "Match_Length",
-        "Pathogen_Protein_Start_Pos", "Pathogen_Protein_End_Pos",
-        "Epitope_Start_Pos", "Epitope_End_Pos"
-    ])
-
+match_columns = [
+    "Assay_ID", "Epitope_Source", "Disease", "IEDB_Protein_ID",
+    "Pathogen_Protein_ID", "Organism_Source", "Strain", "Pathogen_Annotation",
+    "Pathogen_Gene_Name", "Matched_9mer", "Match_Length",
+    "Pathogen_Protein_Start_Pos", "Pathogen_Protein_End_Pos",
+    "Epitope_Start_Pos", "Epitope_End_Pos"
+]
+
+def find_protein_matches(pathogen_data, automaton, IEDB_data, workers=1, seqs=None, collapse=True, members_path=None):
+    """
+    Longest match per assay for every protein, in protein order.
+    Also returns the pathogen_data row of each match.
+    seqs defaults to pathogen_data["Sequence"]; any indexable sequence of str works (e.g. a SequenceStore).
+    With collapse, each distinct sequence is scanned once and its hits are copied to every protein holding it;
+    members_path, if given, receives the protein-to-scanned-row mapping.
+    """
+    # Longest hit per (assay, protein) is kept as hits stream in; metadata is joined at the end
+    assay_codes = pd.factorize(IEDB_data["Assay_ID"])[0].tolist()
+    if seqs is None:
+        seqs = pathogen_data["Sequence"].to_numpy()
+
+    if collapse:
+        distinct = CollapsedSequences(seqs)
+        print(f"Scanning {distinct.summary()}")
+        if members_path is not None:
+            distinct.members(pathogen_data).to_csv(members_path, index=False)
+        hits = scan_sequences(automaton, distinct, assay_codes, workers=workers)
+        unique_idx, epitope_rows, offsets, lengths, ends = hits.columns()
+        protein_idx, hit_idx = distinct.expand(unique_idx)
+        epitope_rows, offsets, lengths, ends = epitope_rows[hit_idx], offsets[hit_idx], lengths[hit_idx], ends[hit_idx]
+    else:
+        hits = scan_sequences(automaton, seqs, assay_codes, workers=workers)
+        protein_idx, epitope_rows, offsets, lengths, ends = hits.columns()
+
+    epitope_seqs = IEDB_data["Sequence"].to_numpy()
+    match_df = pd.DataFrame({
+        "Assay_ID": IEDB_data["Assay_ID"].to_numpy()[epitope_rows],
+        "Epitope_Source": IEDB_data["Protein_source"].to_numpy()[epitope_rows],
+        "Disease": IEDB_data["Disease"].to_numpy()[epitope_rows],
+        "IEDB_Protein_ID": IEDB_data["Protein_ID"].to_numpy()[epitope_rows],
+        "Pathogen_Protein_ID": pathogen_data["Protein_ID"].to_numpy()[protein_idx],
+        "Organism_Source": pathogen_data["Genus_Species"].to_numpy()[protein_idx],
+        "Strain": pathogen_data["Strain"].to_numpy()[protein_idx],
+        "Pathogen_Annotation": pathogen_data["Annotation"].to_numpy()[protein_idx],
+        "Pathogen_Gene_Name": pathogen_data["pathogen_gene_name"].to_numpy()[protein_idx],
+        "Matched_9mer": [epitope_seqs[r][o:o + n] for r, o, n in zip(epitope_rows, offsets, lengths)],
+        "Match_Length": lengths,
+        "Pathogen_Protein_Start_Pos": ends - lengths + 2,  # 1-based
+        "Pathogen_Protein_End_Pos": ends + 1,
+        "Epitope_Start_Pos": IEDB_data["epitope_start_pos"].to_numpy()[epitope_rows],
+        "Epitope_End_Pos": IEDB_data["epitope_end_pos"].to_numpy()[epitope_rows],
+    }, columns=match_columns)
+
+    return match_df, protein_idx
+
+
+def keep_longest_matches(match_df):
     match_df = match_df.sort_values("Match_Length", ascending=False)
     match_df = match_df.drop_duplicates(subset=["Assay_ID", "Pathogen_Protein_ID", "Strain"])
-
     return match_df
 
+
+def find_matches(pathogen_data, automaton, IEDB_data, workers=1, seqs=None, collapse=True, members_path=None):
+    match_df, _ = find_protein_matches(pathogen_data, automaton, IEDB_data, workers, seqs, collapse, members_path)
+    return keep_longest_matches(match_df)
+
+#%% INCREMENTAL MATCHING
+def proteome_fingerprint(fasta_path, organism_name):
+    # A renamed strain changes the shard's Organism_Source and Strain columns too
+    stat = os.stat(fasta_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}-{organism_name}"
+
+
+def load_proteome(fasta_path, organism_name):
+    with open_fasta(fasta_path) as handle:
+        return parse_batch([(set_organism(title, organism_name), seq) for title, seq in SimpleFastaParser(handle)])
+
+
+def find_matches_incremental(proteome_ids, automaton, IEDB_data, workers=1, collapse=True):
+    """
+    Keeps one result shard per proteome under shard_root/<epitope set key>/ and only scans
+    proteomes whose FASTA is new or changed; the final table is rebuilt from all shards.
+    """
+    shard_dir = shard_root / epitope_set_key(IEDB_data_path)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = shard_dir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    organism_names = load_organism_names(strain_table_path)
+    fasta_paths = {}
+    for proteome_id in proteome_ids:
+        fasta_path = find_fasta(proteome_fasta_folder, proteome_id)
+        if proteome_id not in organism_names:
+            print(f"Strain not found for {proteome_id}")
+        elif fasta_path is not None:
+            fasta_paths[proteome_id] = fasta_path
+        else:
+            print(f"FASTA not found for {proteome_id}")
+
+    fingerprints = {pid: proteome_fingerprint(path, organism_names[pid]) for pid, path in fasta_paths.items()}
+    todo = [pid for pid in fasta_paths if manifest.get(pid) != fingerprints[pid]]
+    print(f"{len(todo)} of {len(fasta_paths)} proteomes are new or changed")
+
+    if todo:
+        tables = [load_proteome(fasta_paths[pid], organism_names[pid]) for pid in tqdm(todo, desc="Reading proteomes")]
+        new_data = pd.concat(tables, ignore_index=True)
+        proteome_of_row = np.repeat(np.arange(len(todo)), [len(t) for t in tables])
+
+        match_df, protein_idx = find_protein_matches(new_data, automaton, IEDB_data, workers, collapse=collapse)
+        match_proteome = proteome_of_row[protein_idx]
+
+        for i, pid in enumerate(todo):
+            match_df[match_proteome == i].to_csv(shard_dir / f"{pid}.csv", index=False)
+            manifest[pid] = fingerprints[pid]
+
+        tmp_path = manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=1))
+        os.replace(tmp_path, manifest_path)
+
+    shards = [
+        pd.read_csv(shard_dir / f"{pid}.csv", keep_default_na=False, na_values=[""])
+        for pid in fasta_paths
+    ]
+    match_df = pd.concat(shards, ignore_index=True) if shards else pd.DataFrame(columns=match_columns)
+    return keep_longest_matches(match_df)
+
 #%% EXECUTE MATCHING
-match_df = find_matches(pathogen_data, A)
+if args.incremental:
+    with open(proteome_id_path) as f:
+        proteome_ids = [line.strip() for line in f if line.strip()]
+    match_df = find_matches_incremental(proteome_ids, A, IEDB_data, workers=args.workers, collapse=args.collapse)
+else:
+    match_df = find_matches(pathogen_data, A, IEDB_data, workers=args.workers, seqs=pathogen_store,
+                            collapse=args.collapse, members_path=members_path)
 
 #%% MERGE WITH ALL EPITOPES (even unmatched ones)
 all_epitopes = IEDB_data[[
@@ -1,40 +1,54 @@
 #%% IMPORTS
 import pandas as pd
-import requests
-import time
 import re
+from annotation_store import AnnotationStore
+from uniprot_client import UniProtClient, subcellular_locations
 
 #%% LOAD DATA
 perfect_match = pd.read_csv("../Data/perfect_matches_2_0.csv")
 IEDB_data = pd.read_csv("../Data/wrangled_IEDB_with_sequences.csv")
-cell_location_ref = pd.read_csv("../Data/Uniprot_subcellular_location_ref.csv")
+
+# UniProt lookups and the cleaned DeepLoc/UniProt location tables are kept in a local SQLite store,
+# so reruns neither refetch accessions nor re-concatenate the CSV exports
+annotations = AnnotationStore()
+
+cell_location_ref_path = "../Data/Uniprot_subcellular_location_ref.csv"
+deeplocpro_paths = [
+    "../Data/deeplocpro_Negative_1.csv",
+    "../Data/deeplocpro_Negative_2.csv",
+    "../Data/deeplocpro_Negative_3.csv",
+    "../Data/deeplocpro_Negative_4.csv",
+    "../Data/deeplocpro_Positive.csv",
+    "../Data/deeplocpro_Positive_2.csv",
+]
+epitope_deeploc_paths = ["../Data/deeploc_epitopes_1.csv", "../Data/deeploc_epitopes_2.csv"]
 
 #%% LOAD MULTIPLE DEEPLOCPRO NEGATIVE FILES
-deeploc_neg1 = pd.read_csv("../Data/deeplocpro_Negative_1.csv")
-deeploc_neg2 = pd.read_csv("../Data/deeplocpro_Negative_2.csv")
-deeploc_neg3 = pd.read_csv("../Data/deeplocpro_Negative_3.csv")
-deeploc_neg4 = pd.read_csv("../Data/deeplocpro_Negative_4.csv")
-deeplocpro_positive = pd.read_csv("../Data/deeplocpro_Positive.csv")
-deeplocpro_positive_2 = pd.read_csv("../Data/deeplocpro_Positive_2.csv")
+def read_deeplocpro():
+    deeplocpro_combined = pd.concat([pd.read_csv(path) for path in deeplocpro_paths], ignore_index=True)
 
-deeplocpro_combined = pd.concat([deeploc_neg1, deeploc_neg2, deeploc_neg3, deeploc_neg4, deeplocpro_positive, deeplocpro_positive_2], ignore_index=True)
+    # CLEAN DEEPLOC PATHOGEN LOCATIONS (no mapping)
+    deeplocpro_combined.columns = deeplocpro_combined.columns.str.strip()
+    deeplocpro_combined["Localization"] = deeplocpro_combined["Localization"].str.strip()
 
-#%% CLEAN DEEPLOC PATHOGEN LOCATIONS (no mapping)
-deeplocpro_combined.columns = deeplocpro_combined.columns.str.strip()
-deeplocpro_combined["Localization"] = deeplocpro_combined["Localization"].str.strip()
+    return deeplocpro_combined[["ACC", "Localization"]].rename(
+        columns={"ACC": "Entry", "Localization": "pathogen_deeploc_subcellular_location"}
+    )
 
-deeploc_clean = deeplocpro_combined[["ACC", "Localization"]].rename(
-    columns={"ACC": "Entry", "Localization": "pathogen_deeploc_subcellular_location"}
-)
+deeploc_clean = annotations.cached_table("deeploc_pathogen_locations", deeplocpro_paths, read_deeplocpro, "Entry")
 
 #%% CLEAN UNIPROT PATHOGEN LOCATIONS (no mapping)
-uniprot_clean = cell_location_ref[["Entry", "Subcellular location [CC]"]].copy()
-uniprot_clean["pathogen_uniprot_subcellular_location"] = (
-    uniprot_clean["Subcellular location [CC]"]
-    .str.extract(r"SUBCELLULAR LOCATION:\s*([^;{\.]+)", flags=re.IGNORECASE)[0]
-    .str.strip()
-)
-uniprot_clean = uniprot_clean.drop(columns=["Subcellular location [CC]"])
+def read_uniprot_locations():
+    cell_location_ref = pd.read_csv(cell_location_ref_path)
+    uniprot_clean = cell_location_ref[["Entry", "Subcellular location [CC]"]].copy()
+    uniprot_clean["pathogen_uniprot_subcellular_location"] = (
+        uniprot_clean["Subcellular location [CC]"]
+        .str.extract(r"SUBCELLULAR LOCATION:\s*([^;{\.]+)", flags=re.IGNORECASE)[0]
+        .str.strip()
+    )
+    return uniprot_clean.drop(columns=["Subcellular location [CC]"])
+
+uniprot_clean = annotations.cached_table("uniprot_pathogen_locations", [cell_location_ref_path], read_uniprot_locations, "Entry")
 
 #%% MERGE PATHOGEN LOCATION INFO INTO perfect_match
 perfect_match["Pathogen_Protein_ID"] = perfect_match["Pathogen_Protein_ID"].str.strip().str.upper()
@@ -47,46 +61,35 @@ perfect_match = perfect_match.merge(deeploc_clean, how="left", left_on="Pathogen
 #%% FETCH EPIOTOPE UNIPROT LOCATIONS VIA API (no mapping)
 epitope_ids = IEDB_data["Protein_ID"].dropna().unique()
 
-def fetch_uniprot_location(uniprot_id):
-    url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}.json"
-    try:
-        response = requests.get(url)
-        if response.status_code != 200:
-            return None
-        data = response.json()
-        for comment in data.get("comments", []):
-            if comment.get("commentType") == "SUBCELLULAR LOCATION":
-                locations = [
-                    loc.get("location", {}).get("value")
-                    for loc in comment.get("subcellularLocations", [])
-                    if loc.get("location")
-                ]
-                return "; ".join(locations) if locations else None
-        return None
-    except Exception as e:
-        print(f"Error fetching {uniprot_id}: {e}")
-        return None
-
-epitope_location_map = {}
-for uid in epitope_ids:
-    epitope_location_map[uid] = fetch_uniprot_location(uid)
-    time.sleep(0.5)
+# Accessions go out in batched stream queries over one pooled session,
+# with a bounded number in flight, a token-bucket rate limit and retries with backoff
+client = UniProtClient(max_concurrency=4, rate=3.0, batch_size=100)
+
+def fetch_locations(accessions):
+    # Only accessions UniProt answered 404 for are remembered as not found; failed lookups are
+    # missing from entries altogether and are asked again next run
+    entries = client.fetch_entries(accessions)
+    found = {a: subcellular_locations(entry) for a, entry in entries.items() if entry is not None}
+    return found, [a for a, entry in entries.items() if entry is None]
+
+epitope_location_map = annotations.get_many("uniprot_subcellular_location", epitope_ids, fetch_locations)
+print(f"UniProt requests this run: {client.n_requests} ({client.n_retries} retries)")
 
 # Apply to both datasets
 IEDB_data["epitope_uniprot_subcellular_location"] = IEDB_data["Protein_ID"].map(epitope_location_map)
 perfect_match["epitope_uniprot_subcellular_location"] = perfect_match["IEDB_Protein_ID"].map(epitope_location_map)
 
 #%% MERGE DEEPLOC EPIOTOPE LOCATION (from 2 files, no mapping)
-epitope_deeploc1 = pd.read_csv("../Data/deeploc_epitopes_1.csv")
-epitope_deeploc2 = pd.read_csv("../Data/deeploc_epitopes_2.csv")
+def read_epitope_deeploc():
+    epitope_deeploc = pd.concat([pd.read_csv(path) for path in epitope_deeploc_paths], ignore_index=True)
+    epitope_deeploc.columns = epitope_deeploc.columns.str.strip()
+    epitope_deeploc["Localizations"] = epitope_deeploc["Localizations"].str.strip()
 
-epitope_deeploc = pd.concat([epitope_deeploc1, epitope_deeploc2], ignore_index=True)
-epitope_deeploc.columns = epitope_deeploc.columns.str.strip()
-epitope_deeploc["Localizations"] = epitope_deeploc["Localizations"].str.strip()
+    return epitope_deeploc[["Protein_ID", "Localizations"]].rename(
+        columns={"Localizations": "epitope_deeploc_subcellular_location"}
+    )
 
-epitope_deeploc_clean = epitope_deeploc[["Protein_ID", "Localizations"]].rename(
-    columns={"Localizations": "epitope_deeploc_subcellular_location"}
-)
+epitope_deeploc_clean = annotations.cached_table("deeploc_epitope_locations", epitope_deeploc_paths, read_epitope_deeploc, "Protein_ID")
 
 # Merge into both datasets
 IEDB_data = IEDB_data.merge(
@@ -3,11 +3,13 @@
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-from collections import defaultdict
-import edlib
+from mismatch_search import HammingEngine, SeedIndex, generate_9mers
+from substitution_search import ScoreEngine
+from sequence_store import SequenceStore
 
-# Load data
-pathogen_data = pd.read_csv("../Data/wrangled_rep_pathogen_prots.csv")
+# Load data; pathogen sequences are memory-mapped from the packed store of the table
+pathogen_store = SequenceStore.for_table("../Data/wrangled_rep_pathogen_prots.csv")
+pathogen_data = pathogen_store.metadata
 IEDB_data = pd.read_csv("../Data/wrangled_IEDB.csv")
 
 # Extract relevant columns
@@ -15,63 +17,80 @@ epitope_sequences = IEDB_data["Sequence"].to_numpy()
 epitope_ids = IEDB_data["Assay_ID"].to_numpy()
 epitope_sources = IEDB_data["Epitope - Molecule Parent"].to_numpy()
 
-protein_sequences = pathogen_data["Sequence"].to_numpy()
 protein_ids = pathogen_data["Protein ID"].to_numpy()
 organism = pathogen_data["Organism Source"].to_numpy()
 
-# Function to generate all 9-mers from a sequence (optimized)
-def generate_9mers(seq):
-    return [seq[i:i+9] for i in range(len(seq) - 8)] if len(seq) >= 9 else []
+# Define allowed mismatches (substitutions, i.e. Hamming distance)
+max_mismatches = 4
 
-# Using edlib to calculate Hamming distance (by leveraging edit distance with a gap cost of -1 for insertions and deletions)
-def hamming_distance(s1, s2, max_mismatches):
-    alignment = edlib.align(s1, s2, mode="NW")
-    mismatches = alignment['editDistance']
-    return mismatches if mismatches <= max_mismatches else float('inf')
+# "seed" only checks pairs sharing a pigeonhole seed, "block" compares all 9-mer pairs
+# position by position in cache-sized blocks; seed is as fast or faster up to 4 mismatches
+engine = "seed"
+proteins_per_chunk = 2000
 
-# Define allowed mismatches
-max_mismatches = 4
-prefix_length = max_mismatches  # Ensure correctness of comparisons
+# "hamming" counts substitutions; "blosum62" instead keeps pairs whose summed BLOSUM62
+# score is at least min_score, so conservative substitutions (I→L) count less than W→G
+scoring = "hamming"
+min_score = 30
 
-# Step 2: Group epitope 9-mers by prefix using defaultdict
-epitope_dict = defaultdict(list)
+# Step 2: Collect every epitope 9-mer with the row it came from
+epitope_9mers = []
+epitope_rows = []
 
-for assay_id, epitope_source, seq in zip(epitope_ids, epitope_sources, epitope_sequences):
+for row, seq in enumerate(epitope_sequences):
     for nine_mer in generate_9mers(seq):
-        prefix = nine_mer[:prefix_length]
-        epitope_dict[prefix].append((nine_mer, assay_id, epitope_source))
-
-# Function to find matches in a protein sequence
-def find_fuzzy_matches(protein, protein_id, organism, epitope_dict, max_mismatches):
-    local_matches = []
-    protein_9mers = generate_9mers(protein)
-    
-    for protein_9mer in protein_9mers:
-        prefix = protein_9mer[:prefix_length]
-        if prefix in epitope_dict:
-            for epitope_9mer, assay_id, epitope_source in epitope_dict[prefix]:
-                # Perform fuzzy matching only if prefix matches
-                mismatches = hamming_distance(protein_9mer, epitope_9mer, max_mismatches)
-                if mismatches <= max_mismatches:
-                    local_matches.append((assay_id, epitope_source, protein_id, organism, protein_9mer, epitope_9mer))
-    return local_matches
-
-# Store results
-matches = []
-
-# Iterate over protein sequences and store matches
-with tqdm(total=len(protein_sequences), desc="Processing Proteins") as pbar:
-    for protein, protein_id, org in zip(protein_sequences, protein_ids, organism):
-        matches.extend(find_fuzzy_matches(protein, protein_id, org, epitope_dict, max_mismatches))
-        pbar.update(1)
+        epitope_9mers.append(nine_mer)
+        epitope_rows.append(row)
+
+epitope_9mers = np.array(epitope_9mers, dtype=object)
+epitope_rows = np.array(epitope_rows, dtype=np.int64)
+
+if scoring == "blosum62":
+    epitope_index = ScoreEngine(epitope_9mers, min_score)
+elif engine == "block":
+    epitope_index = HammingEngine(epitope_9mers, max_mismatches)
+else:
+    epitope_index = SeedIndex(epitope_9mers, max_mismatches)
+
+# Iterate over protein sequences in chunks; hits come back as columnar arrays
+hit_proteins, hit_positions, hit_entries, hit_values = [], [], [], []
+
+with tqdm(total=len(pathogen_store), desc="Processing Proteins") as pbar:
+    for start in range(0, len(pathogen_store), proteins_per_chunk):
+        chunk = pathogen_store.sequences(start, start + proteins_per_chunk)
+        protein_idx, positions, entries, values = epitope_index.search_many(chunk)
+        hit_proteins.append(protein_idx + start)
+        hit_positions.append(positions)
+        hit_entries.append(entries)
+        hit_values.append(values)
+        pbar.update(len(chunk))
+
+hit_proteins = np.concatenate(hit_proteins) if hit_proteins else np.array([], dtype=np.int64)
+hit_positions = np.concatenate(hit_positions) if hit_positions else np.array([], dtype=np.int64)
+hit_entries = np.concatenate(hit_entries) if hit_entries else np.array([], dtype=np.int64)
+hit_values = np.concatenate(hit_values) if hit_values else np.array([], dtype=np.int64)
+hit_epitope_rows = epitope_rows[hit_entries]
 
 # Convert to DataFrame for easier viewing & saving
-match_df = pd.DataFrame(matches, columns=["Assay_ID", "Epitope Source", "Protein_ID", "Organism Source", "Matched_9mer", "Epitope_9mer"])
+match_df = pd.DataFrame({
+    "Assay_ID": epitope_ids[hit_epitope_rows],
+    "Epitope Source": epitope_sources[hit_epitope_rows],
+    "Protein_ID": protein_ids[hit_proteins],
+    "Organism Source": organism[hit_proteins],
+    "Matched_9mer": pathogen_store.slices(hit_proteins, hit_positions, 9),
+    "Epitope_9mer": epitope_9mers[hit_entries],
+})
+
+# Rank BLOSUM62 matches best first
+if scoring == "blosum62":
+    match_df["BLOSUM62_Score"] = hit_values
+    match_df = match_df.sort_values("BLOSUM62_Score", ascending=False, kind="stable").reset_index(drop=True)
 
 # Print total matches and head of DataFrame
-print(f"\nTotal Matches Found: {len(matches)}")
+print(f"\nTotal Matches Found: {len(match_df)}")
 
 # Optionally save to CSV
-match_df.to_csv("../Data/matching_9mers.csv", index=False)
+output_path = "../Data/matching_9mers_blosum62.csv" if scoring == "blosum62" else "../Data/matching_9mers.csv"
+match_df.to_csv(output_path, index=False)
 
 # %%
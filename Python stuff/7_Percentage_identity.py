@@ -1,13 +1,15 @@
 #%%
+import numpy as np
 import pandas as pd
-import requests
-from Bio import Align
-from tqdm import tqdm
-import io
+from annotation_store import AnnotationStore
+from kmer_sketch import StoreSketches, approximate_identity, sketch, sketch_kmer_size, sketch_size
+from pairwise_identity import AlignmentEngine
+from sequence_collapse import sequence_digest
+from sequence_store import SequenceStore
+from uniprot_client import UniProtClient
 
 # ---------------------- Step 1: Load Data ---------------------- #
 perfect_match = pd.read_csv("../Data/perfect_matches_finished.csv")
-pathogen_data = pd.read_csv("../Data/wrangled_all_pathogen_prots.csv")
 
 # Filter out unmatched rows (no matched 9mer = no match)
 perfect_match = perfect_match[perfect_match["Matched_9mer"].notna()].copy()
@@ -15,80 +17,147 @@ perfect_match = perfect_match[perfect_match["Matched_9mer"].notna()].copy()
 # Normalize IDs
 perfect_match["Pathogen_Protein_ID"] = perfect_match["Pathogen_Protein_ID"].astype(str).str.strip().str.upper()
 perfect_match["IEDB_Protein_ID"] = perfect_match["IEDB_Protein_ID"].astype(str).str.strip().str.upper()
+
+# Read only the matched pathogen proteins out of the packed sequence store,
+# instead of loading every sequence in wrangled_all_pathogen_prots.csv
+pathogen_store = SequenceStore.for_table("../Data/wrangled_all_pathogen_prots.csv")
+# IDs are matched stripped and upper-cased on both sides, like the normalized perfect_match
+matched_pathogen_ids = perfect_match["Pathogen_Protein_ID"].unique()
+pathogen_data = pathogen_store.select(matched_pathogen_ids, normalize=True)
+pathogen_store_rows = pathogen_store.rows_for(matched_pathogen_ids, normalize=True)
 pathogen_data["Protein_ID"] = pathogen_data["Protein_ID"].astype(str).str.strip().str.upper()
+print(f"Read {len(pathogen_data)} matched pathogen sequences from the sequence store.")
 
 # Get unique IEDB protein IDs that were matched
 matched_iedb_ids = perfect_match["IEDB_Protein_ID"].dropna().unique().tolist()
 
-# ---------------------- Step 2: Fetch UniProt Sequences ---------------------- #
-def fetch_uniprot_sequences(uniprot_ids):
-    url = "https://rest.uniprot.org/uniprotkb/stream"
-    headers = {"Accept": "text/tab-separated-values"}
-    query = f"({' OR '.join(uniprot_ids)})"
-    params = {
-        "query": f"accession:({query})",
-        "fields": "accession,sequence",
-        "format": "tsv"
-    }
-
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
+# "global_score" is the global alignment score as a percentage of the longer sequence;
+# "banded_identity" is identical columns / alignment length of a banded alignment around
+# the shared k-mer diagonal, and skips pairs sharing too few k-mers (flagged Below_Kmer_Cutoff)
+identity_method = "global_score"
 
-    df = pd.read_csv(io.StringIO(response.text), sep="\t")
-    return df.rename(columns={"Entry": "Protein_ID", "Sequence": "Full_Sequence"})
+# Screen every pair with MinHash sketches first: each gets Approx_Identity with a 95% interval,
+# and only pairs whose interval contains identity_cutoff are aligned exactly
+sketch_screen = False
+identity_cutoff = 50.0
 
-print("Fetching UniProt sequences...")
-uniprot_seq_df = fetch_uniprot_sequences(matched_iedb_ids)
-print(f"Fetched sequences for {len(uniprot_seq_df)} IEDB proteins.")
-
-# ---------------------- Step 3: Rename and Merge ---------------------- #
+# ---------------------- Step 2: Pair Table ---------------------- #
 # Rename to avoid conflict with 'Sequence' column in perfect_match
 pathogen_data = pathogen_data.rename(columns={"Sequence": "Pathogen_Sequence"})
+pathogen_data["Pathogen_Row"] = np.arange(len(pathogen_data))
 
-# Merge sequences
 full_align_analysis = (
     perfect_match
     .drop_duplicates(subset=["IEDB_Protein_ID", "Pathogen_Protein_ID"])
     .merge(
-        pathogen_data[["Protein_ID", "Genus_Species", "Pathogen_Sequence"]],
+        pathogen_data[["Protein_ID", "Genus_Species", "Pathogen_Sequence", "Pathogen_Row"]],
         how="left",
         left_on="Pathogen_Protein_ID",
         right_on="Protein_ID"
     )
-    .merge(
-        uniprot_seq_df.drop_duplicates("Protein_ID"),
-        how="left",
-        left_on="IEDB_Protein_ID",
-        right_on="Protein_ID"
-    )
+    .rename(columns={"Genus_Species": "Organism_Source"})
+    .reset_index(drop=True)
 )
 
-# Rename for consistency
-full_align_analysis = full_align_analysis.rename(columns={
-    "Full_Sequence": "IEDB_Sequence",
-    "Genus_Species": "Organism_Source"
-})
-
-# ---------------------- Step 4: Compute Alignment ---------------------- #
-aligner = Align.PairwiseAligner()
-aligner.mode = 'global'
-
-def compute_similarity(seq1, seq2):
-    if pd.isna(seq1) or pd.isna(seq2):
-        return None
-    score = aligner.score(seq1, seq2)
-    max_length = max(len(seq1), len(seq2))
-    return (score / max_length) * 100 if max_length else 0
-
-percent_identities = []
-for idx, row in tqdm(full_align_analysis.iterrows(), total=len(full_align_analysis), desc="Computing Percent Identity"):
-    pid = compute_similarity(row["IEDB_Sequence"], row["Pathogen_Sequence"])
-    percent_identities.append(pid)
-
-full_align_analysis["Percent_Identity"] = percent_identities
+# Rows waiting for the UniProt sequence of their IEDB protein
+rows_by_iedb_id = full_align_analysis.groupby("IEDB_Protein_ID", sort=False).indices
+iedb_ids_by_row = full_align_analysis["IEDB_Protein_ID"].tolist()
+pathogen_sequences = full_align_analysis["Pathogen_Sequence"].tolist()
+pathogen_rows = full_align_analysis["Pathogen_Row"].fillna(-1).astype(np.int64).to_numpy()
+
+if sketch_screen:
+    # Pathogen sketches live next to the sequence store and are only computed once per protein
+    pathogen_sketches = StoreSketches(pathogen_store).get(pathogen_store_rows)
+
+# ---------------------- Step 3: Fetch and Align ---------------------- #
+# IEDB sequences are fetched from UniProt in bounded batches, several at once. Each batch is
+# handed to the alignment engine as soon as it arrives, so downloading overlaps aligning.
+# The engine aligns each distinct (IEDB, pathogen) sequence pair once (strains often share
+# identical sequences) and checkpoints its results, so a rerun after a crash resumes.
+iedb_sequences = {}
+iedb_sketches = {}
+pair_keys = [None] * len(full_align_analysis)
+approx = {column: np.full(len(full_align_analysis), np.nan) for column in ("Approx_Identity", "Approx_Identity_Low", "Approx_Identity_High")}
+
+def sketch_sequences(annotations, sequences):
+    # IEDB sketches are kept in the annotation store under their sequence digest
+    by_digest = {sequence_digest(seq).hex(): seq for seq in sequences.values()}
+    stored = annotations.get_many(
+        f"kmer_sketch_k{sketch_kmer_size}_s{sketch_size}", by_digest,
+        lambda digests: ({d: sketch(by_digest[d]).tolist() for d in digests}, []),
+    )
+    for iedb_id, seq in sequences.items():
+        iedb_sketches[iedb_id] = np.array(stored[sequence_digest(seq).hex()], dtype=np.uint32)
+
+def submit_alignments(engine, iedb_ids):
+    rows = np.array([row for iedb_id in iedb_ids for row in rows_by_iedb_id.get(iedb_id, [])], dtype=np.int64)
+    if sketch_screen:
+        rows = rows[pathogen_rows[rows] >= 0]
+        estimate, low, high = approximate_identity(
+            np.array([iedb_sketches[iedb_ids_by_row[row]] for row in rows]).reshape(len(rows), sketch_size),
+            pathogen_sketches[pathogen_rows[rows]],
+            [min(len(iedb_sequences[iedb_ids_by_row[row]]), len(pathogen_sequences[row])) for row in rows],
+        )
+        for column, values in zip(approx, (estimate, low, high)):
+            approx[column][rows] = values
+        rows = rows[(low <= identity_cutoff) & (identity_cutoff <= high)]
+
+    keys = engine.submit([iedb_sequences[iedb_ids_by_row[row]] for row in rows], [pathogen_sequences[row] for row in rows])
+    for row, key in zip(rows, keys):
+        pair_keys[row] = key
+
+def sequence_of(entry):
+    return entry.get("sequence", {}).get("value") if entry else None
+
+print("Fetching UniProt sequences and aligning...")
+client = UniProtClient()
+with AnnotationStore() as annotations, AlignmentEngine(identity_method) as engine:
+    # Sequences already in the local annotation store are not fetched again
+    stored_sequences, to_fetch = annotations.stored("uniprot_sequence", matched_iedb_ids)
+    print(f"uniprot_sequence: {len(matched_iedb_ids) - len(to_fetch)} stored, {len(to_fetch)} to fetch")
+    iedb_sequences.update(stored_sequences)
+    if sketch_screen:
+        sketch_sequences(annotations, stored_sequences)
+    submit_alignments(engine, stored_sequences)
+
+    for entries in client.iter_entries(to_fetch, fields=("accession", "sequence")):
+        # Accessions UniProt answered 404 for (or without a sequence) are stored as not found;
+        # ones whose lookup failed are not in entries, so they are fetched again next run
+        fetched = {accession: sequence_of(entry) for accession, entry in entries.items() if sequence_of(entry)}
+        annotations.put_many("uniprot_sequence", fetched, [a for a in entries if a not in fetched])
+        iedb_sequences.update(fetched)
+        if sketch_screen:
+            sketch_sequences(annotations, fetched)
+        submit_alignments(engine, fetched)
+
+    print(f"Have sequences for {len(iedb_sequences)} IEDB proteins ({client.n_requests} UniProt requests).")
+    n_pairs = len({key for key in pair_keys if key is not None})
+    ratio = len(full_align_analysis) / n_pairs if n_pairs else 1.0
+    print(f"{len(full_align_analysis)} alignments, {n_pairs} distinct sequence pairs (redundancy ratio {ratio:.2f})")
+
+    full_align_analysis["Percent_Identity"] = engine.results(pair_keys)
+    print(engine.summary())
+
+if sketch_screen:
+    for column, values in approx.items():
+        full_align_analysis[column] = values
+    # Sketch error, measured on the pairs near the cutoff that were also aligned exactly. The sketch
+    # estimates an identity, so it is only compared with banded_identity, not with a global score
+    checked = full_align_analysis["Percent_Identity"].notna() & full_align_analysis["Approx_Identity"].notna()
+    if identity_method != "banded_identity":
+        sketch_error = f"sketch error n/a: Percent_Identity is a {identity_method}, not an identity"
+    elif not checked.any():
+        sketch_error = "sketch error n/a: no pair aligned exactly"
+    else:
+        error = (full_align_analysis.loc[checked, "Approx_Identity"] - full_align_analysis.loc[checked, "Percent_Identity"]).abs()
+        sketch_error = f"mean absolute sketch error {error.mean():.1f} identity points"
+    print(f"Sketch screen: {full_align_analysis['Approx_Identity'].notna().sum()} pairs estimated, "
+          f"{checked.sum()} within the interval of {identity_cutoff}% aligned exactly ({sketch_error})")
+
+full_align_analysis["IEDB_Sequence"] = full_align_analysis["IEDB_Protein_ID"].map(iedb_sequences)
 
 # ---------------------- Step 5: Export ---------------------- #
-result_with_similarity = full_align_analysis[[
+export_columns = [
     "IEDB_Protein_ID",
     "Pathogen_Protein_ID",
     "Strain",
@@ -97,9 +166,20 @@ result_with_similarity = full_align_analysis[[
     "Epitope_Source",
     "Disease",
     "Percent_Identity"
-]]
-
-result_with_similarity.to_csv("../Data/full_align_with_similarity.csv", index=False)
-print("\nFinished! Exported to ../Data/full_align_with_similarity.csv ✅")
+]
+if identity_method == "banded_identity":
+    # Both sequences present but no identity: the pair failed the k-mer prefilter
+    full_align_analysis["Below_Kmer_Cutoff"] = [
+        key is not None and identity is None
+        for key, identity in zip(pair_keys, full_align_analysis["Percent_Identity"])
+    ]
+    export_columns.append("Below_Kmer_Cutoff")
+if sketch_screen:
+    export_columns += list(approx)
+result_with_similarity = full_align_analysis[export_columns]
+
+output_path = "../Data/full_align_with_banded_identity.csv" if identity_method == "banded_identity" else "../Data/full_align_with_similarity.csv"
+result_with_similarity.to_csv(output_path, index=False)
+print(f"\nFinished! Exported to {output_path} ✅")
 
 #%%
@@ -0,0 +1,164 @@
+#%% IMPORTS
+import json
+import os
+import sqlite3
+import time
+import pandas as pd
+
+store_path = "../Data/annotation_store.sqlite"
+
+day = 24 * 60 * 60
+
+# SQLite caps the number of ? parameters per statement
+query_chunk_size = 500
+
+
+def source_fingerprint(paths):
+    """
+    Size and modification time of every source file, as one comparable string.
+    """
+    return json.dumps([[str(p), os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths])
+
+#%% STORE
+class AnnotationStore:
+    """
+    On-disk SQLite cache for the pipeline's network lookups and reference tables.
+
+    Lookups (UniProt entries, proteome metadata, ...) live in one table keyed by
+    (namespace, key). Found values are reused for ttl seconds; keys the source did not
+    know (404s) are remembered for negative_ttl seconds, so they are not asked again
+    on every run. Reference tables such as the DeepLoc exports are imported from their
+    CSV files once and reimported only when one of the files changes.
+    """
+    def __init__(self, path=store_path, ttl=30 * day, negative_ttl=7 * day):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "namespace TEXT, key TEXT, found INTEGER, value TEXT, fetched_at REAL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, fingerprint TEXT)")
+        self.connection.commit()
+
+    #%% LOOKUPS
+    def _cached(self, namespace, keys):
+        cached = {}
+        for i in range(0, len(keys), query_chunk_size):
+            chunk = keys[i:i + query_chunk_size]
+            rows = self.connection.execute(
+                f"SELECT key, found, value, fetched_at FROM lookups "
+                f"WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                [namespace, *chunk],
+            )
+            for key, found, value, fetched_at in rows:
+                cached[key] = (bool(found), json.loads(value), fetched_at)
+        return cached
+
+    def _expired(self, entry, now):
+        found, _, fetched_at = entry
+        return now - fetched_at >= (self.ttl if found else self.negative_ttl)
+
+    def stored(self, namespace, keys):
+        """
+        Splits keys into ({key: value} for stored, current keys that exist, [keys to fetch]).
+        """
+        keys = list(dict.fromkeys(str(k) for k in keys))
+        now = time.time()
+        cached = self._cached(namespace, keys)
+        todo = [k for k in keys if k not in cached or self._expired(cached[k], now)]
+        todo_set = set(todo)
+        values = {k: cached[k][1] for k in keys if k not in todo_set and cached[k][0]}
+        return values, todo
+
+    def put_many(self, namespace, found, not_found=()):
+        """
+        Records a fetch: the keys of found ({key: value}) as found, the keys in not_found (ones
+        the source answered did not exist) as not found. Keys whose fetch failed are not given,
+        so they are asked again next time.
+        """
+        now = time.time()
+        rows = [(namespace, str(k), 1, json.dumps(v), now) for k, v in found.items()]
+        rows += [(namespace, str(k), 0, json.dumps(None), now) for k in not_found]
+        self.connection.executemany("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def get_many(self, namespace, keys, fetch):
+        """
+        {key: value} for the keys in namespace that exist. Keys missing from the store or
+        past their TTL are passed to fetch(keys), which returns ({key: value} for the keys it
+        found, [keys the source does not know]); only those are stored. Keys in neither (their
+        fetch failed) keep their stored values, however old, and are fetched again next time.
+        A warm store makes no fetch call.
+        """
+        keys = list(dict.fromkeys(str(k) for k in keys))
+        values, todo = self.stored(namespace, keys)
+
+        if todo:
+            try:
+                found, not_found = fetch(todo)
+            except Exception as e:
+                # Expired entries are still better than nothing when the source is unreachable
+                if not self._cached(namespace, todo):
+                    raise
+                print(f"⚠️ Refreshing {len(todo)} {namespace} entries failed ({e})")
+                found, not_found = {}, []
+            else:
+                self.put_many(namespace, found, not_found)
+            values.update({k: found[k] for k in todo if k in found})
+
+            answered = set(found) | set(not_found)
+            failed = [k for k in todo if k not in answered]
+            if failed:
+                stale = self._cached(namespace, failed)
+                values.update({k: value for k, (was_found, value, _) in stale.items() if was_found})
+                print(f"⚠️ {len(failed)} {namespace} lookups failed; {len(stale)} of them use stored values")
+
+        print(f"{namespace}: {len(keys) - len(todo)} stored, {len(todo)} fetched")
+        return {k: values[k] for k in keys if k in values}
+
+    #%% REFERENCE TABLES
+    def cached_table(self, name, paths, build, index_column):
+        """
+        The DataFrame build() makes from the files in paths, kept as table name with an index
+        on index_column. build() only runs again when one of the files changes.
+        """
+        fingerprint = source_fingerprint(paths)
+        row = self.connection.execute("SELECT fingerprint FROM sources WHERE name = ?", [name]).fetchone()
+
+        if row is None or row[0] != fingerprint:
+            table_df = build()
+            table_df.to_sql(name, self.connection, if_exists="replace", index=False)
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}_{index_column}" ON "{name}" ("{index_column}")')
+            self.connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", [name, fingerprint])
+            self.connection.commit()
+            print(f"Imported {len(table_df)} rows into {name}")
+
+        return pd.read_sql(f'SELECT * FROM "{name}" ORDER BY rowid', self.connection)
+
+    def lookup(self, name, column, keys):
+        """
+        Rows of table name whose column is one of keys, through its index.
+        """
+        keys = list(dict.fromkeys(str(k) for k in keys))
+        frames = []
+        for i in range(0, len(keys), query_chunk_size):
+            chunk = keys[i:i + query_chunk_size]
+            frames.append(pd.read_sql(
+                f'SELECT * FROM "{name}" WHERE "{column}" IN ({",".join("?" * len(chunk))}) ORDER BY rowid',
+                self.connection, params=chunk,
+            ))
+        return pd.concat(frames, ignore_index=True) if frames else pd.read_sql(f'SELECT * FROM "{name}" LIMIT 0', self.connection)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# %%
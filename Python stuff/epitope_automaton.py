@@ -0,0 +1,221 @@
+#%% IMPORTS
+import hashlib
+import multiprocessing
+import os
+import pickle
+import time
+from pathlib import Path
+import ahocorasick
+import numpy as np
+from tqdm import tqdm
+
+cache_dir = Path("../Data/automaton_cache")
+
+# Bump when the automaton payload layout changes, so old cache files are never loaded
+cache_version = 2
+
+# Each pattern stores one packed integer instead of a metadata tuple:
+# (row in wrangled_IEDB.csv << 16) | (offset of the sub-epitope << 8) | sub-epitope length
+offset_bits = 8
+length_bits = 8
+max_epitope_length = (1 << length_bits) - 1
+
+#%% BUILD AHO-CORASICK AUTOMATON
+def pack_hit(row, offset, length):
+    return (row << (offset_bits + length_bits)) | (offset << length_bits) | length
+
+
+def unpack_hits(packed):
+    """
+    Splits an int64 array of automaton values into (row, offset, length) arrays.
+    """
+    rows = packed >> (offset_bits + length_bits)
+    offsets = (packed >> length_bits) & ((1 << offset_bits) - 1)
+    lengths = packed & ((1 << length_bits) - 1)
+    return rows, offsets, lengths
+
+
+def build_aho_corasick_automaton(epitopes, min_length=9):
+    """
+    Adds every sub-epitope from full length down to min_length, valued by pack_hit().
+    epitopes are the Sequence column of wrangled_IEDB.csv; the row index is the position in it.
+    """
+    A = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+    for row, epitope in enumerate(epitopes):
+        if len(epitope) > max_epitope_length:
+            raise ValueError(f"Epitope in row {row} is longer than {max_epitope_length} residues")
+        for length in range(len(epitope), min_length - 1, -1):  # 15 → 9-mers
+            for i in range(len(epitope) - length + 1):
+                A.add_word(epitope[i:i + length], pack_hit(row, i, length))
+    A.make_automaton()
+    return A
+
+#%% PERSISTED AUTOMATON
+def file_hash(path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def epitope_set_key(IEDB_data_path, min_length=9):
+    """
+    Identifies an epitope set: content hash of the epitope table plus the k-range (min_length up to full length).
+    """
+    return f"{file_hash(IEDB_data_path)[:16]}_k{min_length}-full"
+
+
+def automaton_cache_path(IEDB_data_path, min_length=9):
+    return cache_dir / f"epitope_automaton_v{cache_version}_{epitope_set_key(IEDB_data_path, min_length)}.pkl"
+
+
+def load_or_build_automaton(IEDB_data_path, IEDB_data, min_length=9):
+    """
+    Loads the pickled automaton for this exact epitope table, or builds and saves it.
+    Cache files from older versions of the table are removed.
+    """
+    path = automaton_cache_path(IEDB_data_path, min_length)
+
+    if path.exists():
+        start = time.perf_counter()
+        with open(path, "rb") as handle:
+            A = pickle.load(handle)
+        print(f"Loaded cached automaton {path.name} in {time.perf_counter() - start:.2f}s")
+        return A
+
+    start = time.perf_counter()
+    A = build_aho_corasick_automaton(IEDB_data["Sequence"].tolist(), min_length)
+    print(f"Built automaton with {len(A)} patterns in {time.perf_counter() - start:.2f}s")
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for stale in cache_dir.glob("epitope_automaton_*.pkl"):
+        stale.unlink()
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as handle:
+        pickle.dump(A, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    return A
+
+#%% BEST-HIT REDUCTION
+def best_hits(automaton, seq, assay_codes):
+    """
+    Longest hit per assay in one sequence, reduced as the automaton reports hits.
+    Ties keep the earliest hit. Returns (packed, end_idx) pairs ordered by length
+    (longest first), then by position in the hit stream.
+    """
+    shift = offset_bits + length_bits
+    mask = (1 << length_bits) - 1
+    best = {}
+
+    for i, (end_idx, packed) in enumerate(automaton.iter(seq)):
+        code = assay_codes[packed >> shift]
+        length = packed & mask
+        kept = best.get(code)
+        if kept is None or length > kept[0]:
+            best[code] = (length, i, packed, end_idx)
+
+    return [(packed, end_idx) for _, _, packed, end_idx in sorted(best.values(), key=lambda hit: (-hit[0], hit[1]))]
+
+
+class HitBuffer:
+    """
+    Preallocated int64 columns (protein index, packed value, end index) that double when full.
+    """
+    def __init__(self, capacity=1 << 16):
+        self.data = np.empty((3, capacity), dtype=np.int64)
+        self.size = 0
+
+    def _reserve(self, n):
+        if self.size + n > self.data.shape[1]:
+            grown = np.empty((3, max(2 * self.data.shape[1], self.size + n)), dtype=np.int64)
+            grown[:, :self.size] = self.data[:, :self.size]
+            self.data = grown
+
+    def extend(self, protein_idx, hits):
+        n = len(hits)
+        self._reserve(n)
+        block = self.data[:, self.size:self.size + n]
+        block[0] = protein_idx
+        block[1:] = np.array(hits, dtype=np.int64).T
+        self.size += n
+
+    def extend_block(self, block):
+        """
+        Appends a (3, n) array as returned by another buffer's to_block().
+        """
+        n = block.shape[1]
+        self._reserve(n)
+        self.data[:, self.size:self.size + n] = block
+        self.size += n
+
+    def to_block(self):
+        return self.data[:, :self.size].copy()
+
+    def columns(self):
+        """
+        Returns (protein_idx, epitope_rows, offsets, lengths, end_idx) arrays.
+        """
+        protein_idx, packed, end_idx = self.data[:, :self.size]
+        return (protein_idx, *unpack_hits(packed), end_idx)
+
+#%% SHARDED SCAN
+# Set in each worker by _init_worker; with fork these objects are shared copy-on-write
+_worker_state = {}
+
+
+def _init_worker(automaton, seqs, assay_codes):
+    _worker_state["automaton"] = automaton
+    _worker_state["seqs"] = seqs
+    _worker_state["assay_codes"] = assay_codes
+
+
+def _scan_shard(bounds):
+    start, stop = bounds
+    automaton = _worker_state["automaton"]
+    seqs = _worker_state["seqs"]
+    assay_codes = _worker_state["assay_codes"]
+
+    hits = HitBuffer(1024)
+    for p in range(start, stop):
+        row_hits = best_hits(automaton, seqs[p], assay_codes)
+        if row_hits:
+            hits.extend(p, row_hits)
+    return hits.to_block()
+
+
+def scan_sequences(automaton, seqs, assay_codes, workers=1, shards_per_worker=8):
+    """
+    Best hits for every sequence, as a HitBuffer ordered by sequence index.
+    With workers > 1 the sequences are split into contiguous row ranges that are scanned
+    in forked worker processes sharing the automaton; shards are merged in row order,
+    so the result is the same as a single-process scan.
+    """
+    if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("⚠️ Parallel scan needs the fork start method; scanning in one process")
+        workers = 1
+
+    if workers <= 1:
+        hits = HitBuffer()
+        for p, seq in enumerate(tqdm(seqs, desc="Matching epitopes")):
+            row_hits = best_hits(automaton, seq, assay_codes)
+            if row_hits:
+                hits.extend(p, row_hits)
+        return hits
+
+    shard_size = max(1, -(-len(seqs) // (workers * shards_per_worker)))
+    shards = [(start, min(start + shard_size, len(seqs))) for start in range(0, len(seqs), shard_size)]
+
+    hits = HitBuffer()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, initializer=_init_worker, initargs=(automaton, seqs, assay_codes)) as pool:
+        with tqdm(total=len(seqs), desc=f"Matching epitopes ({workers} workers)") as pbar:
+            # imap yields shards in submission order, which keeps the merge deterministic
+            for (start, stop), block in zip(shards, pool.imap(_scan_shard, shards)):
+                hits.extend_block(block)
+                pbar.update(stop - start)
+    return hits
@@ -0,0 +1,197 @@
+#%% IMPORTS
+import time
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from mismatch_search import SeedIndex, generate_9mers, kmer_length
+
+IEDB_data_path = "../Data/wrangled_IEDB.csv"
+
+# Queries never look further than this many substitutions
+max_supported_mismatches = 4
+
+# Segments each level-m seed is made of, so no seed is shorter than 3 residues
+# (at m = 3 and 4 single segments are 1-2 residues and their buckets dominate the query)
+seeds_required = {0: 1, 1: 1, 2: 1, 3: 2, 4: 3}
+
+# Median single-peptide latency the benchmark holds every supported level to
+target_p50_ms = 1.0
+
+result_columns = ["Query_9mer", "Epitope_9mer", "Mismatches", "Assay_ID", "Epitope Source", "Epitope"]
+
+#%% IN-MEMORY INDEX
+class EpitopeQueryIndex:
+    """
+    All distinct epitope 9-mers of wrangled_IEDB.csv, searchable by Hamming distance.
+
+    A query looks at 0 mismatches first, then 1, 2, ... and stops at the first level where
+    n epitopes are already found, so a close match costs one exact seed lookup.
+    Each level m has its own pigeonhole SeedIndex, built the first time it is needed; from
+    m = 3 on its seeds combine several segments (seeds_required) so that no seed is shorter
+    than 3 residues. That keeps a 9-mer query under target_p50_ms for every
+    max_mismatches up to max_supported_mismatches, on a few hundred thousand epitope 9-mers.
+    """
+    def __init__(self, IEDB_data, latency_window=10_000):
+        self.assay_ids = IEDB_data["Assay_ID"].to_numpy()
+        self.sources = IEDB_data["Epitope - Molecule Parent"].to_numpy()
+        self.sequences = IEDB_data["Sequence"].to_numpy()
+
+        # Distinct 9-mers, each pointing at the epitope rows it occurs in (in row order)
+        kmer_rows = {}
+        for row, seq in enumerate(self.sequences):
+            for nine_mer in generate_9mers(seq):
+                rows = kmer_rows.setdefault(nine_mer, [])
+                if not rows or rows[-1] != row:
+                    rows.append(row)
+        self.kmers = list(kmer_rows)
+        self.kmer_rows = list(kmer_rows.values())
+
+        self.levels = {}
+        self.latencies = np.zeros(latency_window)
+        self.n_queries = 0
+
+    @classmethod
+    def load(cls, path=IEDB_data_path):
+        return cls(pd.read_csv(path))
+
+    def _level(self, m):
+        if m not in self.levels:
+            self.levels[m] = SeedIndex(self.kmers, m, seeds_required[m])
+        return self.levels[m]
+
+    def nearest(self, peptide, n=10, max_mismatches=2):
+        """
+        Up to n epitopes closest to any 9-mer of peptide, fewest mismatches first
+        (ties in wrangled_IEDB.csv row order), as a list of dicts with result_columns.
+        """
+        start = time.perf_counter()
+        if len(peptide) < kmer_length:
+            raise ValueError(f"Peptide {peptide!r} is shorter than {kmer_length} residues")
+        if not 0 <= max_mismatches <= max_supported_mismatches:
+            raise ValueError(f"max_mismatches must be between 0 and {max_supported_mismatches}")
+
+        peptide = peptide.upper()
+        query_kmers = generate_9mers(peptide)
+        for m in range(max_mismatches + 1):
+            level = self._level(m)
+
+            # Best (mismatches, query position) per epitope row
+            best = {}
+            for pos, query_kmer in enumerate(query_kmers):
+                entries, mismatches = level.search_kmer(query_kmer)
+                for entry, n_mismatch in zip(entries.tolist(), mismatches.tolist()):
+                    for row in self.kmer_rows[entry]:
+                        kept = best.get(row)
+                        if kept is None or (n_mismatch, pos) < kept[:2]:
+                            best[row] = (n_mismatch, pos, entry)
+
+            # Every epitope within m mismatches is known now, so n of them settle the answer
+            if len(best) >= n:
+                break
+
+        ranked = sorted(best.items(), key=lambda item: (item[1][0], item[0]))[:n]
+        hits = [{
+            "Query_9mer": peptide[pos:pos + kmer_length],
+            "Epitope_9mer": self.kmers[entry],
+            "Mismatches": n_mismatch,
+            "Assay_ID": self.assay_ids[row],
+            "Epitope Source": self.sources[row],
+            "Epitope": self.sequences[row],
+        } for row, (n_mismatch, pos, entry) in ranked]
+
+        self._record(time.perf_counter() - start)
+        return hits
+
+    def nearest_many(self, peptides, n=10, max_mismatches=2):
+        """
+        nearest() for a batch of peptides, as one DataFrame with a leading Query column.
+        """
+        rows = []
+        for peptide in peptides:
+            for hit in self.nearest(peptide, n, max_mismatches):
+                rows.append({"Query": peptide, **hit})
+        return pd.DataFrame(rows, columns=["Query"] + result_columns)
+
+    #%% LATENCY
+    def _record(self, seconds):
+        self.latencies[self.n_queries % len(self.latencies)] = seconds
+        self.n_queries += 1
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Query latency in milliseconds over the most recent queries, as {"p50": ..., ...}.
+        """
+        recent = self.latencies[:min(self.n_queries, len(self.latencies))]
+        if len(recent) == 0:
+            return {}
+        return {f"p{p}": float(np.percentile(recent, p) * 1000) for p in percentiles}
+
+#%% MODULE-LEVEL API
+@lru_cache(maxsize=None)
+def get_index(path=IEDB_data_path):
+    """
+    The index for path, loaded on first use and kept for the rest of the session.
+    """
+    return EpitopeQueryIndex.load(path)
+
+
+def nearest(peptide, n=10, max_mismatches=2):
+    return get_index().nearest(peptide, n, max_mismatches)
+
+
+def nearest_many(peptides, n=10, max_mismatches=2):
+    return get_index().nearest_many(peptides, n, max_mismatches)
+
+#%% BENCHMARK
+def benchmark(n_queries=2000, max_mismatches=2, seed=0):
+    """
+    Times random queries made from mutated epitope 9-mers, checks a sample of them
+    against a full scan, prints latency percentiles and asserts the median is under target_p50_ms.
+    """
+    index = get_index()
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+    # Warm up the per-level seed indexes so build time is not counted as query latency
+    for m in range(max_mismatches + 1):
+        index._level(m)
+    index.n_queries = 0
+
+    queries = []
+    for _ in range(n_queries):
+        kmer = list(index.kmers[int(rng.integers(len(index.kmers)))])
+        for pos in rng.choice(kmer_length, int(rng.integers(0, 4)), replace=False):
+            kmer[pos] = rng.choice(letters)
+        queries.append("".join(kmer))
+
+    for query in queries[:50]:
+        got = index.nearest(query, 10, max_mismatches)
+        scanned = sorted(
+            (sum(a != b for a, b in zip(query, kmer)), row)
+            for entry, kmer in enumerate(index.kmers)
+            for row in index.kmer_rows[entry]
+        )
+        best = {}
+        for n_mismatch, row in scanned:
+            if n_mismatch <= max_mismatches:
+                best.setdefault(row, n_mismatch)
+        expected = sorted(best.items(), key=lambda item: (item[1], item[0]))[:10]
+        got = [(h["Mismatches"], h["Assay_ID"]) for h in got]
+        assert got == [(m, index.assay_ids[row]) for row, m in expected], f"nearest({query!r}) disagrees with a full scan"
+
+    index.n_queries = 0
+    for query in queries:
+        index.nearest(query, 10, max_mismatches)
+
+    percentiles = index.latency_percentiles()
+    print(f"Epitope 9-mers indexed: {len(index.kmers)}")
+    print(f"Query latency over {n_queries} queries at max_mismatches={max_mismatches} (ms): "
+          + ", ".join(f"{k}={v:.3f}" for k, v in percentiles.items()))
+    assert percentiles["p50"] < target_p50_ms, f"median query latency {percentiles['p50']:.3f} ms is over {target_p50_ms} ms"
+
+
+if __name__ == "__main__":
+    for max_mismatches in range(max_supported_mismatches + 1):
+        benchmark(max_mismatches=max_mismatches)
+
+# %%
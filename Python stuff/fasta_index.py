@@ -0,0 +1,296 @@
+#%% IMPORTS
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from fasta_io import fasta_name, fasta_suffixes, find_fasta, inflate_block, is_bgzf, is_gzip, iter_blocks, n_threads, read_block
+from uniprot_headers import extract_protein_id
+
+index_path = "../Data/proteome_index.fai"
+index_columns = ["Protein_ID", "File", "Offset", "Length"]
+
+# Inflated BGZF blocks kept between lookups (64 KiB each)
+block_cache_size = 1024
+
+
+def default_fasta_paths():
+    """
+    all_proteomes.fasta first, then the per-proteome FASTAs (plain or bgzipped).
+    """
+    paths = [find_fasta("../Data", "all_proteomes")]
+    folder = Path("../Data/proteome_fastas")
+    names = sorted({fasta_name(p) for suffix in fasta_suffixes for p in folder.glob(f"*{suffix}")})
+    paths += [find_fasta(folder, name) for name in names]
+    return [str(p) for p in paths if p is not None]
+
+#%% BUILD
+def scan_bgzf(fasta_path):
+    """
+    scan_fasta for a bgzip file. Offsets are BGZF virtual offsets (the file offset of the
+    block holding the '>' shifted left 16 bits, plus the '>''s position inside the block);
+    lengths count uncompressed bytes.
+    """
+    block_offsets, block_starts = [], []
+    starts, headers = [], []
+    position = 0
+    line_start = True
+    header = None
+
+    with open(fasta_path, "rb") as handle:
+        for block_offset, data in iter_blocks(handle):
+            if not data:
+                continue
+            block_offsets.append(block_offset)
+            block_starts.append(position)
+
+            i = 0
+            if header is not None:
+                # A header line carried over from the previous block
+                end = data.find(b"\n")
+                if end < 0:
+                    header += data
+                    position += len(data)
+                    continue
+                headers.append(bytes(header + data[:end]))
+                header = None
+                i = end
+            if i == 0 and line_start and data[:1] == b">":
+                p = 0
+            else:
+                p = data.find(b"\n>", i)
+                p = p + 1 if p >= 0 else -1
+
+            while p >= 0:
+                starts.append(position + p)
+                end = data.find(b"\n", p)
+                if end < 0:
+                    header = bytearray(data[p + 1:])
+                    break
+                headers.append(data[p + 1:end])
+                p = data.find(b"\n>", end)
+                p = p + 1 if p >= 0 else -1
+
+            line_start = data.endswith(b"\n")
+            position += len(data)
+
+    if header is not None:
+        headers.append(bytes(header))
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.diff(np.append(starts, position))
+    blocks = np.searchsorted(block_starts, starts, side="right") - 1
+    virtual_offsets = (np.array(block_offsets, dtype=np.int64)[blocks] << 16) + starts - np.array(block_starts, dtype=np.int64)[blocks]
+    for header, offset, length in zip(headers, virtual_offsets.tolist(), lengths.tolist()):
+        yield extract_protein_id(header.decode().rstrip()), offset, length
+
+
+def scan_fasta(fasta_path):
+    """
+    Yields (Protein_ID, byte offset, byte length) for every record in a FASTA file.
+    Offset points at the '>' of the header, length runs up to the next record.
+    """
+    if is_bgzf(fasta_path):
+        yield from scan_bgzf(fasta_path)
+        return
+    if is_gzip(fasta_path):
+        # Plain gzip can only be read from the start
+        print(f"⚠️ Skipping {fasta_path}: plain gzip has no random access, recompress it with fasta_io.bgzip_file")
+        return
+    with open(fasta_path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = mm.find(b">")
+            while start >= 0:
+                header_end = mm.find(b"\n", start)
+                if header_end < 0:
+                    header_end = len(mm)
+                next_start = mm.find(b"\n>", header_end)
+                end = next_start + 1 if next_start >= 0 else len(mm)
+
+                header = mm[start + 1:header_end].decode().rstrip()
+                yield extract_protein_id(header), start, end - start
+
+                start = next_start + 1 if next_start >= 0 else -1
+
+
+def build_fasta_index(fasta_paths, output_path=index_path):
+    """
+    Writes a .fai-style table mapping each Protein_ID to file, byte offset and length.
+    When an accession occurs in several files, the first file listed wins.
+    """
+    seen = set()
+    rows = []
+    for fasta_path in tqdm(fasta_paths, desc="Indexing FASTA files"):
+        for protein_id, offset, length in scan_fasta(fasta_path):
+            if protein_id in seen:
+                continue
+            seen.add(protein_id)
+            rows.append((protein_id, str(fasta_path), offset, length))
+
+    index_df = pd.DataFrame(rows, columns=index_columns)
+    index_df.to_csv(output_path, sep="\t", index=False)
+    return index_df
+
+
+def index_is_stale(fasta_paths, output_path=index_path):
+    """
+    True when the index is missing or older than any of the FASTA files.
+    """
+    if not os.path.exists(output_path):
+        return True
+    index_mtime = os.path.getmtime(output_path)
+    return any(os.path.getmtime(p) > index_mtime for p in fasta_paths)
+
+#%% RANDOM ACCESS
+class FastaIndex:
+    """
+    Reads single records straight out of the indexed FASTA files through mmap (or, for bgzip
+    files, by inflating only the blocks that hold them), so a lookup costs time and memory in
+    proportion to the number of IDs asked for.
+    """
+    def __init__(self, index_df):
+        self.files = index_df["File"].astype(str).to_numpy()
+        self.offsets = index_df["Offset"].to_numpy()
+        self.lengths = index_df["Length"].to_numpy()
+        self.rows = {pid: i for i, pid in enumerate(index_df["Protein_ID"].astype(str))}
+        self.maps = {}
+        self.bgzf = {}
+        self.handles = {}
+        self.blocks = OrderedDict()
+
+    @classmethod
+    def load(cls, path=index_path):
+        return cls(pd.read_csv(path, sep="\t", dtype={"Protein_ID": str, "File": str}))
+
+    @classmethod
+    def open(cls, fasta_paths=None, path=index_path):
+        """
+        Loads the index, (re)building it first if any FASTA file changed.
+        """
+        fasta_paths = default_fasta_paths() if fasta_paths is None else fasta_paths
+        if index_is_stale(fasta_paths, path):
+            return cls(build_fasta_index(fasta_paths, path))
+        return cls.load(path)
+
+    def _map(self, fasta_path):
+        if fasta_path not in self.maps:
+            with open(fasta_path, "rb") as handle:
+                self.maps[fasta_path] = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[fasta_path]
+
+    def _is_bgzf(self, fasta_path):
+        if fasta_path not in self.bgzf:
+            self.bgzf[fasta_path] = is_bgzf(fasta_path)
+        return self.bgzf[fasta_path]
+
+    def _compressed_block(self, fasta_path, block_offset):
+        if fasta_path not in self.handles:
+            self.handles[fasta_path] = open(fasta_path, "rb")
+        handle = self.handles[fasta_path]
+        handle.seek(block_offset)
+        return read_block(handle)
+
+    def _cache_block(self, key, entry):
+        self.blocks[key] = entry
+        self.blocks.move_to_end(key)
+        while len(self.blocks) > block_cache_size:
+            self.blocks.popitem(last=False)
+
+    def _prefetch(self, fasta_path, block_offsets):
+        """
+        Inflates the given blocks of a bgzip file in parallel into the block cache.
+        """
+        todo = [b for b in block_offsets if (fasta_path, b) not in self.blocks]
+        blocks = [self._compressed_block(fasta_path, b) for b in todo]
+        with ThreadPoolExecutor(n_threads) as pool:
+            for block_offset, block, data in zip(todo, blocks, pool.map(inflate_block, blocks)):
+                self._cache_block((fasta_path, block_offset), (data, block_offset + len(block)))
+
+    def _read_bgzf(self, fasta_path, virtual_offset, length):
+        block_offset, within = virtual_offset >> 16, virtual_offset & 0xFFFF
+        chunk = bytearray()
+        while len(chunk) < within + length:
+            key = (fasta_path, block_offset)
+            if key not in self.blocks:
+                block = self._compressed_block(fasta_path, block_offset)
+                if block is None:
+                    break
+                self._cache_block(key, (inflate_block(block), block_offset + len(block)))
+            data, block_offset = self.blocks[key]
+            self.blocks.move_to_end(key)
+            chunk += data
+        return bytes(chunk[within:within + length])
+
+    def _read(self, row):
+        fasta_path, offset, length = self.files[row], self.offsets[row], self.lengths[row]
+        if self._is_bgzf(fasta_path):
+            return self._read_bgzf(fasta_path, int(offset), int(length))
+        return self._map(fasta_path)[offset:offset + length]
+
+    def get_records(self, ids):
+        """
+        Returns {Protein_ID: (header, sequence)} for the IDs present in the index.
+        """
+        found = sorted(
+            (self.rows[pid], pid) for pid in set(ids) if pid in self.rows
+        )
+        # Sorted by row, so reads within a file go front to back. The first block of every
+        # bgzip record is inflated up front, up to half the block cache at a time, in parallel.
+        records = {}
+        for start in range(0, len(found), block_cache_size // 2):
+            group = found[start:start + block_cache_size // 2]
+            first_blocks = {}
+            for row, _ in group:
+                if self._is_bgzf(self.files[row]):
+                    first_blocks.setdefault(self.files[row], set()).add(int(self.offsets[row]) >> 16)
+            for fasta_path, block_offsets in first_blocks.items():
+                self._prefetch(fasta_path, sorted(block_offsets))
+
+            for row, pid in group:
+                records[pid] = self._parse_record(self._read(row))
+        return records
+
+    @staticmethod
+    def _parse_record(chunk):
+        header, _, body = chunk.partition(b"\n")
+        sequence = body.replace(b"\n", b"").replace(b"\r", b"").replace(b" ", b"")
+        return header[1:].decode().rstrip(), sequence.decode()
+
+    def get_sequences(self, ids):
+        """
+        Returns {Protein_ID: sequence} for the IDs present in the index.
+        """
+        return {pid: seq for pid, (_, seq) in self.get_records(ids).items()}
+
+    def __contains__(self, protein_id):
+        return protein_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def close(self):
+        for mm in self.maps.values():
+            mm.close()
+        for handle in self.handles.values():
+            handle.close()
+        self.maps = {}
+        self.handles = {}
+        self.blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    fasta_paths = default_fasta_paths()
+    index_df = build_fasta_index(fasta_paths)
+    print(f"✅ Indexed {len(index_df)} proteins from {len(fasta_paths)} FASTA files → {index_path}")
+
+# %%
@@ -0,0 +1,259 @@
+#%% IMPORTS
+import gzip
+import io
+import os
+import random
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+# Suffixes a FASTA may carry, in the order they are looked for
+fasta_suffixes = (".fasta", ".fasta.bgz", ".fasta.gz")
+
+# Uncompressed bytes per BGZF block (the format caps a compressed block at 64 KiB)
+bgzf_block_size = 0xFF00
+
+# Threads that inflate (or deflate) BGZF blocks; zlib releases the GIL while it works
+n_threads = os.cpu_count() or 1
+
+gzip_magic = b"\x1f\x8b"
+bgzf_magic = b"\x1f\x8b\x08\x04"
+bgzf_eof = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def is_gzip(path):
+    with open(path, "rb") as handle:
+        return handle.read(2) == gzip_magic
+
+
+def is_bgzf(path):
+    """
+    True for blocked gzip (bgzip) files, whose first member carries the "BC" extra subfield.
+    """
+    with open(path, "rb") as handle:
+        header = handle.read(16)
+    return header[:4] == bgzf_magic and header[12:14] == b"BC"
+
+
+def find_fasta(folder, name):
+    """
+    folder/<name>.fasta, .fasta.bgz or .fasta.gz, whichever exists first, or None.
+    """
+    for suffix in fasta_suffixes:
+        path = Path(folder) / f"{name}{suffix}"
+        if path.exists():
+            return path
+    return None
+
+
+def fasta_name(path):
+    """
+    File name without its FASTA suffix (UP000000625.fasta.bgz → UP000000625).
+    """
+    name = Path(path).name
+    for suffix in fasta_suffixes:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return Path(path).stem
+
+#%% BGZF BLOCKS
+def read_block(handle):
+    """
+    The next whole BGZF block from a binary handle, or None at the end of the file.
+    """
+    header = handle.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != bgzf_magic:
+        raise OSError("Not a BGZF block")
+    xlen = int.from_bytes(header[10:12], "little")
+    extra = handle.read(xlen)
+
+    block_size = None
+    i = 0
+    while i + 4 <= len(extra):
+        subfield_length = int.from_bytes(extra[i + 2:i + 4], "little")
+        if extra[i:i + 2] == b"BC" and subfield_length == 2:
+            block_size = int.from_bytes(extra[i + 4:i + 6], "little") + 1
+        i += 4 + subfield_length
+    if block_size is None:
+        raise OSError("BGZF block without a BC subfield")
+
+    rest = handle.read(block_size - 12 - xlen)
+    if len(rest) < block_size - 12 - xlen:
+        raise EOFError("Truncated BGZF block")
+    return header + extra + rest
+
+
+def inflate_block(block):
+    """
+    The uncompressed bytes of one BGZF block, checked against its CRC32 and length.
+    """
+    xlen = int.from_bytes(block[10:12], "little")
+    crc, size = struct.unpack("<II", block[-8:])
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise OSError("BGZF block failed its CRC check")
+    return data
+
+
+def deflate_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = bgzf_magic + b"\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+    return header + struct.pack("<H", len(header) + 2 + len(cdata) + 8 - 1) + cdata + struct.pack(
+        "<II", zlib.crc32(data), len(data))
+
+
+def iter_blocks(handle, threads=None, start=0):
+    """
+    Yields (file offset, uncompressed bytes) of every BGZF block from start on, in file order.
+    Up to 4 blocks per thread are inflated ahead of the one being yielded.
+    """
+    threads = threads or n_threads
+    handle.seek(start)
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        offset = start
+        while True:
+            while len(pending) < 4 * threads:
+                block = read_block(handle)
+                if block is None:
+                    break
+                pending.append((offset, pool.submit(inflate_block, block)))
+                offset += len(block)
+            if not pending:
+                return
+            block_offset, future = pending.popleft()
+            yield block_offset, future.result()
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Read-only stream of a BGZF file's uncompressed bytes, inflated threads blocks at a time.
+    """
+    def __init__(self, path, threads=None):
+        self.handle = open(path, "rb")
+        self.blocks = iter_blocks(self.handle, threads)
+        self.pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.pending = memoryview(block[1])
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+            self.handle.close()
+        super().close()
+
+
+def open_fasta(path, mode="rt", threads=None):
+    """
+    Opens a plain, gzip or bgzip FASTA (told apart by their first bytes) for reading, in text
+    ("rt") or binary ("rb") mode. Bgzip files are inflated in parallel across threads.
+    """
+    if is_bgzf(path):
+        stream = io.BufferedReader(BgzfReader(path, threads), buffer_size=bgzf_block_size)
+    elif is_gzip(path):
+        stream = gzip.open(path, "rb")
+    else:
+        return open(path, "r" if mode == "rt" else "rb")
+    return io.TextIOWrapper(stream) if mode == "rt" else stream
+
+#%% WRITING
+def bgzip_stream(source, output_path, threads=None, level=6):
+    """
+    Writes the bytes of a binary stream to output_path as BGZF, deflating blocks in parallel.
+    The file appears under its name only once it is complete.
+    """
+    threads = threads or n_threads
+    tmp_path = Path(str(output_path) + ".tmp")
+    try:
+        with open(tmp_path, "wb") as target, ThreadPoolExecutor(threads) as pool:
+            while True:
+                chunk = source.read(bgzf_block_size * 4 * threads)
+                if not chunk:
+                    break
+                blocks = [chunk[i:i + bgzf_block_size] for i in range(0, len(chunk), bgzf_block_size)]
+                for block in pool.map(deflate_block, blocks, [level] * len(blocks)):
+                    target.write(block)
+            target.write(bgzf_eof)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, output_path)
+
+
+def bgzip_file(input_path, output_path=None, threads=None, level=6):
+    """
+    Compresses a FASTA (plain or gzip) to <input>.bgz, or output_path. Returns the output path.
+    """
+    output_path = output_path or Path(str(input_path).removesuffix(".gz") + ".bgz")
+    with open_fasta(input_path, "rb") as source:
+        bgzip_stream(source, output_path, threads, level)
+    return Path(output_path)
+
+#%% CHECK
+def check_round_trip(n_records=3000, seed=0):
+    """
+    Bgzips a random FASTA and checks that open_fasta reads back the same records (so does the
+    standard gzip module, which treats BGZF as ordinary gzip), then times plain, single-threaded
+    and parallel reads.
+    """
+    rng = random.Random(seed)
+    alphabet = "ACDEFGHIKLMNPQRSTVWY"
+    lines = []
+    for i in range(n_records):
+        seq = "".join(rng.choice(alphabet) for _ in range(rng.randint(50, 900)))
+        lines.append(f">tr|Q{i:05d}|Q{i:05d}_BACT Protein {i} OS=Genus species OX=1 PE=4 SV=1")
+        lines += [seq[k:k + 60] for k in range(0, len(seq), 60)]
+    text = "\n".join(lines) + "\n"
+
+    with tempfile.TemporaryDirectory() as folder:
+        plain_path = Path(folder, "test.fasta")
+        plain_path.write_text(text)
+        bgz_path = bgzip_file(plain_path)
+        with gzip.open(plain_path.with_name("test.fasta.gz"), "wt") as handle:
+            handle.write(text)
+
+        with gzip.open(bgz_path, "rt") as handle:
+            assert handle.read() == text, "gzip module reads the BGZF file differently"
+        expected = list(SimpleFastaParser(io.StringIO(text)))
+        readers = [("plain", plain_path, None), ("gzip", plain_path.with_name("test.fasta.gz"), None),
+                   ("bgzip, 1 thread", bgz_path, 1)]
+        if n_threads > 1:
+            readers.append((f"bgzip, {n_threads} threads", bgz_path, n_threads))
+        timings = {}
+        for label, path, threads in readers:
+            start = time.perf_counter()
+            with open_fasta(path, threads=threads) as handle:
+                records = list(SimpleFastaParser(handle))
+            timings[label] = time.perf_counter() - start
+            assert records == expected, f"{label} records differ"
+        ratio = plain_path.stat().st_size / bgz_path.stat().st_size
+
+    print(f"✅ {n_records} records read back from plain, gzip and bgzip; bgzip file {ratio:.1f}x smaller")
+    for label, seconds in timings.items():
+        print(f"   {label:<20} {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    check_round_trip()
+
+# %%
@@ -0,0 +1,116 @@
+#%% IMPORTS
+import pandas as pd
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from tqdm import tqdm
+from fasta_io import open_fasta
+from sequence_store import SequenceStoreWriter
+from uniprot_headers import header_columns, parse_headers
+
+# Columns of wrangled_all_pathogen_prots.csv
+metadata_columns = header_columns + ["Sequence"]
+
+#%% RECORD PARSING
+def parse_batch(batch):
+    """
+    Turns a list of (title, sequence) pairs into a DataFrame with metadata_columns.
+    """
+    titles = [title for title, _ in batch]
+    fallback_ids = [title.split(None, 1)[0] if title else "" for title in titles]
+    batch_df = parse_headers(titles, fallback_ids)
+    batch_df["Sequence"] = [seq for _, seq in batch]
+    return batch_df
+
+
+#%% STREAMING
+def iter_record_batches(records, batch_size):
+    """
+    Groups an iterator of records into lists of at most batch_size records.
+    """
+    batch = []
+    for seq_record in records:
+        batch.append(seq_record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class TableWriter:
+    """
+    Appends DataFrame batches to a CSV file, or to a Parquet file as one row group per batch.
+    """
+    def __init__(self, output_path):
+        self.output_path = str(output_path)
+        self.parquet = self.output_path.endswith(".parquet")
+        self.writer = None
+        self.first = True
+
+    def write(self, batch_df):
+        if self.parquet:
+            # pyarrow is only needed for Parquet output
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([(col, pa.string()) for col in batch_df.columns])
+            table = pa.Table.from_pandas(batch_df, schema=schema, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.output_path, schema)
+            self.writer.write_table(table)
+        else:
+            batch_df.to_csv(self.output_path, mode="w" if self.first else "a", header=self.first, index=False)
+        self.first = False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stream_records_to_table(records, output_path, batch_size=50_000, store_dir=None, desc="Parsing records"):
+    """
+    Writes the metadata table of an iterator of (title, sequence) records batch by batch,
+    so peak memory is bounded by batch_size rather than by the number of proteomes.
+    With store_dir, the same batches also go into a packed sequence store for output_path.
+    Returns the number of records written.
+    """
+    n_written = 0
+    store = SequenceStoreWriter(store_dir) if store_dir is not None else None
+
+    try:
+        with TableWriter(output_path) as writer, tqdm(desc=desc, unit=" sequence") as pbar:
+            for batch in iter_record_batches(records, batch_size):
+                batch_df = parse_batch(batch)
+                writer.write(batch_df)
+                if store is not None:
+                    store.write(batch_df)
+                n_written += len(batch_df)
+                pbar.update(len(batch_df))
+
+            # Keep an empty input from silently producing no file
+            if n_written == 0:
+                writer.write(pd.DataFrame(columns=metadata_columns))
+    except BaseException:
+        if store is not None:
+            store.abort()
+        raise
+
+    # The store records the finished table, so it is closed after the table
+    if store is not None:
+        store.close(output_path)
+
+    return n_written
+
+
+def stream_fasta_to_table(fasta_path, output_path, batch_size=50_000, store_dir=None):
+    """
+    stream_records_to_table for one FASTA file (plain, gzip or bgzip), parsed lazily.
+    """
+    with open_fasta(fasta_path) as handle:
+        return stream_records_to_table(SimpleFastaParser(handle), output_path, batch_size, store_dir,
+                                       desc=f"Parsing {fasta_path}")
@@ -0,0 +1,179 @@
+#%% IMPORTS
+import numpy as np
+from pairwise_identity import kmer_codes
+
+sketch_kmer_size = 5
+sketch_size = 1024
+
+# One multiply-shift hash per sketch slot, fixed so sketches stay comparable between runs
+_rng = np.random.default_rng(20240521)
+hash_multipliers = _rng.integers(1, 1 << 63, sketch_size, dtype=np.uint64) | np.uint64(1)
+hash_offsets = _rng.integers(0, 1 << 63, sketch_size, dtype=np.uint64)
+
+# Sketch value of a sequence without a single k-mer
+empty_slot = np.uint32(0xFFFFFFFF)
+
+#%% SKETCHES
+def sketch(seq, k=sketch_kmer_size, size=sketch_size):
+    """
+    MinHash sketch of the distinct k-mers of seq: for each of size hash functions, the
+    smallest hash any k-mer gets. Two sketches agree in a slot with probability equal to
+    the Jaccard similarity of the two k-mer sets.
+    """
+    codes = np.unique(kmer_codes(seq, k)).astype(np.uint64)
+    if len(codes) == 0:
+        return np.full(size, empty_slot, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        hashes = (codes[:, None] * hash_multipliers[:size] + hash_offsets[:size]) >> np.uint64(32)
+    return hashes.min(axis=0).astype(np.uint32)
+
+
+def sketch_many(seqs, k=sketch_kmer_size, size=sketch_size):
+    sketches = np.empty((len(seqs), size), dtype=np.uint32)
+    for i, seq in enumerate(seqs):
+        sketches[i] = sketch(seq, k, size)
+    return sketches
+
+
+def jaccard_estimates(sketches1, sketches2):
+    """
+    Estimated k-mer Jaccard similarity of each row of sketches1 with the same row of sketches2.
+    """
+    agree = (sketches1 == sketches2).mean(axis=1)
+    empty = (sketches1 == empty_slot).all(axis=1) | (sketches2 == empty_slot).all(axis=1)
+    return np.where(empty, 0.0, agree)
+
+
+def identity_from_jaccard(jaccard, k=sketch_kmer_size):
+    """
+    Percent identity implied by a k-mer Jaccard similarity, assuming independent substitutions:
+    a k-mer survives with probability identity ** k, and that is the shared fraction 2J / (1 + J).
+    """
+    jaccard = np.clip(np.asarray(jaccard, dtype=float), 0, 1)
+    return 100 * (2 * jaccard / (1 + jaccard)) ** (1 / k)
+
+
+def jaccard_interval(jaccard, n_effective, z=1.96):
+    """
+    Wilson score interval of a Jaccard estimate worth n_effective independent slots. Unlike
+    jaccard ± z·sd it stays informative when few or no slots agree.
+    """
+    z2 = z * z / n_effective
+    centre = (jaccard + z2 / 2) / (1 + z2)
+    half = z * np.sqrt(jaccard * (1 - jaccard) / n_effective + z2 / (4 * n_effective)) / (1 + z2)
+    return centre - half, centre + half
+
+
+def approximate_identity(sketches1, sketches2, lengths=None, k=sketch_kmer_size, z=1.96):
+    """
+    (approximate percent identity, lowest and highest identity of its z-score interval) for
+    each row pair. The interval is a Wilson interval on the Jaccard estimate, whose variance
+    adds two parts: the binomial error of the sketch slots, and, when lengths (of the shorter
+    sequence of each pair) are given, the spread of the shared k-mer count itself. Overlapping
+    k-mers survive together, which inflates the binomial variance by 1 + 2 (p + ... + p ** (k - 1)).
+    """
+    jaccard = jaccard_estimates(sketches1, sketches2)
+    estimate = identity_from_jaccard(jaccard, k)
+    variance = np.full(len(jaccard), 1 / sketches1.shape[1])
+    if lengths is not None:
+        p = estimate / 100
+        overlap = 1 + 2 * sum(p ** d for d in range(1, k))
+        n_kmers = np.maximum(np.asarray(lengths, dtype=float) - k + 1, 1)
+        variance += overlap / (2 * n_kmers)
+    low, high = jaccard_interval(jaccard, 1 / variance, z)
+    return estimate, identity_from_jaccard(low, k), identity_from_jaccard(high, k)
+
+#%% STORED SKETCHES
+class StoreSketches:
+    """
+    Sketches of a SequenceStore's rows, kept in the store directory as a memory-mapped
+    (rows, size) array plus a mask of the rows already sketched. Rows are sketched the
+    first time they are asked for, so later runs only read them.
+    """
+    def __init__(self, store, k=sketch_kmer_size, size=sketch_size):
+        self.store = store
+        self.k = k
+        self.size = size
+        name = f"sketches_k{k}_s{size}"
+        self.sketch_path = store.store_dir / f"{name}.npy"
+        self.built_path = store.store_dir / f"{name}_built.npy"
+
+        if self.sketch_path.exists() and self.built_path.exists():
+            self.sketches = np.load(self.sketch_path, mmap_mode="r+")
+            self.built = np.load(self.built_path)
+        else:
+            self.sketches = np.lib.format.open_memmap(self.sketch_path, mode="w+", dtype=np.uint32, shape=(len(store), size))
+            self.built = np.zeros(len(store), dtype=bool)
+
+    def get(self, rows):
+        """
+        Sketches of the given store rows, sketching (and saving) the ones not seen before.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        missing = np.unique(rows[~self.built[rows]])
+        if len(missing):
+            self.sketches[missing] = sketch_many([self.store[i] for i in missing], self.k, self.size)
+            self.sketches.flush()
+            self.built[missing] = True
+            np.save(self.built_path, self.built)
+        return np.asarray(self.sketches[rows])
+
+#%% CHECK
+def check_against_exact(n_pairs=300, seed=0):
+    """
+    Sketch Jaccard estimates should fall within their stated error of the exact k-mer
+    Jaccard similarity for about 95% of pairs.
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    seqs1, seqs2 = [], []
+    for _ in range(n_pairs):
+        seq1 = "".join(rng.choice(alphabet, rng.integers(100, 1500)))
+        rate = rng.uniform(0, 0.5)
+        seq2 = "".join(rng.choice(alphabet) if rng.random() < rate else c for c in seq1)
+        seqs1.append(seq1)
+        seqs2.append(seq2)
+
+    estimated = jaccard_estimates(sketch_many(seqs1), sketch_many(seqs2))
+    exact = np.array([
+        len(np.intersect1d(kmer_codes(a, sketch_kmer_size), kmer_codes(b, sketch_kmer_size)))
+        / len(np.union1d(kmer_codes(a, sketch_kmer_size), kmer_codes(b, sketch_kmer_size)))
+        for a, b in zip(seqs1, seqs2)
+    ])
+    error = np.maximum(1.96 * np.sqrt(exact * (1 - exact) / sketch_size), 1.96 / sketch_size)
+    covered = np.mean(np.abs(estimated - exact) <= error)
+    assert covered >= 0.9, f"only {covered:.0%} of estimates within their error"
+    print(f"✅ {covered:.0%} of {n_pairs} sketch estimates within their 95% error "
+          f"(mean absolute Jaccard error {np.abs(estimated - exact).mean():.3f})")
+
+
+def check_identity_interval(n_pairs=60, identities=(0.1, 0.2, 0.3, 0.5, 0.7, 0.9), cutoff=50, seed=0):
+    """
+    approximate_identity intervals of substituted copies should hold the true percent identity
+    for about 95% of pairs, and pairs of 300+ residues at 20% identity or less should resolve
+    below cutoff without an alignment.
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    covered, resolved = [], {}
+    for identity in identities:
+        seqs1 = ["".join(rng.choice(alphabet, rng.integers(300, 1500))) for _ in range(n_pairs)]
+        seqs2 = ["".join(c if rng.random() < identity else rng.choice(alphabet) for c in seq) for seq in seqs1]
+        true = np.array([100 * np.mean([a == b for a, b in zip(seq1, seq2)]) for seq1, seq2 in zip(seqs1, seqs2)])
+        _, low, high = approximate_identity(sketch_many(seqs1), sketch_many(seqs2), [len(seq) for seq in seqs1])
+        covered.append((low <= true) & (true <= high))
+        resolved[identity] = np.mean((high < cutoff) | (low > cutoff))
+    coverage = np.concatenate(covered).mean()
+    assert coverage >= 0.9, f"only {coverage:.0%} of intervals hold the true identity"
+    for identity in identities:
+        if identity <= 0.2:
+            assert resolved[identity] >= 0.9, f"only {resolved[identity]:.0%} of {identity:.0%} identity pairs resolved"
+    print(f"✅ {coverage:.0%} of identity intervals hold the true identity; resolved against {cutoff}% without "
+          f"aligning: " + ", ".join(f"{resolved[i]:.0%} at {i:.0%}" for i in identities))
+
+
+if __name__ == "__main__":
+    check_against_exact()
+    check_identity_interval()
+
+# %%
@@ -0,0 +1,342 @@
+#%% IMPORTS
+from itertools import combinations
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+kmer_length = 9
+
+# 9-mers are packed into 45 bits, 5 bits per residue: A-Z and '*' get their own code,
+# anything else shares code 31 and is re-checked byte by byte
+residue_bits = 5
+other_code = 31
+residue_codes = np.full(256, other_code, dtype=np.uint64)
+residue_codes[np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ*", dtype=np.uint8)] = np.arange(1, 28, dtype=np.uint64)
+
+# Lowest bit of every residue field, and a multiplier that sums those bits into the top field
+low_bits = np.uint64(sum(1 << (residue_bits * j) for j in range(kmer_length)))
+top_shift = np.uint64(residue_bits * (kmer_length - 1))
+
+#%% ENCODING
+# Function to generate all 9-mers from a sequence (optimized)
+def generate_9mers(seq):
+    return [seq[i:i+9] for i in range(len(seq) - 8)] if len(seq) >= 9 else []
+
+
+def encode(seq):
+    """
+    Residues as a uint8 array (their ASCII bytes), so equal residues have equal codes.
+    """
+    return np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+
+
+def kmer_windows(codes, k=kmer_length):
+    """
+    All k-mers of an encoded sequence as a (n, k) read-only view; no data is copied.
+    """
+    if len(codes) < k:
+        return np.empty((0, k), dtype=np.uint8)
+    return sliding_window_view(codes, k)
+
+
+def protein_windows(proteins, k=kmer_length):
+    """
+    Every k-mer of many proteins at once. The proteins are joined into one uint8 buffer and
+    the k-mers are a strided view over it; k-mers crossing a protein boundary are skipped.
+    Returns (windows view, window start in the buffer, protein index, position in protein).
+    """
+    codes = encode("".join(proteins))
+    lengths = np.fromiter((len(p) for p in proteins), dtype=np.int64, count=len(proteins))
+    n_windows = np.maximum(lengths - k + 1, 0)
+    protein_starts = np.cumsum(lengths) - lengths
+
+    protein_idx = np.repeat(np.arange(len(proteins)), n_windows)
+    positions = np.arange(n_windows.sum()) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+    return kmer_windows(codes, k), protein_starts[protein_idx] + positions, protein_idx, positions
+
+
+def split_segments(length, max_mismatches, seeds_required=1):
+    """
+    Cuts positions 0..length-1 into max_mismatches + seeds_required contiguous, near-equal segments.
+    By the pigeonhole principle, two k-mers within max_mismatches substitutions
+    agree exactly on at least seeds_required of them.
+    """
+    n_segments = min(max_mismatches + seeds_required, length)
+    bounds = np.linspace(0, length, n_segments + 1).round().astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def pack_kmers(windows):
+    """
+    Packs (n, 9) uint8 k-mers into uint64 codes. Also returns a mask of k-mers
+    holding a residue without its own code, which need a byte-level check.
+    """
+    packed = np.zeros(len(windows), dtype=np.uint64)
+    ambiguous = np.zeros(len(windows), dtype=bool)
+    for j in range(windows.shape[1]):
+        codes = residue_codes[windows[:, j]]
+        ambiguous |= codes == other_code
+        packed = (packed << np.uint64(residue_bits)) | codes
+    return packed, ambiguous
+
+
+def field_mask(start, stop, k=kmer_length):
+    """
+    Bits of the packed code that hold positions start..stop-1 (position 0 is the highest field).
+    """
+    return np.uint64(sum(((1 << residue_bits) - 1) << (residue_bits * (k - 1 - j)) for j in range(start, stop)))
+
+
+def mismatch_fields(a, b):
+    """
+    For packed k-mers a and b: one set bit per differing position, at the low bit of its field.
+    """
+    x = a ^ b
+    one, two, three, four = (np.uint64(n) for n in (1, 2, 3, 4))
+    return (x | (x >> one) | (x >> two) | (x >> three) | (x >> four)) & low_bits
+
+
+def count_fields(fields):
+    """
+    Number of set low bits, summed into the top field by one multiplication.
+    """
+    return ((fields * low_bits) >> top_shift) & np.uint64((1 << residue_bits) - 1)
+
+#%% PIGEONHOLE SEED INDEX
+class SeedIndex:
+    """
+    Multi-seed index over epitope 9-mers for ≤ max_mismatches substitution search.
+    Every 9-mer within max_mismatches is guaranteed to share a seed with the query,
+    and every candidate is confirmed with an exact Hamming distance.
+
+    With seeds_required > 1 the 9-mer is cut into max_mismatches + seeds_required segments
+    and each seed is a combination of seeds_required of them. Seeds get longer and buckets
+    smaller, at the cost of more seed tables; worth it once single segments are 1-2 residues.
+    """
+    def __init__(self, epitope_kmers, max_mismatches, seeds_required=1):
+        self.max_mismatches = max_mismatches
+        self.kmers = np.array([encode(kmer) for kmer in epitope_kmers], dtype=np.uint8).reshape(-1, kmer_length)
+        self.packed, self.ambiguous = pack_kmers(self.kmers)
+        # Never ask for more exact segments than the substitutions leave untouched
+        self.seeds_required = max(1, min(seeds_required, kmer_length - max_mismatches))
+        self.segments = split_segments(kmer_length, max_mismatches, self.seeds_required)
+        self.seed_masks = np.array([
+            np.bitwise_or.reduce([field_mask(start, stop) for start, stop in combination])
+            for combination in combinations(self.segments, self.seeds_required)
+        ], dtype=np.uint64)
+
+        # All seed tables in one sorted array: each key carries its seed number above the
+        # packed residues, so every seed of a 9-mer is looked up by one searchsorted call
+        self.seed_tags = np.arange(len(self.seed_masks), dtype=np.uint64) << np.uint64(residue_bits * kmer_length)
+        seed_keys, seed_entries = [], []
+        for tag, mask in zip(self.seed_tags, self.seed_masks):
+            keys = tag | (self.packed & mask)
+            order = np.argsort(keys, kind="stable")
+            seed_keys.append(keys[order])
+            seed_entries.append(order)
+        self.seed_keys = np.concatenate(seed_keys)
+        self.seed_entries = np.concatenate(seed_entries)
+
+    def search(self, protein, block_size=4096):
+        """
+        Returns (positions, entries, mismatches) arrays for every protein 9-mer / epitope 9-mer
+        pair within max_mismatches, ordered by protein position, then by entry.
+        """
+        windows = kmer_windows(encode(protein))
+        found = []
+        for block_start in range(0, len(windows), block_size):
+            found.append(self._search_block(windows[block_start:block_start + block_size], block_start))
+
+        if not found:
+            return tuple(np.array([], dtype=np.int64) for _ in range(3))
+        positions, entries, mismatches = (np.concatenate(a) for a in zip(*found))
+        order = np.lexsort((entries, positions))
+        return positions[order], entries[order], mismatches[order]
+
+    def search_kmer(self, kmer):
+        """
+        (entries, mismatches) arrays for a single 9-mer, in entry order.
+        One vectorised lookup over all seeds, for interactive queries where per-call overhead dominates.
+        """
+        codes = encode(kmer)
+        packed = 0
+        for code in residue_codes[codes].tolist():
+            packed = (packed << residue_bits) | int(code)
+        keys = self.seed_tags | (np.uint64(packed) & self.seed_masks)
+        lo = self.seed_keys.searchsorted(keys, "left")
+        counts = self.seed_keys.searchsorted(keys, "right") - lo
+        total = counts.sum()
+        if total == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        cand = self.seed_entries[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(total)]
+
+        # Distances on the raw bytes, so catch-all seed collisions cannot add false hits;
+        # duplicates from several shared seeds are dropped after the (few) hits are kept
+        n_mismatch = np.count_nonzero(self.kmers[cand] != codes, axis=1)
+        keep = n_mismatch <= self.max_mismatches
+        entries, first = np.unique(cand[keep], return_index=True)
+        return entries, n_mismatch[keep][first]
+
+    def search_many(self, proteins):
+        """
+        Columnar (protein index, position, entry, mismatches) arrays over a list of proteins.
+        """
+        found = []
+        for i, protein in enumerate(proteins):
+            positions, entries, mismatches = self.search(protein)
+            found.append((np.full(len(positions), i), positions, entries, mismatches))
+        if not found:
+            return tuple(np.array([], dtype=np.int64) for _ in range(4))
+        return tuple(np.concatenate(a).astype(np.int64) for a in zip(*found))
+
+    def _search_block(self, windows, offset):
+        packed, ambiguous = pack_kmers(windows)
+        positions, entries, mismatches = [], [], []
+
+        for s, (tag, mask) in enumerate(zip(self.seed_tags, self.seed_masks)):
+            keys = tag | (packed & mask)
+            lo = np.searchsorted(self.seed_keys, keys, side="left")
+            hi = np.searchsorted(self.seed_keys, keys, side="right")
+            counts = hi - lo
+            total = counts.sum()
+            if total == 0:
+                continue
+
+            # Expand each window's bucket range into explicit (window, entry) candidate pairs
+            window_idx = np.repeat(np.arange(len(windows)), counts)
+            run_starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            cand = self.seed_entries[run_starts + np.arange(total)]
+
+            fields = mismatch_fields(packed[window_idx], self.packed[cand])
+            n_mismatch = count_fields(fields).astype(np.int64)
+
+            # Residues sharing the catch-all code are compared byte by byte
+            recheck = np.flatnonzero(ambiguous[window_idx] | self.ambiguous[cand])
+            if len(recheck):
+                equal = windows[window_idx[recheck]] == self.kmers[cand[recheck]]
+                n_mismatch[recheck] = kmer_length - equal.sum(axis=1)
+                for j in range(kmer_length):
+                    position_bit = np.uint64(1 << (residue_bits * (kmer_length - 1 - j)))
+                    fields[recheck] = np.where(equal[:, j], fields[recheck] & ~position_bit, fields[recheck] | position_bit)
+
+            # Seeds can collide on the catch-all code, so the seed itself must really match
+            keep = (n_mismatch <= self.max_mismatches) & ((fields & mask) == 0)
+
+            # A pair sharing several seeds is reported only by the first seed it shares
+            for earlier_mask in self.seed_masks[:s]:
+                keep &= (fields & earlier_mask) != 0
+
+            positions.append(window_idx[keep] + offset)
+            entries.append(cand[keep])
+            mismatches.append(n_mismatch[keep])
+
+        if not positions:
+            return tuple(np.array([], dtype=np.int64) for _ in range(3))
+        return tuple(np.concatenate(a).astype(np.int64) for a in (positions, entries, mismatches))
+
+#%% BLOCKED HAMMING ENGINE
+class HammingEngine:
+    """
+    Compares every protein 9-mer with every epitope 9-mer on the raw uint8 residues,
+    one position at a time by broadcasting, in blocks of protein 9-mers sized so the
+    (block, epitope) work buffers stay in cache. No seeds, so the cost does not
+    grow with max_mismatches.
+    """
+    def __init__(self, epitope_kmers, max_mismatches, cache_bytes=1 << 19):
+        self.max_mismatches = max_mismatches
+        self.kmers = np.array([encode(kmer) for kmer in epitope_kmers], dtype=np.uint8).reshape(-1, kmer_length)
+        # Position-major copy, so each position's residues are one contiguous row
+        self.columns = np.ascontiguousarray(self.kmers.T)
+        self.block_rows = max(1, cache_bytes // (2 * max(1, len(self.kmers))))
+
+    def search_many(self, proteins):
+        """
+        Columnar (protein index, position, entry, mismatches) arrays over a list of proteins,
+        ordered by protein, position, then entry.
+        """
+        windows, window_starts, protein_idx, positions = protein_windows(proteins)
+        n_entries = len(self.kmers)
+        counts = np.empty((self.block_rows, n_entries), dtype=np.uint8)
+        differs = np.empty((self.block_rows, n_entries), dtype=bool)
+
+        hit_windows, hit_entries, hit_mismatches = [], [], []
+        for start in range(0, len(window_starts), self.block_rows):
+            block = windows[window_starts[start:start + self.block_rows]]
+            block_counts = counts[:len(block)]
+            block_differs = differs[:len(block)]
+
+            block_counts[:] = 0
+            for j in range(kmer_length):
+                np.not_equal(block[:, j, None], self.columns[j][None, :], out=block_differs)
+                block_counts += block_differs
+
+            w, e = np.nonzero(block_counts <= self.max_mismatches)
+            hit_mismatches.append(block_counts[w, e].astype(np.int64))
+            hit_windows.append(w + start)
+            hit_entries.append(e)
+
+        if not hit_windows:
+            return tuple(np.array([], dtype=np.int64) for _ in range(4))
+        w = np.concatenate(hit_windows)
+        return protein_idx[w], positions[w], np.concatenate(hit_entries).astype(np.int64), np.concatenate(hit_mismatches)
+
+#%% BRUTE-FORCE REFERENCE
+def brute_force_search(protein, epitope_kmers, max_mismatches):
+    """
+    Every (position, entry, mismatches) pair by plain string comparison.
+    """
+    hits = []
+    for pos, protein_kmer in enumerate(generate_9mers(protein)):
+        for entry, epitope_kmer in enumerate(epitope_kmers):
+            n_mismatch = sum(a != b for a, b in zip(protein_kmer, epitope_kmer))
+            if n_mismatch <= max_mismatches:
+                hits.append((pos, entry, n_mismatch))
+    return hits
+
+
+def check_against_brute_force(n_trials=40, alphabet="ACDEFGHIKLMNPQRSTVWYXUbz-", seed=0):
+    """
+    Compares SeedIndex.search with brute_force_search on random proteins and epitopes.
+    Epitopes are partly mutated copies of protein 9-mers, so every mismatch count occurs.
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(alphabet))
+
+    for trial in range(n_trials):
+        max_mismatches = int(rng.integers(0, 5))
+        protein = "".join(rng.choice(letters, int(rng.integers(5, 300))))
+        protein_kmers = generate_9mers(protein)
+
+        epitope_kmers = []
+        for _ in range(int(rng.integers(1, 200))):
+            if protein_kmers and rng.random() < 0.7:
+                kmer = list(protein_kmers[int(rng.integers(len(protein_kmers)))])
+                for pos in rng.choice(kmer_length, int(rng.integers(0, 7)), replace=False):
+                    kmer[pos] = rng.choice(letters)
+                epitope_kmers.append("".join(kmer))
+            else:
+                epitope_kmers.append("".join(rng.choice(letters, kmer_length)))
+
+        expected = brute_force_search(protein, epitope_kmers, max_mismatches)
+
+        index = SeedIndex(epitope_kmers, max_mismatches, seeds_required=int(rng.integers(1, 4)))
+        got = list(zip(*(a.tolist() for a in index.search(protein, block_size=64))))
+        assert got == expected, f"trial {trial}: seed index disagrees with brute force"
+
+        for pos, protein_kmer in enumerate(protein_kmers[:5]):
+            got = list(zip(*(a.tolist() for a in index.search_kmer(protein_kmer))))
+            assert got == [(e, m) for p, e, m in expected if p == pos], f"trial {trial}: search_kmer disagrees with brute force"
+
+        # Same protein twice, around a short one, to cover protein boundaries
+        engine = HammingEngine(epitope_kmers, max_mismatches, cache_bytes=4096)
+        protein_idx, positions, entries, mismatches = engine.search_many([protein, "ACD", protein])
+        for i in (0, 2):
+            got = list(zip(*(a[protein_idx == i].tolist() for a in (positions, entries, mismatches))))
+            assert got == expected, f"trial {trial}: Hamming engine disagrees with brute force"
+
+    print(f"✅ Seed index and Hamming engine match brute force on {n_trials} random trials")
+
+
+if __name__ == "__main__":
+    check_against_brute_force()
+
+# %%
@@ -0,0 +1,444 @@
+#%% IMPORTS
+import csv
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import Bio
+from Bio import Align
+from tqdm import tqdm
+from sequence_collapse import sequence_digest
+
+checkpoint_root = Path("../Data/alignment_checkpoints")
+
+# Banded identity mode: pairs are aligned within band_width of the seed diagonal, unless they
+# share fewer k-mers on that band than a pair at gate_identity plausibly would (min_seed_hits),
+# so only clearly unrelated pairs are skipped
+kmer_size = 3
+gate_identity = 0.3
+gate_z = 3
+band_width = 32
+identity_scores = (1, -1, -2)  # match, mismatch, gap
+pairs_per_batch = 64
+
+#%% ALIGNMENT
+def make_aligner():
+    aligner = Align.PairwiseAligner()
+    aligner.mode = 'global'
+    return aligner
+
+
+aligner = make_aligner()
+
+
+def compute_similarity(seq1, seq2):
+    """
+    Global alignment score as a percentage of the longer sequence, or None if either is missing.
+    """
+    if pd.isna(seq1) or pd.isna(seq2):
+        return None
+    score = aligner.score(seq1, seq2)
+    max_length = max(len(seq1), len(seq2))
+    return (score / max_length) * 100 if max_length else 0
+
+
+def align_pairs(pairs):
+    """
+    compute_similarity for a list of (seq1, seq2), as one task for a worker process.
+    """
+    return [compute_similarity(seq1, seq2) for seq1, seq2 in pairs]
+
+#%% BANDED IDENTITY
+def kmer_codes(seq, k=kmer_size):
+    """
+    Every k-mer of seq packed into an int (5 bits per residue).
+    """
+    codes = (np.frombuffer(seq.encode("ascii"), dtype=np.uint8).astype(np.int64) - 64) & 31
+    if len(codes) < k:
+        return np.array([], dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    return (windows << (5 * np.arange(k - 1, -1, -1))).sum(axis=1)
+
+
+def seed_diagonal(seq1, seq2, k=kmer_size, width=band_width):
+    """
+    (number of shared k-mers within width of the seed diagonal; the seed diagonal j - i, the
+    one most shared k-mers sit on), taking each k-mer's first occurrence in both sequences.
+    """
+    unique1, first1 = np.unique(kmer_codes(seq1, k), return_index=True)
+    unique2, first2 = np.unique(kmer_codes(seq2, k), return_index=True)
+    _, idx1, idx2 = np.intersect1d(unique1, unique2, assume_unique=True, return_indices=True)
+    if len(idx1) == 0:
+        return 0, len(seq2) - len(seq1)
+    offsets = first2[idx2] - first1[idx1]
+    diagonals, votes = np.unique(offsets, return_counts=True)
+    diagonal = int(diagonals[np.argmax(votes)])
+    return int(np.count_nonzero(np.abs(offsets - diagonal) <= width)), diagonal
+
+
+def min_seed_hits(n_kmers, identity=gate_identity, k=kmer_size, z=gate_z):
+    """
+    Fewest on-band shared k-mers a pair at identity plausibly shows: each of the n_kmers k-mers
+    of the shorter sequence survives with probability identity ** k, and the cutoff sits z
+    standard deviations below that mean (0 for short sequences, which are always aligned).
+    """
+    p = identity ** k
+    n_kmers = max(0, n_kmers)
+    return max(0.0, n_kmers * p - z * np.sqrt(n_kmers * p * (1 - p)))
+
+
+def band_limits(n, m, diagonals, width=band_width):
+    """
+    Lowest and highest diagonal j - i of each pair's band: width around the seed diagonal,
+    widened to take in both corners of the matrix (diagonals 0 and m - n).
+    """
+    lo = np.minimum(np.minimum(diagonals, 0), m - n) - width
+    hi = np.maximum(np.maximum(diagonals, 0), m - n) + width
+    return lo, hi
+
+
+# Cells hold score, identical columns and alignment length (each length below 2**20) packed into
+# one int64, so one max picks the best move; among equal scores it prefers more identical columns
+score_shift, matches_shift = 40, 20
+field_mask = (1 << matches_shift) - 1
+
+
+def pack_cell(score, matches, length):
+    return (np.int64(score) << score_shift) + (np.int64(matches) << matches_shift) + np.int64(length)
+
+
+def banded_alignment_stats(pairs, diagonals, width=band_width, scores=identity_scores):
+    """
+    Global alignment with linear gaps of every (seq1, seq2) in pairs, restricted to the cells
+    of its band (band_limits). All pairs advance one row of seq1 at a time together, keeping
+    only the current band row, so memory is linear.
+    Returns (score, identical columns, alignment length) arrays.
+    """
+    match, mismatch, gap = scores
+    n_pairs = len(pairs)
+    n = np.array([len(a) for a, _ in pairs], dtype=np.int64)
+    m = np.array([len(b) for _, b in pairs], dtype=np.int64)
+    lo, hi = band_limits(n, m, np.asarray(diagonals, dtype=np.int64), width)
+    n_band = int((hi - lo).max()) + 1
+    band = np.arange(n_band, dtype=np.int64)
+    negative = np.int64(-(1 << 62))
+
+    # seq2 is stored shifted by each pair's lo, so the residues facing row i are one slice
+    rows1 = np.full((n_pairs, max(1, n.max())), 0, dtype=np.uint8)
+    shifted2 = np.full((n_pairs, n.max() + n_band + 1), 1, dtype=np.uint8)
+    for p, (a, b) in enumerate(pairs):
+        rows1[p, :len(a)] = np.frombuffer(a.encode("ascii"), dtype=np.uint8)
+        codes2 = np.frombuffer(b.encode("ascii"), dtype=np.uint8)
+        # shifted2[p, x] holds seq2[x + lo]
+        first = max(0, -lo[p])
+        last = min(shifted2.shape[1], len(b) - lo[p])
+        if last > first:
+            shifted2[p, first:last] = codes2[first + lo[p]:last + lo[p]]
+
+    def in_band(i):
+        first = np.maximum(0, -i - lo)
+        last = np.minimum(hi - lo, m - i - lo)
+        return (band >= first[:, None]) & (band <= last[:, None])
+
+    # What each move adds to a cell: a diagonal step is one column, matched or not;
+    # a gap step (vertical or horizontal) is one column scoring gap
+    diag_match, diag_mismatch, gap_step = pack_cell(match, 1, 1), pack_cell(mismatch, 0, 1), pack_cell(gap, 0, 1)
+    gap_band = gap_step * band
+
+    # Row 0: only gaps in seq1
+    H = np.where(in_band(0), gap_step * (lo[:, None] + band), negative)
+    up = np.full_like(H, negative)
+
+    end = m - n - lo  # band index of cell (n, m)
+    final = np.zeros(n_pairs, dtype=np.int64)
+    done = np.flatnonzero(n == 0)
+    final[done] = H[done, end[done]]
+
+    for i in range(1, n.max() + 1):
+        same = rows1[:, i - 1][:, None] == shifted2[:, i - 1:i - 1 + n_band]
+
+        # Diagonal move: previous row, same band index; vertical move: previous row, next band index.
+        # Cells off the matrix's right edge are left unmasked here: nothing valid lies to their right.
+        D = H + np.where(same, diag_match, diag_mismatch)
+        up[:, :-1] = H[:, 1:] + gap_step
+        np.maximum(D, up, out=D)
+
+        # Horizontal runs: H[b] = max over k <= b of D[k] + gap_step * (b - k), as a running maximum
+        D -= gap_band
+        np.maximum.accumulate(D, axis=1, out=D)
+        D += gap_band
+        H = np.where(in_band(i), D, negative)
+
+        done = np.flatnonzero(n == i)
+        final[done] = H[done, end[done]]
+
+    return final >> score_shift, (final >> matches_shift) & field_mask, final & field_mask
+
+
+def banded_identity_pairs(pairs):
+    """
+    Percent identity (identical columns / alignment length) for a list of (seq1, seq2), as one
+    task for a worker process. Pairs with fewer than min_seed_hits on-band k-mers get None
+    without being aligned.
+    """
+    identities = [None] * len(pairs)
+    seeded = []
+    for p, (seq1, seq2) in enumerate(pairs):
+        hits, diagonal = seed_diagonal(seq1, seq2)
+        if hits >= min_seed_hits(min(len(seq1), len(seq2)) - kmer_size + 1):
+            seeded.append((p, diagonal))
+
+    # Pairs with similar bands and lengths share a batch, so little of each batch is padding
+    def batch_order(item):
+        p, diagonal = item
+        n, m = len(pairs[p][0]), len(pairs[p][1])
+        lo, hi = band_limits(n, m, diagonal)
+        return int(hi - lo).bit_length(), n
+    seeded.sort(key=batch_order)
+    for start in range(0, len(seeded), pairs_per_batch):
+        batch = seeded[start:start + pairs_per_batch]
+        _, matches, length = banded_alignment_stats([pairs[p] for p, _ in batch], [d for _, d in batch])
+        for (p, _), same, columns in zip(batch, matches, length):
+            identities[p] = 100 * int(same) / int(columns) if columns else 0.0
+    return identities
+
+
+def full_alignment_stats(seq1, seq2, scores=identity_scores):
+    """
+    Unbanded O(len1 * len2) version of banded_alignment_stats for one pair, choosing between
+    equal scores the same way (more identical columns, then more columns). Slow; for checking only.
+    """
+    match, mismatch, gap = scores
+    prev = [(gap * j, 0, j) for j in range(len(seq2) + 1)]
+    for i in range(1, len(seq1) + 1):
+        row = [(gap * i, 0, i)]
+        for j in range(1, len(seq2) + 1):
+            same = seq1[i - 1] == seq2[j - 1]
+            diag = (prev[j - 1][0] + (match if same else mismatch), prev[j - 1][1] + same, prev[j - 1][2] + 1)
+            up = (prev[j][0] + gap, prev[j][1], prev[j][2] + 1)
+            left = (row[j - 1][0] + gap, row[j - 1][1], row[j - 1][2] + 1)
+            row.append(max(diag, up, left))
+        prev = row
+    return prev[-1]
+
+
+def check_against_brute_force(n_pairs=200, seed=0):
+    """
+    With a band wide enough to hold the whole matrix, banded_alignment_stats must agree with
+    full_alignment_stats on score, identical columns and alignment length.
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    pairs = []
+    for _ in range(n_pairs):
+        seq1 = "".join(rng.choice(alphabet, rng.integers(0, 40)))
+        # Related pairs: a mutated copy with indels; unrelated ones: a fresh sequence
+        if len(seq1) and rng.random() < 0.6:
+            seq2 = "".join(
+                "" if rng.random() < 0.1 else (rng.choice(alphabet) if rng.random() < 0.2 else c) + ("".join(rng.choice(alphabet, 2)) if rng.random() < 0.05 else "")
+                for c in seq1
+            )
+        else:
+            seq2 = "".join(rng.choice(alphabet, rng.integers(0, 40)))
+        pairs.append((seq1, seq2))
+
+    diagonals = rng.integers(-5, 6, len(pairs))
+    score, matches, length = banded_alignment_stats(pairs, diagonals, width=100)
+    for p, (seq1, seq2) in enumerate(pairs):
+        expected = full_alignment_stats(seq1, seq2)
+        got = (score[p], matches[p], length[p])
+        assert tuple(map(int, got)) == expected, f"pair {p} ({seq1!r}, {seq2!r}): {got} != {expected}"
+    print(f"✅ banded alignment matches the full DP on {len(pairs)} pairs")
+
+
+def check_seed_gate(n_pairs=40, lengths=(50, 300, 1000, 2000), identities=(0.3, 0.4), seed=0):
+    """
+    Every mutated copy (substitutions plus 2% insertions and deletions) at gate_identity or
+    above must pass the k-mer gate, so homologs near the identity cutoff are always aligned.
+    Also reports how many unrelated pairs of each length the gate skips.
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+    def mutate(seq, identity):
+        out = []
+        for c in seq:
+            if rng.random() < 0.02:
+                continue
+            out.append(c if rng.random() < identity else rng.choice(alphabet))
+            if rng.random() < 0.02:
+                out.append(rng.choice(alphabet))
+        return "".join(out)
+
+    def passes(seq1, seq2):
+        hits, _ = seed_diagonal(seq1, seq2)
+        return hits >= min_seed_hits(min(len(seq1), len(seq2)) - kmer_size + 1)
+
+    skipped = {}
+    for length in lengths:
+        for identity in identities:
+            for _ in range(n_pairs):
+                seq1 = "".join(rng.choice(alphabet, length))
+                assert passes(seq1, mutate(seq1, identity)), f"{identity:.0%} identity pair of length {length} was gated out"
+        unrelated = ["".join(rng.choice(alphabet, length)) for _ in range(2 * n_pairs)]
+        skipped[length] = sum(not passes(a, b) for a, b in zip(unrelated[::2], unrelated[1::2]))
+    print(f"✅ k-mer gate passes every pair at {min(identities):.0%}+ identity "
+          f"(lengths {', '.join(map(str, lengths))})")
+    print("   unrelated pairs skipped: " + ", ".join(f"{skipped[n]}/{n_pairs} at {n}" for n in lengths))
+
+#%% ENGINE
+identity_methods = {
+    # Global alignment score as a percentage of the longer sequence (the original measure)
+    "global_score": align_pairs,
+    # True identity of a seeded, banded alignment; pairs failing the k-mer prefilter get None
+    "banded_identity": banded_identity_pairs,
+}
+
+
+def checkpoint_path_for(method):
+    """
+    Results depend on the method's parameters, so the checkpoint is named after a digest of
+    the aligner's scoring, the Biopython version and, for banded_identity, the k-mer gate,
+    band width and identity scores.
+    """
+    params = [method, Bio.__version__, str(aligner)]
+    if method == "banded_identity":
+        params += [kmer_size, gate_identity, gate_z, band_width, identity_scores]
+    key = hashlib.sha256(repr(params).encode()).hexdigest()[:16]
+    return checkpoint_root / f"{method}_{key}.csv"
+
+
+class AlignmentEngine:
+    """
+    Computes percent identity (see identity_methods) for arrays of sequence pairs on a process pool.
+
+    Results are memoized by (digest of seq1, digest of seq2), so a pair that repeats across
+    strains is aligned once. Each finished task is appended to a checkpoint file; a later run
+    with the same checkpoint reloads it and only aligns the pairs it does not hold yet, so a
+    crash loses at most the tasks that were in flight.
+    """
+    def __init__(self, method="global_score", checkpoint_path=None, n_workers=None, pairs_per_task=64):
+        self.method = method
+        self.align = identity_methods[method]
+        self.checkpoint_path = Path(checkpoint_path) if checkpoint_path is not None else checkpoint_path_for(method)
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.pairs_per_task = pairs_per_task
+
+        self.memo = self._load_checkpoint()
+        self.n_checkpointed = len(self.memo)
+        self.pending = {}
+        self.queued = set()
+        self.n_aligned = 0
+        self.pool = None
+        self.checkpoint = None
+
+    def _load_checkpoint(self):
+        memo = {}
+        if not self.checkpoint_path.exists():
+            return memo
+        with open(self.checkpoint_path, newline="") as handle:
+            lines = handle.read().split("\n")
+        # A crash can leave the last line half written (no newline yet); its pairs are aligned again
+        for row in csv.reader(lines[:-1]):
+            try:
+                key = (bytes.fromhex(row[0]), bytes.fromhex(row[1]))
+                memo[key] = float(row[2]) if row[2] else None
+            except (IndexError, ValueError):
+                continue
+        return memo
+
+    def _write_checkpoint(self, keys, identities):
+        if self.checkpoint is None:
+            self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+            needs_newline = self.checkpoint_path.exists() and self.checkpoint_path.stat().st_size > 0
+            if needs_newline:
+                with open(self.checkpoint_path, "rb") as handle:
+                    handle.seek(-1, os.SEEK_END)
+                    needs_newline = handle.read(1) != b"\n"
+            self.checkpoint = open(self.checkpoint_path, "a", newline="")
+            if needs_newline:
+                self.checkpoint.write("\n")
+            self.checkpoint_writer = csv.writer(self.checkpoint, lineterminator="\n")
+        self.checkpoint_writer.writerows(
+            (a.hex(), b.hex(), "" if identity is None else repr(float(identity)))
+            for (a, b), identity in zip(keys, identities)
+        )
+        self.checkpoint.flush()
+
+    def submit(self, seqs1, seqs2):
+        """
+        Queues the pairs (seqs1[i], seqs2[i]) that are neither memoized nor already queued.
+        Returns the key of every pair, None where a sequence is missing, for results().
+        """
+        keys = []
+        new_pairs = {}
+        for seq1, seq2 in zip(seqs1, seqs2):
+            if not isinstance(seq1, str) or not isinstance(seq2, str):
+                keys.append(None)
+                continue
+            key = (sequence_digest(seq1), sequence_digest(seq2))
+            keys.append(key)
+            if key not in self.memo and key not in self.queued:
+                self.queued.add(key)
+                new_pairs[key] = (seq1, seq2)
+
+        if new_pairs:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.n_workers)
+            items = list(new_pairs.items())
+            for i in range(0, len(items), self.pairs_per_task):
+                task = items[i:i + self.pairs_per_task]
+                future = self.pool.submit(self.align, [pair for _, pair in task])
+                self.pending[future] = [key for key, _ in task]
+
+        # Checkpoint whatever finished meanwhile, so it is saved before the final wait
+        for future in [f for f in self.pending if f.done()]:
+            self._collect(future)
+        return keys
+
+    def _collect(self, future):
+        keys = self.pending.pop(future)
+        identities = future.result()
+        self.memo.update(zip(keys, identities))
+        self._write_checkpoint(keys, identities)
+        self.queued.difference_update(keys)
+        self.n_aligned += len(identities)
+
+    def wait(self):
+        """
+        Collects every queued task into the memo, checkpointing each one as it finishes.
+        """
+        for future in tqdm(as_completed(list(self.pending)), total=len(self.pending), desc="Computing Percent Identity"):
+            self._collect(future)
+
+    def results(self, keys):
+        """
+        Percent identity for each key returned by submit(), waiting for queued tasks first.
+        """
+        self.wait()
+        return [self.memo.get(key) if key is not None else None for key in keys]
+
+    def summary(self):
+        return f"{self.n_aligned} pairs aligned, {self.n_checkpointed} reused from {self.checkpoint_path}"
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+            self.checkpoint = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    check_against_brute_force()
+    check_seed_gate()
+
+# %%
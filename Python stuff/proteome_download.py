@@ -0,0 +1,470 @@
+#%% IMPORTS
+import gzip
+import io
+import os
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+import requests
+import urllib3
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from tqdm import tqdm
+from fasta_io import bgzip_stream, find_fasta, open_fasta
+from uniprot_client import UniProtClient, start_stand_in_server
+
+proteome_fasta_folder = Path("../Data/proteome_fastas")
+
+# Bytes read from a response (and written to disk) at a time
+chunk_size = 1 << 16
+
+# Errors that can break off a download partway through its body
+broken_download_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                          urllib3.exceptions.HTTPError)
+corrupt_gzip_errors = (OSError, EOFError, zlib.error)
+
+
+def fasta_query(proteome_id):
+    """
+    Path and parameters of the gzipped FASTA of every protein in one proteome.
+    """
+    return "/uniprotkb/stream", {"query": f"proteome:{proteome_id}", "format": "fasta", "compressed": "true"}
+
+
+def content_range_start(response):
+    """
+    First byte offset of a 206 response's Content-Range, or None.
+    """
+    value = response.headers.get("Content-Range", "")
+    if not value.startswith("bytes ") or "-" not in value:
+        return None
+    try:
+        return int(value[len("bytes "):].split("-")[0])
+    except ValueError:
+        return None
+
+
+def iter_body(response):
+    """
+    The raw (still gzipped) body of a streamed response, in chunks of up to chunk_size bytes as
+    they arrive, so the bytes received before a connection breaks are kept.
+    """
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        # urllib3 before 2.2 only hands out whole chunks
+        yield from response.iter_content(chunk_size)
+        return
+    while True:
+        chunk = read1(chunk_size, decode_content=False)
+        if not chunk:
+            return
+        yield chunk
+
+
+def gunzip_file(gz_path, output_path):
+    """
+    Decompresses gz_path to output_path through a temporary file. The gzip trailer's CRC32
+    and length are checked on the way, so a truncated or corrupt download raises instead of
+    leaving a FASTA behind.
+    """
+    tmp_path = Path(str(output_path) + ".tmp")
+    try:
+        with gzip.open(gz_path, "rb") as source, open(tmp_path, "wb") as target:
+            shutil.copyfileobj(source, target, chunk_size)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, output_path)
+
+#%% STREAMING
+# Markers a streaming worker ends its queue with
+end_of_stream = object()
+not_found = object()
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class DecompressingSink:
+    """
+    Stands in for a file in _fetch: inflates the gzip bytes as they arrive and puts the FASTA
+    text on a bounded queue for a reader in another thread. When the server sends the whole
+    file again instead of the Range asked for, the bytes already inflated are skipped; the
+    gzip CRC32, checked at the end, catches a file that changed in between.
+    """
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.position = 0
+        self.skip = 0
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        # _fetch only ever rewinds to the start
+        self.skip, self.position = self.position, position
+
+    def truncate(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def write(self, chunk):
+        n_skipped = min(self.skip, len(chunk))
+        self.skip -= n_skipped
+        self.position += len(chunk)
+        data = self.decompressor.decompress(chunk[n_skipped:])
+        # Concatenated gzip members go on with a fresh decompressor
+        while self.decompressor.eof and self.decompressor.unused_data:
+            rest = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += self.decompressor.decompress(rest)
+        if data:
+            self.put(data)
+
+    def finish(self):
+        if not self.decompressor.eof:
+            raise EOFError("Download ended before the end of its gzip stream")
+
+    def put(self, item):
+        # Waits while the reader is behind, giving up once the reader has gone away
+        while True:
+            if self.cancelled.is_set():
+                raise DownloadCancelled()
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+class QueueReader(io.RawIOBase):
+    """
+    Read-only stream of the text chunks a DecompressingSink puts on a queue, starting with first.
+    """
+    def __init__(self, chunks, first):
+        self.chunks = chunks
+        self.pending = memoryview(b"")
+        self.done = False
+        self._take(first)
+
+    def _take(self, item):
+        if item is end_of_stream:
+            self.done = True
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            self.pending = memoryview(item)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            if self.done:
+                return 0
+            self._take(self.chunks.get())
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+#%% DOWNLOADER
+class ProteomeDownloader:
+    """
+    Downloads proteome FASTAs from UniProt, max_concurrency at a time, over the client's pooled
+    keep-alive session (and under its rate limit and 429/5xx retries). Bodies are fetched
+    gzipped. A download that breaks off is resumed from the bytes already received with a
+    Range request (guarded by If-Range, so a changed file is fetched from the start), and the
+    gzip CRC32 is checked before anything is kept; a resumed file that fails it is fetched again.
+
+    download() keeps <proteome ID>.fasta files in a folder (<proteome ID>.fasta.bgz with
+    bgzip=True, which every FASTA reader of the pipeline opens too), with partial downloads
+    kept as <proteome ID>.fasta.gz.part so a later run resumes them. iter_records() feeds the
+    decompressed records straight to a parser without writing anything to disk.
+    """
+    def __init__(self, client=None, max_concurrency=4, max_resumes=5, bgzip=False):
+        self.client = client or UniProtClient(max_concurrency=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_resumes = max_resumes
+        self.bgzip = bgzip
+
+        self.stats_lock = threading.Lock()
+        self.n_downloaded = 0
+        self.n_resumed = 0
+        self.n_restarted = 0
+        self.n_bytes = 0
+
+    def _count(self, **counts):
+        with self.stats_lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def _fetch(self, proteome_id, sink, validator=None, on_validator=None):
+        """
+        Appends proteome_id's gzipped FASTA to sink (a binary file object positioned at the end
+        of what it already holds), resuming from sink.tell(). validator is the ETag (or
+        Last-Modified) those bytes came with; on_validator(value) is called with each new one.
+        Returns False when UniProt does not know the proteome.
+        """
+        path, params = fasta_query(proteome_id)
+        for attempt in range(self.max_resumes + 1):
+            offset = sink.tell()
+            headers = {"Accept-Encoding": "identity"}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                if validator:
+                    headers["If-Range"] = validator
+
+            response = self.client.get(path, params, headers=headers, stream=True)
+            with response:
+                if response.status_code == 404:
+                    return False
+                if response.status_code == 416:
+                    # Nothing after offset: the bytes held are the whole file (the CRC check decides)
+                    return True
+                response.raise_for_status()
+
+                if response.status_code == 206 and content_range_start(response) == offset:
+                    self._count(n_resumed=1)
+                elif offset:
+                    # The server sent the whole file (no Range support, or it changed): start over
+                    sink.seek(0)
+                    sink.truncate()
+                    self._count(n_restarted=1)
+
+                new_validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                if new_validator and new_validator != validator:
+                    validator = new_validator
+                    if on_validator is not None:
+                        on_validator(validator)
+
+                try:
+                    for chunk in iter_body(response):
+                        sink.write(chunk)
+                        self._count(n_bytes=len(chunk))
+                    return True
+                except broken_download_errors as e:
+                    error = e
+                    sink.flush()
+
+            if attempt < self.max_resumes:
+                time.sleep(self.client.backoff * 2 ** attempt * (0.5 + random.random()))
+        raise error
+
+    #%% TO DISK
+    def download_one(self, proteome_id, folder):
+        """
+        folder/<proteome ID>.fasta (or .fasta.bgz), downloaded (or resumed) and checked. Returns False when
+        UniProt does not know the proteome.
+        """
+        fasta_path = Path(folder) / f"{proteome_id}.fasta{'.bgz' if self.bgzip else ''}"
+        part_path = Path(folder) / f"{proteome_id}.fasta.gz.part"
+        validator_path = Path(str(part_path) + ".etag")
+
+        # A corrupt resumed file is fetched once more from the start
+        for fresh in (False, True):
+            if fresh:
+                part_path.unlink(missing_ok=True)
+                validator_path.unlink(missing_ok=True)
+            validator = validator_path.read_text() if validator_path.exists() else None
+            with open(part_path, "ab") as sink:
+                found = self._fetch(proteome_id, sink, validator, on_validator=validator_path.write_text)
+            if not found:
+                part_path.unlink(missing_ok=True)
+                validator_path.unlink(missing_ok=True)
+                return False
+            try:
+                if self.bgzip:
+                    # Recompressed into blocks, so it can be inflated in parallel and indexed
+                    with open_fasta(part_path, "rb") as source:
+                        bgzip_stream(source, fasta_path, threads=1)
+                else:
+                    gunzip_file(part_path, fasta_path)
+                break
+            except corrupt_gzip_errors:
+                if fresh:
+                    raise
+                print(f"⚠️ {proteome_id}: resumed download failed its gzip check, downloading it again")
+                self._count(n_restarted=1)
+
+        part_path.unlink()
+        validator_path.unlink(missing_ok=True)
+        self._count(n_downloaded=1)
+        return True
+
+    def download(self, proteome_ids, folder=proteome_fasta_folder):
+        """
+        Downloads the proteomes whose FASTA is not in folder yet. Returns [proteome IDs UniProt
+        did not know, or that failed]; a failed download leaves its .part file for the next run.
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        todo = [pid for pid in dict.fromkeys(proteome_ids) if find_fasta(folder, pid) is None]
+        print(f"{len(todo)} of {len(set(proteome_ids))} proteome FASTAs to download")
+
+        def attempt(proteome_id):
+            try:
+                return self.download_one(proteome_id, folder)
+            except (requests.RequestException, *corrupt_gzip_errors) as e:
+                print(f"Error downloading {proteome_id}: {e}")
+                return False
+
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            done = list(tqdm(pool.map(attempt, todo), total=len(todo), desc="Downloading proteomes"))
+        missing = [pid for pid, ok in zip(todo, done) if not ok]
+        for proteome_id in missing:
+            print(f"FASTA not downloaded for {proteome_id}")
+        return missing
+
+    #%% STRAIGHT TO THE PARSER
+    def _stream(self, proteome_id, chunks, cancelled):
+        """
+        Worker: downloads one proteome through a DecompressingSink onto chunks, ending with
+        end_of_stream, not_found, or the exception that stopped it.
+        """
+        if cancelled.is_set():
+            return
+        sink = DecompressingSink(chunks, cancelled)
+        try:
+            if self._fetch(proteome_id, sink):
+                sink.finish()
+                sink.put(end_of_stream)
+            else:
+                sink.put(not_found)
+        except DownloadCancelled:
+            pass
+        except Exception as e:
+            try:
+                sink.put(e)
+            except DownloadCancelled:
+                pass
+
+    def iter_records(self, proteome_ids, queue_size=64):
+        """
+        Yields (proteome ID, iterator of (title, sequence)) for each proteome in the order given.
+        Records are parsed as the gzip bytes arrive, so nothing is written to disk and no
+        proteome is held whole in memory: up to max_concurrency proteomes download at once, each
+        at most queue_size inflated chunks ahead of the parser. Each iterator has to be used up
+        before the next proteome is taken.
+
+        Proteomes UniProt does not know, or whose download fails before any bytes arrive, are
+        reported and skipped. A download that breaks off is resumed as usual; one that still
+        fails (or fails its gzip check) partway through raises from the record iterator.
+        """
+        proteome_ids = list(dict.fromkeys(proteome_ids))
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            pending = deque()
+            ids = iter(proteome_ids)
+
+            def start(proteome_id):
+                chunks = queue.Queue(queue_size)
+                pool.submit(self._stream, proteome_id, chunks, cancelled)
+                pending.append((proteome_id, chunks))
+
+            try:
+                for proteome_id in islice(ids, 2 * self.max_concurrency):
+                    start(proteome_id)
+
+                while pending:
+                    proteome_id, chunks = pending.popleft()
+                    next_id = next(ids, None)
+                    if next_id is not None:
+                        start(next_id)
+
+                    first = chunks.get()
+                    if isinstance(first, Exception):
+                        print(f"Error downloading {proteome_id}: {first}")
+                    if first is not_found or isinstance(first, Exception):
+                        print(f"FASTA not downloaded for {proteome_id}")
+                        continue
+                    self._count(n_downloaded=1)
+                    yield proteome_id, SimpleFastaParser(io.TextIOWrapper(io.BufferedReader(QueueReader(chunks, first))))
+            finally:
+                # Workers still downloading stop at their next chunk
+                cancelled.set()
+
+    def summary(self):
+        return (f"{self.n_downloaded} proteomes, {self.n_bytes / 1e6:.1f} MB gzipped, "
+                f"{self.n_resumed} resumed, {self.n_restarted} restarted, "
+                f"{self.client.n_requests} requests ({self.client.n_retries} retried)")
+
+#%% CHECK
+def check_against_stand_in(n_proteomes=12, drop_every=3):
+    """
+    Downloads random proteomes from the stand-in server, which drops every drop_every-th
+    download halfway and answers some requests with 429s. One proteome starts from a
+    half-finished .part file and one from a corrupt one. Checks that every file comes out
+    byte for byte, and that iter_records() parses the same records.
+    """
+    rng = random.Random(0)
+    alphabet = "ACDEFGHIKLMNPQRSTVWY"
+    fastas = {}
+    for i in range(n_proteomes):
+        proteome_id = f"UP{i:09d}"
+        lines = []
+        for j in range(rng.randint(50, 300)):
+            seq = "".join(rng.choice(alphabet) for _ in range(rng.randint(50, 600)))
+            lines.append(f">tr|Q{i:02d}{j:04d}|Q{i:02d}{j:04d}_BACT Protein {j} OS=Genus species{i} OX={i} PE=4 SV=1")
+            lines += [seq[k:k + 60] for k in range(0, len(seq), 60)]
+        fastas[proteome_id] = "\n".join(lines) + "\n"
+
+    server, url = start_stand_in_server({}, fail_every=5, latency=0.01, fastas=fastas, drop_every=drop_every)
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            ids = list(fastas)
+            # A half-finished download from an earlier run, and one whose bytes are garbage
+            data = gzip.compress(fastas[ids[0]].encode(), mtime=0)
+            Path(folder, f"{ids[0]}.fasta.gz.part").write_bytes(data[:len(data) // 2])
+            Path(folder, f"{ids[1]}.fasta.gz.part").write_bytes(b"\x1f\x8b" + bytes(500))
+
+            client = UniProtClient(url, max_concurrency=4, rate=200, backoff=0.01)
+            downloader = ProteomeDownloader(client, max_concurrency=4)
+            start = time.perf_counter()
+            missing = downloader.download(ids + ["UP999999999"], folder)
+            elapsed = time.perf_counter() - start
+
+            assert missing == ["UP999999999"], f"unexpected failures: {missing}"
+            for proteome_id, text in fastas.items():
+                assert Path(folder, f"{proteome_id}.fasta").read_text() == text, f"{proteome_id} differs"
+            assert not list(Path(folder).glob("*.part*")), "partial downloads left behind"
+            assert downloader.n_resumed > 0, "no download was resumed"
+            print(f"✅ {len(fastas)} proteomes in {elapsed:.2f}s: {downloader.summary()}, "
+                  f"{server.state['connections']} connections")
+
+        with tempfile.TemporaryDirectory() as folder:
+            kept = ProteomeDownloader(UniProtClient(url, max_concurrency=4, rate=200, backoff=0.01), max_concurrency=4, bgzip=True)
+            kept.download(ids, folder)
+            for proteome_id, text in fastas.items():
+                with open_fasta(Path(folder, f"{proteome_id}.fasta.bgz")) as handle:
+                    assert handle.read() == text, f"{proteome_id} differs after bgzip"
+            plain_size = sum(len(text) for text in fastas.values())
+            kept_size = sum(p.stat().st_size for p in Path(folder).glob("*.bgz"))
+            print(f"✅ Kept as bgzip: {kept.summary()}, {plain_size / kept_size:.1f}x smaller on disk")
+
+        streamed = ProteomeDownloader(UniProtClient(url, max_concurrency=4, rate=200, backoff=0.01), max_concurrency=4)
+        got = {proteome_id: list(records) for proteome_id, records in streamed.iter_records(ids + ["UP999999999"])}
+        assert list(got) == ids, "records not yielded in proteome order"
+        for proteome_id, text in fastas.items():
+            assert got[proteome_id] == list(SimpleFastaParser(io.StringIO(text))), f"{proteome_id} records differ"
+        print(f"✅ Streamed straight to the parser: {streamed.summary()}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    check_against_stand_in()
+
+# %%
@@ -0,0 +1,451 @@
+#%% IMPORTS
+import argparse
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from mismatch_search import split_segments
+from sequence_store import SequenceStore, build_store_from_table
+
+# Bump when the on-disk layout changes, so old index directories are rebuilt
+index_version = 3
+
+# Text codes: 0 ends the text, 1 separates proteins, A-Z and '*' get 2..28,
+# anything else shares 29 (hits are re-checked on the raw bytes, so it never causes false hits)
+terminator_code = 0
+separator_code = 1
+other_code = 29
+alphabet_size = 30
+residue_codes = np.full(256, other_code, dtype=np.uint8)
+residue_codes[np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ*", dtype=np.uint8)] = np.arange(2, 29, dtype=np.uint8)
+first_residue_code = 2
+
+# Occurrence counts are kept per step BWT rows, relative to the start of their superblock
+# (so they fit in uint16), plus absolute counts at every superblock
+superblock_size = 1 << 16
+
+index_files = ["bwt", "occ", "occ_super", "counts", "marks", "mark_counts", "sa_samples"]
+
+# Set bits per byte value, for ranking the packed sample marks
+popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int64)
+
+#%% BUILD
+def concatenate_proteins(store):
+    """
+    The residues of a SequenceStore joined into one text, each protein followed by a separator,
+    plus the start offset of each protein in that text.
+    """
+    offsets = np.asarray(store.offsets)
+    text = np.insert(np.asarray(store.residues), offsets[1:], np.uint8(1))
+    return text, offsets[:-1] + np.arange(len(offsets) - 1)
+
+
+def build_suffix_array(codes):
+    """
+    Suffix array of an integer code array ending in a unique smallest code, by prefix doubling:
+    every round sorts suffixes by the pair (rank of the first k codes, rank of the next k codes).
+    Ranks are kept as int32 while the text is shorter than 2**31, and the pair is sorted as two
+    keys, never combined into a single number that could overflow.
+    """
+    n = len(codes)
+    rank_dtype = np.int32 if n < 2 ** 31 else np.int64
+    rank = codes.astype(rank_dtype)
+    order = np.argsort(rank, kind="stable")
+    k = 1
+    while True:
+        next_rank = np.zeros(n, dtype=rank_dtype)
+        next_rank[:n - k] = rank[k:] + 1
+        order = np.lexsort((next_rank, rank))
+
+        sorted_rank, sorted_next = rank[order], next_rank[order]
+        del next_rank
+        boundary = (sorted_rank[1:] != sorted_rank[:-1]) | (sorted_next[1:] != sorted_next[:-1])
+        del sorted_rank, sorted_next
+        rank[order[0]] = 0
+        rank[order[1:]] = np.cumsum(boundary, dtype=rank_dtype)
+        n_ranks = int(rank[order[-1]]) + 1
+        del boundary
+        if n_ranks == n or k >= n:
+            return order
+        k *= 2
+
+
+def build_fm_index(store, output_dir, step=128, sa_sample_rate=32):
+    """
+    Writes the BWT of a SequenceStore's proteins, occurrence checkpoints every step BWT rows,
+    per-code counts and the suffix array sampled at every sa_sample_rate-th text position
+    (with a bitvector marking the sampled rows) as .npy files in output_dir.
+    """
+    if superblock_size % step or step % 8:
+        raise ValueError(f"step must be a multiple of 8 dividing {superblock_size}, not {step}")
+    text, _ = concatenate_proteins(store)
+    codes = residue_codes[text]
+    codes[text == 1] = separator_code
+    codes = np.append(codes, np.uint8(terminator_code))
+    del text
+
+    sa = build_suffix_array(codes)
+    bwt = codes[sa - 1]  # sa == 0 wraps around to the terminator
+    padding = -len(bwt) % step
+
+    # occ[b, c]: occurrences of code c in bwt[:b * step], less those before b's superblock
+    blocks = np.bincount((np.arange(len(bwt)) // step) * alphabet_size + bwt,
+                         minlength=(len(bwt) // step + 1) * alphabet_size).reshape(-1, alphabet_size)
+    absolute = np.zeros((len(blocks) + 1, alphabet_size), dtype=np.int64)
+    np.cumsum(blocks, axis=0, out=absolute[1:])
+    blocks_per_superblock = superblock_size // step
+    occ_super = absolute[::blocks_per_superblock]
+    occ = (absolute - np.repeat(occ_super, blocks_per_superblock, axis=0)[:len(absolute)]).astype(np.uint16)
+
+    # counts[c]: number of codes smaller than c in the text
+    counts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=alphabet_size))))
+
+    # Rows whose suffix starts at a multiple of sa_sample_rate keep their text offset
+    index_dtype = np.int32 if len(codes) < 2 ** 31 else np.int64
+    sampled = sa % sa_sample_rate == 0
+    sa_samples = sa[sampled].astype(index_dtype)
+    mark_counts = np.concatenate(([0], np.cumsum(sampled)))[::step].astype(index_dtype)
+    marks = np.packbits(np.append(sampled, np.zeros(padding, dtype=bool)))
+    del sa, sampled
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # bwt and marks are padded to whole blocks, so they can be read block by block
+    arrays = {
+        "bwt": np.append(bwt, np.zeros(padding, dtype=np.uint8)), "occ": occ, "occ_super": occ_super, "counts": counts,
+        "marks": marks, "mark_counts": mark_counts, "sa_samples": sa_samples,
+    }
+    for name, array in arrays.items():
+        np.save(output_dir / f"{name}.npy", array)
+    with open(output_dir / "manifest.json", "w") as handle:
+        json.dump({"version": index_version, "step": step, "sa_sample_rate": sa_sample_rate,
+                   "n_proteins": len(store), "length": len(codes)}, handle)
+
+#%% SEARCH
+class ProteomeIndex:
+    """
+    FM-index over the concatenated proteins of a SequenceStore, memory-mapped from disk.
+
+    Patterns are matched by backward search: each residue narrows the range of suffix-array
+    rows, so exact lookups cost time in proportion to the pattern length. Only every
+    sa_sample_rate-th text offset of the suffix array is stored; the offset of any other row
+    is recovered by LF-walking back to a sampled row, so reporting costs up to sa_sample_rate
+    steps per hit. Hits are verified on the store's residues, so the index keeps no copy of the text.
+
+    For ≤k mismatches the pattern is cut into k + 1 pieces, one of which must occur exactly;
+    when every piece is at least min_seed_length long, the pieces are looked up exactly and
+    their hits verified on the residues. Shorter patterns backtrack over substitutions instead,
+    abandoning a branch as soon as its range is empty or it runs out of mismatches.
+    """
+    min_seed_length = 3
+
+    # Rows LF-walked together, bounding the (rows, step) work arrays; fewer rows than
+    # scalar_locate are walked one at a time, which avoids numpy call overhead per step
+    locate_chunk = 1 << 14
+    scalar_locate = 16
+
+    def __init__(self, index_dir, store):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / "manifest.json") as handle:
+            manifest = json.load(handle)
+        self.step = manifest["step"]
+        self.sa_sample_rate = manifest["sa_sample_rate"]
+        # Plain ndarray views of the mapped files: indexing a np.memmap costs a subclass
+        # round trip per lookup, which dominates the many tiny lookups of a search
+        for name in index_files:
+            setattr(self, name, np.asarray(np.load(self.index_dir / f"{name}.npy", mmap_mode="r")))
+        self.counts = np.array(self.counts)
+        self.occ_super = np.array(self.occ_super)
+        self.bwt_blocks = self.bwt.reshape(-1, self.step)
+        self.marks_blocks = self.marks.reshape(-1, self.step // 8)
+        self.bwt = self.bwt[:manifest["length"]]
+
+        self.store = store
+        self.residues = np.asarray(store.residues)
+        self.offsets = np.asarray(store.offsets)
+        self.lengths = np.diff(self.offsets)
+        self.protein_starts = self.offsets[:-1] + np.arange(len(self.lengths))
+        self.text_length = len(self.bwt) - 1
+
+    @classmethod
+    def open(cls, table_path, step=128, sa_sample_rate=32):
+        """
+        Loads the index kept in the SequenceStore of table_path, building it first when missing.
+        A changed table repacks the store, which drops its old index with it.
+        """
+        store = SequenceStore.for_table(table_path)
+        index_dir = store.store_dir / f"fm_index_v{index_version}_s{step}_r{sa_sample_rate}"
+        if not (index_dir / "manifest.json").exists():
+            start = time.perf_counter()
+            for stale in store.store_dir.glob("fm_index_*"):
+                shutil.rmtree(stale)
+            tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+            build_fm_index(store, tmp_dir, step, sa_sample_rate)
+            os.replace(tmp_dir, index_dir)
+            print(f"Built FM-index over {len(store)} proteins in {time.perf_counter() - start:.2f}s → {index_dir}")
+        return cls(index_dir, store)
+
+    def disk_size(self):
+        return sum((self.index_dir / f"{name}.npy").stat().st_size for name in index_files)
+
+    def _occ(self, row):
+        """
+        Occurrences of every code in bwt[:row].
+        """
+        block = row // self.step
+        partial = np.bincount(self.bwt[block * self.step:row], minlength=alphabet_size)
+        return self.occ_super[block * self.step // superblock_size] + self.occ[block] + partial
+
+    def _occ_of(self, rows, codes):
+        """
+        Occurrences of codes[i] in bwt[:rows[i]], for arrays of rows and codes.
+        """
+        blocks = rows // self.step
+        before = np.arange(self.step) < (rows - blocks * self.step)[:, None]
+        return (self.occ_super[blocks * self.step // superblock_size, codes] + self.occ[blocks, codes]
+                + np.count_nonzero((self.bwt_blocks[blocks] == codes[:, None]) & before, axis=1))
+
+    def _sample_rank(self, rows):
+        """
+        Number of sampled rows before each of rows, i.e. its index into sa_samples if it is sampled.
+        """
+        blocks = rows // self.step
+        full = np.arange(self.step // 8) < ((rows - blocks * self.step) >> 3)[:, None]
+        partial = self.marks[rows >> 3] & ((0xFF00 >> (rows & 7)) & 0xFF)
+        return self.mark_counts[blocks] + (popcount[self.marks_blocks[blocks]] * full).sum(axis=1) + popcount[partial]
+
+    def _locate_row(self, row):
+        """
+        _locate for a single row, in scalar steps.
+        """
+        steps = 0
+        while not (self.marks[row >> 3] >> (7 - (row & 7))) & 1:
+            c = self.bwt[row]
+            block = row // self.step
+            row = int(self.counts[c] + self.occ_super[block * self.step // superblock_size, c] + self.occ[block, c]
+                      + np.count_nonzero(self.bwt[block * self.step:row] == c))
+            steps += 1
+        block = row // self.step
+        rank = (self.mark_counts[block] + popcount[self.marks[block * self.step // 8:row >> 3]].sum()
+                + popcount[self.marks[row >> 3] & ((0xFF00 >> (row & 7)) & 0xFF)])
+        return int(self.sa_samples[rank]) + steps
+
+    def _locate(self, rows):
+        """
+        Text offsets of suffix-array rows: each row is LF-walked back one text position at a
+        time until it reaches a sampled row, whose stored offset plus the steps taken is its own.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) < self.scalar_locate:
+            return np.array([self._locate_row(int(row)) for row in rows], dtype=np.int64)
+        positions = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), self.locate_chunk):
+            current = rows[start:start + self.locate_chunk].copy()
+            steps = np.zeros(len(current), dtype=np.int64)
+            todo = np.arange(len(current))
+            while len(todo):
+                r = current[todo]
+                walking = ((self.marks[r >> 3] >> (7 - (r & 7))) & 1) == 0
+                todo, r = todo[walking], r[walking]
+                codes = self.bwt[r].astype(np.int64)
+                current[todo] = self.counts[codes] + self._occ_of(r, codes)
+                steps[todo] += 1
+            positions[start:start + len(current)] = self.sa_samples[self._sample_rank(current)] + steps
+        return positions
+
+    def _ranges(self, lo, hi):
+        """
+        (lo, hi) suffix-array ranges of every code prepended to the range lo..hi.
+        """
+        return self.counts[:alphabet_size] + self._occ(lo), self.counts[:alphabet_size] + self._occ(hi)
+
+    def count(self, pattern):
+        """
+        Number of exact occurrences of pattern.
+        """
+        return len(self.find(pattern)[0])
+
+    def _exact_range(self, codes, lo=0, hi=None):
+        """
+        Suffix-array rows of codes, narrowed from the range lo..hi by backward search.
+        """
+        hi = len(self.bwt) if hi is None else hi
+        for c in codes[::-1]:
+            lo, hi = self.counts[c] + self._occ(lo)[c], self.counts[c] + self._occ(hi)[c]
+            if hi <= lo:
+                break
+        return lo, hi
+
+    def _backtrack_starts(self, codes, max_mismatches):
+        """
+        Text offsets of every ≤max_mismatches occurrence, found depth-first over
+        (next pattern index from the end, row range, mismatches so far).
+        """
+        ranges = []
+        stack = [(len(codes) - 1, 0, len(self.bwt), 0)]
+        while stack:
+            j, lo, hi, n_mismatch = stack.pop()
+            if j < 0:
+                ranges.append((lo, hi))
+                continue
+            if n_mismatch == max_mismatches:
+                lo, hi = self._exact_range(codes[:j + 1], lo, hi)
+                if hi > lo:
+                    ranges.append((lo, hi))
+                continue
+            new_lo, new_hi = self._ranges(lo, hi)
+            for c in np.flatnonzero(new_hi[first_residue_code:] > new_lo[first_residue_code:]) + first_residue_code:
+                stack.append((j - 1, new_lo[c], new_hi[c], n_mismatch + (c != codes[j])))
+
+        if not ranges:
+            return np.array([], dtype=np.int64)
+        return self._locate(np.concatenate([np.arange(lo, hi) for lo, hi in ranges]))
+
+    def _seed_starts(self, codes, max_mismatches):
+        """
+        Candidate text offsets from exact hits of the k + 1 pigeonhole pieces of the pattern.
+        """
+        rows, piece_starts = [], []
+        for a, b in split_segments(len(codes), max_mismatches):
+            lo, hi = self._exact_range(codes[a:b])
+            if hi > lo:
+                rows.append(np.arange(lo, hi))
+                piece_starts.append(np.full(hi - lo, a))
+        if not rows:
+            return np.array([], dtype=np.int64)
+        # One LF-walk over the rows of every piece
+        starts = np.unique(self._locate(np.concatenate(rows)) - np.concatenate(piece_starts))
+        return starts[(starts >= 0) & (starts + len(codes) <= self.text_length)]
+
+    def find(self, pattern, max_mismatches=0):
+        """
+        (protein index, position, mismatches) arrays for every occurrence of pattern with
+        at most max_mismatches substitutions, ordered by protein, then position.
+        """
+        raw = np.frombuffer(pattern.encode("ascii"), dtype=np.uint8)
+        codes = residue_codes[raw]
+        if len(codes) == 0:
+            raise ValueError("Cannot search for an empty pattern")
+
+        pieces = split_segments(len(codes), max_mismatches)
+        if 0 < max_mismatches < len(pieces) and min(b - a for a, b in pieces) >= self.min_seed_length:
+            starts = self._seed_starts(codes, max_mismatches)
+        else:
+            starts = self._backtrack_starts(codes, max_mismatches)
+        starts = np.sort(starts)
+
+        # Candidates running into a separator are dropped; mismatches are counted on the
+        # store's raw residues, so residues sharing the catch-all code are told apart
+        protein_idx = np.searchsorted(self.protein_starts, starts, side="right") - 1
+        positions = starts - self.protein_starts[protein_idx]
+        fits = positions + len(raw) <= self.lengths[protein_idx]
+        protein_idx, positions = protein_idx[fits], positions[fits]
+        windows = self.residues[(self.offsets[protein_idx] + positions)[:, None] + np.arange(len(raw))]
+        n_mismatch = np.count_nonzero(windows != raw, axis=1)
+        keep = n_mismatch <= max_mismatches
+        return protein_idx[keep], positions[keep], n_mismatch[keep]
+
+    def find_many(self, patterns, max_mismatches=0):
+        """
+        Columnar (pattern index, protein index, position, mismatches) arrays over a list of patterns.
+        """
+        found = []
+        for i, pattern in enumerate(patterns):
+            protein_idx, positions, mismatches = self.find(pattern, max_mismatches)
+            found.append((np.full(len(positions), i), protein_idx, positions, mismatches))
+        if not found:
+            return tuple(np.array([], dtype=np.int64) for _ in range(4))
+        return tuple(np.concatenate(a).astype(np.int64) for a in zip(*found))
+
+#%% BRUTE-FORCE REFERENCE
+def check_against_brute_force(n_trials=20, alphabet="ACDEFGHIKLMNPQRSTVWYXbz-", seed=0):
+    """
+    Builds small indexes over random proteins and compares find() with a plain scan.
+    """
+    import tempfile
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(alphabet))
+
+    for trial in range(n_trials):
+        proteins = ["".join(rng.choice(letters, int(rng.integers(0, 80)))) for _ in range(int(rng.integers(1, 30)))]
+        with tempfile.TemporaryDirectory() as tmp:
+            table_path = Path(tmp) / "proteins.csv"
+            pd.DataFrame({"Protein_ID": range(len(proteins)), "Sequence": proteins}).to_csv(table_path, index=False)
+            build_store_from_table(table_path, Path(tmp) / "store")
+            store = SequenceStore(Path(tmp) / "store")
+            build_fm_index(store, Path(tmp) / "index", step=int(rng.choice([8, 16, 64])),
+                           sa_sample_rate=int(rng.choice([1, 2, 5, 32])))
+            index = ProteomeIndex(Path(tmp) / "index", store)
+            index.min_seed_length = int(rng.integers(1, 6))
+
+            for _ in range(10):
+                max_mismatches = int(rng.integers(0, 3))
+                length = int(rng.integers(1, 20))
+                source = proteins[int(rng.integers(len(proteins)))]
+                if len(source) >= length and rng.random() < 0.8:
+                    start = int(rng.integers(len(source) - length + 1))
+                    pattern = list(source[start:start + length])
+                    for pos in rng.choice(length, int(rng.integers(0, min(3, length) + 1)), replace=False):
+                        pattern[pos] = rng.choice(letters)
+                    pattern = "".join(pattern)
+                else:
+                    pattern = "".join(rng.choice(letters, length))
+
+                expected = [
+                    (p, i, sum(a != b for a, b in zip(pattern, protein[i:i + length])))
+                    for p, protein in enumerate(proteins)
+                    for i in range(len(protein) - length + 1)
+                ]
+                expected = [hit for hit in expected if hit[2] <= max_mismatches]
+                got = list(zip(*(a.tolist() for a in index.find(pattern, max_mismatches))))
+                assert got == expected, f"trial {trial}: FM-index disagrees with brute force for {pattern!r}"
+
+    print(f"✅ FM-index matches brute force on {n_trials} random proteomes")
+
+
+def benchmark(table_path, IEDB_data_path="../Data/wrangled_IEDB.csv"):
+    """
+    Times find_many over every epitope in wrangled_IEDB.csv at 0, 1 and 2 mismatches.
+    """
+    index = ProteomeIndex.open(table_path)
+    n_residues = len(index.store.residues)
+    print(f"Index: {index.disk_size() / 1e6:.1f} MB for {n_residues / 1e6:.1f} MB of residues "
+          f"({index.disk_size() / max(1, n_residues):.2f} bytes per residue)")
+    epitopes = pd.read_csv(IEDB_data_path)["Sequence"].tolist()
+    for max_mismatches in (0, 1, 2):
+        start = time.perf_counter()
+        pattern_idx, _, _, _ = index.find_many(epitopes, max_mismatches)
+        elapsed = time.perf_counter() - start
+        print(f"{len(epitopes)} epitopes, ≤{max_mismatches} mismatches: {len(pattern_idx)} hits "
+              f"in {elapsed:.2f}s ({elapsed / len(epitopes) * 1000:.2f} ms per epitope)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up peptides in the pathogen proteome FM-index")
+    parser.add_argument("peptides", nargs="*", help="peptides to look up (default: benchmark all IEDB epitopes)")
+    parser.add_argument("--max-mismatches", type=int, default=0, help="allowed substitutions (default: 0)")
+    parser.add_argument("--table", default="../Data/wrangled_rep_pathogen_prots.csv", help="protein table to index")
+    parser.add_argument("--check", action="store_true", help="compare against brute force on random proteomes first")
+    args = parser.parse_args()
+
+    if args.check:
+        check_against_brute_force()
+
+    if not args.peptides:
+        benchmark(args.table)
+    else:
+        index = ProteomeIndex.open(args.table)
+        pathogen_data = index.store.metadata
+        pattern_idx, protein_idx, positions, mismatches = index.find_many(args.peptides, args.max_mismatches)
+        hits_df = pd.DataFrame({
+            "Peptide": np.array(args.peptides, dtype=object)[pattern_idx],
+            "Protein_ID": pathogen_data["Protein ID"].to_numpy()[protein_idx],
+            "Organism Source": pathogen_data["Organism Source"].to_numpy()[protein_idx],
+            "Position": positions,
+            "Mismatches": mismatches,
+        })
+        print(hits_df.to_string(index=False))
+
+# %%
@@ -0,0 +1,83 @@
+#%% IMPORTS
+import hashlib
+import numpy as np
+import pandas as pd
+
+#%% COLLAPSING
+def sequence_digest(seq):
+    """
+    128-bit BLAKE2b digest of a sequence, used as its identity.
+    """
+    return hashlib.blake2b(seq.encode("ascii"), digest_size=16).digest()
+
+
+class CollapsedSequences:
+    """
+    The distinct sequences of an indexable collection of sequences (a list, an object array
+    or a SequenceStore), each represented by the first row holding it.
+
+    Indexing and iterating give the distinct sequences only, so it can be scanned in place
+    of the full collection; expand() maps per-sequence results back to every row.
+    """
+    def __init__(self, seqs):
+        self.seqs = seqs
+        self.inverse = np.empty(len(seqs), dtype=np.int64)
+
+        canonical = {}
+        canonical_rows = []
+        for row, seq in enumerate(seqs):
+            key = sequence_digest(seq)
+            u = canonical.setdefault(key, len(canonical_rows))
+            if u == len(canonical_rows):
+                canonical_rows.append(row)
+            self.inverse[row] = u
+        self.canonical_rows = np.array(canonical_rows, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.canonical_rows)
+
+    def __getitem__(self, u):
+        return self.seqs[self.canonical_rows[u]]
+
+    def __iter__(self):
+        for row in self.canonical_rows:
+            yield self.seqs[row]
+
+    @property
+    def redundancy_ratio(self):
+        """
+        Rows per distinct sequence (1.0 means no sequence occurs twice).
+        """
+        return len(self.seqs) / len(self) if len(self) else 1.0
+
+    def summary(self):
+        return (f"{len(self.seqs)} sequences, {len(self)} distinct "
+                f"(redundancy ratio {self.redundancy_ratio:.2f})")
+
+    def expand(self, unique_idx):
+        """
+        Replicates results found for distinct sequences onto every row holding that sequence.
+        unique_idx gives the distinct sequence of each result and must be ascending, as a
+        scan over this collection returns it. Returns (row of each expanded result, index
+        of the original result), ordered by row and keeping each sequence's result order.
+        """
+        unique_idx = np.asarray(unique_idx, dtype=np.int64)
+        result_counts = np.bincount(unique_idx, minlength=len(self))
+        result_starts = np.cumsum(result_counts) - result_counts
+
+        row_counts = result_counts[self.inverse]
+        rows = np.repeat(np.arange(len(self.inverse)), row_counts)
+        within = np.arange(row_counts.sum()) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+        return rows, result_starts[self.inverse[rows]] + within
+
+    def members(self, metadata, columns=("Protein_ID", "Strain", "Genus_Species")):
+        """
+        Maps every row back to its canonical row (the one scanned for its sequence): one line
+        per row of metadata with Canonical_Row and the given identifying columns.
+        """
+        members_df = pd.DataFrame({"Canonical_Row": self.canonical_rows[self.inverse]})
+        for column in columns:
+            members_df[column] = metadata[column].to_numpy()
+        return members_df
+
+# %%
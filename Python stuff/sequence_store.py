@@ -0,0 +1,197 @@
+#%% IMPORTS
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+store_root = Path("../Data/sequence_store")
+
+# Bump when the on-disk layout changes, so old stores are rebuilt
+store_version = 1
+
+
+def table_fingerprint(table_path):
+    stat = os.stat(table_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def store_path_for(table_path):
+    """
+    Where the packed store of a protein table lives: ../Data/sequence_store/<table name>/.
+    """
+    return store_root / Path(table_path).stem
+
+#%% WRITE
+class SequenceStoreWriter:
+    """
+    Appends DataFrame batches to a packed store: the Sequence column goes into one
+    contiguous residue file with int64 offsets, the other columns into metadata.csv.
+    The store only appears at store_dir once close() records the source table.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        self.tmp_dir = self.store_dir.with_name(self.store_dir.name + ".tmp")
+        if self.tmp_dir.exists():
+            shutil.rmtree(self.tmp_dir)
+        self.tmp_dir.mkdir(parents=True)
+
+        self.residues = open(self.tmp_dir / "residues.bin", "wb")
+        self.lengths = []
+        self.first = True
+
+    def write(self, batch_df):
+        sequences = batch_df["Sequence"].fillna("").astype(str).tolist()
+        self.residues.write("".join(sequences).encode("ascii"))
+        self.lengths.append(np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences)))
+
+        metadata_df = batch_df.drop(columns="Sequence")
+        metadata_df.to_csv(self.tmp_dir / "metadata.csv", mode="w" if self.first else "a", header=self.first, index=False)
+        self.first = False
+
+    def close(self, table_path):
+        """
+        Finishes the store for table_path (already fully written) and moves it into place.
+        """
+        self.residues.close()
+        lengths = np.concatenate(self.lengths) if self.lengths else np.array([], dtype=np.int64)
+        np.save(self.tmp_dir / "offsets.npy", np.concatenate(([0], np.cumsum(lengths))))
+
+        manifest = {
+            "version": store_version,
+            "table": str(table_path),
+            "table_fingerprint": table_fingerprint(table_path),
+            "n_proteins": len(lengths),
+            "n_residues": int(lengths.sum()),
+        }
+        with open(self.tmp_dir / "manifest.json", "w") as handle:
+            json.dump(manifest, handle, indent=1)
+
+        if self.store_dir.exists():
+            shutil.rmtree(self.store_dir)
+        os.replace(self.tmp_dir, self.store_dir)
+
+    def abort(self):
+        self.residues.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def build_store_from_table(table_path, store_dir=None, chunksize=50_000):
+    """
+    Packs an existing protein table (CSV or Parquet) into a store, chunk by chunk.
+    """
+    store_dir = store_path_for(table_path) if store_dir is None else store_dir
+    writer = SequenceStoreWriter(store_dir)
+    try:
+        if str(table_path).endswith(".parquet"):
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(table_path).iter_batches(batch_size=chunksize):
+                writer.write(batch.to_pandas())
+        else:
+            # Read as text so metadata.csv keeps the table's values exactly as written
+            for chunk in pd.read_csv(table_path, chunksize=chunksize, dtype=str, keep_default_na=False):
+                writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close(table_path)
+
+#%% READ
+class SequenceStore:
+    """
+    Read-only packed sequences, memory-mapped. Opening costs two small file reads;
+    forked workers share the mapped pages instead of copying Python strings.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / "manifest.json") as handle:
+            self.manifest = json.load(handle)
+        self.offsets = np.load(self.store_dir / "offsets.npy", mmap_mode="r")
+        if self.manifest["n_residues"]:
+            self.residues = np.memmap(self.store_dir / "residues.bin", dtype=np.uint8, mode="r")
+        else:
+            self.residues = np.array([], dtype=np.uint8)
+        self._metadata = None
+
+    @classmethod
+    def for_table(cls, table_path, store_dir=None):
+        """
+        Opens the store of table_path, packing the table first when the store is missing
+        or was made from an older version of the table.
+        """
+        store_dir = store_path_for(table_path) if store_dir is None else Path(store_dir)
+        manifest_path = store_dir / "manifest.json"
+        if manifest_path.exists():
+            with open(manifest_path) as handle:
+                manifest = json.load(handle)
+            if manifest["version"] == store_version and manifest["table_fingerprint"] == table_fingerprint(table_path):
+                return cls(store_dir)
+
+        print(f"Packing sequences of {table_path} into {store_dir}")
+        build_store_from_table(table_path, store_dir)
+        return cls(store_dir)
+
+    @property
+    def metadata(self):
+        """
+        The table's other columns, read on first use.
+        """
+        if self._metadata is None:
+            self._metadata = pd.read_csv(self.store_dir / "metadata.csv")
+        return self._metadata
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.residues[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("ascii")
+
+    def __iter__(self, chunk_size=10_000):
+        for start in range(0, len(self), chunk_size):
+            yield from self.sequences(start, start + chunk_size)
+
+    def sequences(self, start=0, stop=None):
+        """
+        Sequences of rows start..stop-1 as a list of str.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        offsets = np.asarray(self.offsets[start:stop + 1])
+        if len(offsets) < 2:
+            return []
+        block = self.residues[offsets[0]:offsets[-1]].tobytes().decode("ascii")
+        relative = (offsets - offsets[0]).tolist()
+        return [block[a:b] for a, b in zip(relative[:-1], relative[1:])]
+
+    def slices(self, rows, positions, length):
+        """
+        The length-residue substrings starting at positions of the given rows, as a list of str.
+        """
+        starts = np.asarray(self.offsets)[np.asarray(rows, dtype=np.int64)] + np.asarray(positions, dtype=np.int64)
+        if len(starts) == 0:
+            return []
+        windows = np.ascontiguousarray(self.residues[starts[:, None] + np.arange(length)])
+        return windows.view(f"S{length}").ravel().astype(str).tolist()
+
+    def rows_for(self, ids, id_column="Protein_ID", normalize=False):
+        """
+        Row numbers of the first row of each of the given IDs, in table order.
+        With normalize, IDs on both sides are compared stripped and upper-cased.
+        """
+        stored = self.metadata[id_column].astype(str)
+        ids = pd.Series(list(ids), dtype=object).astype(str)
+        if normalize:
+            stored, ids = stored.str.strip().str.upper(), ids.str.strip().str.upper()
+        wanted = stored.isin(set(ids))
+        return np.flatnonzero(wanted & ~stored.duplicated())
+
+    def select(self, ids, id_column="Protein_ID", normalize=False):
+        """
+        Metadata plus Sequence for the first row of each of the given IDs, in table order.
+        """
+        rows = self.rows_for(ids, id_column, normalize)
+        selected = self.metadata.iloc[rows].reset_index(drop=True)
+        selected["Sequence"] = [self[i] for i in rows]
+        return selected
+
+# %%
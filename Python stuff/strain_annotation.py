@@ -0,0 +1,137 @@
+#%% IMPORTS
+import os
+import re
+import pandas as pd
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from fasta_io import find_fasta, open_fasta
+from uniprot_client import UniProtClient
+from uniprot_headers import extract_protein_id
+
+# Sidecar tables written by strain_extraction.py: the organism name (with strain) of every
+# proteome, and the proteome every protein accession came from
+strain_table_path = "../Data/proteome_strains.csv"
+protein_proteome_path = "../Data/protein_proteomes.csv"
+strain_columns = ["Proteome_ID", "Organism_Name", "Genus_Species", "Strain"]
+
+# The organism part of a UniProt header, up to (but not including) the taxon ID
+organism_field_pattern = re.compile(r"OS=.*?OX=")
+
+# Bytes read (whole lines) per chunk while scanning a FASTA
+chunk_size = 1 << 20
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+#%% STRAIN NAMES
+def strain_name_from(proteome_id, data):
+    if data is None:
+        return None
+    try:
+        organism = data.get("taxonomy", {}).get("scientificName", "").strip()
+        strain = data.get("strain", None)
+
+        if not strain or strain.strip() == "":
+            print(f"⚠️ No strain listed for {proteome_id}")
+            return organism  # Return just the organism
+
+        return f"{organism} {strain}"
+    except Exception as e:
+        print(f"Failed to parse JSON for {proteome_id}: {e}")
+        return None
+
+
+def fetch_strain_names(proteome_ids):
+    # Several requests in flight at once, under the client's rate limit. Only proteomes
+    # UniProt answered 404 for are not found; failed lookups are left for the next run.
+    records = UniProtClient().fetch_proteomes(proteome_ids)
+    strain_names = {}
+    for proteome_id, data in records.items():
+        strain_name = strain_name_from(proteome_id, data)
+        if strain_name:
+            strain_names[proteome_id] = strain_name
+    return strain_names, [proteome_id for proteome_id, data in records.items() if data is None]
+
+#%% SCANNING
+def scan_proteome(task):
+    """
+    Worker task (proteome ID, FASTA path): reads the file (plain or compressed) once in
+    ~chunk_size blocks of whole lines. Returns (proteome ID, (size, mtime_ns), accessions
+    in file order).
+    """
+    proteome_id, fasta_path = task
+    stat = file_stat(fasta_path)
+    accessions = []
+    with open_fasta(fasta_path, "rb") as handle:
+        while True:
+            lines = handle.readlines(chunk_size)
+            if not lines:
+                break
+            for line in lines:
+                if line.startswith(b">"):
+                    accessions.append(extract_protein_id(line[1:].decode().rstrip()))
+    return proteome_id, stat, accessions
+
+
+def organism_columns(organism_name):
+    """
+    (Genus_Species, Strain) of an OS= value: the first two words, and the rest or
+    "unknown strain". None for the genus when the name has fewer than two words or
+    contains "=" (which the analysis notebooks' OS= pattern does not match).
+    """
+    if "=" in organism_name:
+        return None, "unknown strain"
+    words = organism_name.split()
+    genus_species = " ".join(words[:2]) if len(words) >= 2 else None
+    strain = " ".join(words[2:]) if len(words) > 2 else "unknown strain"
+    return genus_species, strain
+
+#%% APPLYING THE SIDECAR
+def set_organism(title, organism_name):
+    """
+    A FASTA title with its OS= field replaced by organism_name (inserted literally).
+    """
+    return organism_field_pattern.sub(lambda _: f"OS={organism_name} OX=", title)
+
+
+def load_organism_names(path=strain_table_path):
+    strain_df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return dict(zip(strain_df["Proteome_ID"], strain_df["Organism_Name"]))
+
+
+def load_protein_proteomes(path=protein_proteome_path):
+    """
+    {protein accession: proteome ID}. An accession listed under several proteomes maps to
+    the first, in strain table order.
+    """
+    map_df = pd.read_csv(path, dtype=str, keep_default_na=False).drop_duplicates("Protein_ID")
+    return dict(zip(map_df["Protein_ID"], map_df["Proteome_ID"]))
+
+
+def iter_proteome_records(fasta_folder, organism_names):
+    """
+    (title, sequence) of every record in fasta_folder/<proteome ID>.fasta (or .fasta.bgz,
+    .fasta.gz), for the proteomes of organism_names in its order, with each title's OS= field
+    set to the proteome's name.
+    """
+    for proteome_id, organism_name in organism_names.items():
+        fasta_path = find_fasta(fasta_folder, proteome_id)
+        if fasta_path is None:
+            print(f"FASTA not found for {proteome_id}")
+            continue
+        with open_fasta(fasta_path) as handle:
+            for title, seq in SimpleFastaParser(handle):
+                yield set_organism(title, organism_name), seq
+
+
+def annotate_records(records, organism_names, protein_proteomes):
+    """
+    Sets the OS= field of (title, sequence) records from a combined FASTA, finding each
+    record's proteome through its accession. Records of unknown proteomes pass unchanged.
+    """
+    for title, seq in records:
+        organism_name = organism_names.get(protein_proteomes.get(extract_protein_id(title)))
+        yield (set_organism(title, organism_name) if organism_name else title), seq
+
+# %%
@@ -1,69 +1,100 @@
 #%%
+import json
 import os
-import requests
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import pandas as pd
 from tqdm import tqdm
-import re
-from time import sleep
+from annotation_store import AnnotationStore
+from fasta_io import find_fasta
+from strain_annotation import (
+    fetch_strain_names, file_stat, organism_columns, protein_proteome_path, scan_proteome, strain_columns,
+    strain_table_path,
+)
 
 
 # Paths
 proteome_id_file = "../Data/proteome_ids.txt"
 fasta_folder = Path("../Data/proteome_fastas")
-output_folder = Path("../Data/proteome_fastas_strain")
-output_folder.mkdir(parents=True, exist_ok=True)
-
-def fetch_strain_name(proteome_id):
-    url = f"https://rest.uniprot.org/proteomes/{proteome_id}"
-    response = requests.get(url)
-    if response.status_code != 200:
-        return None
-    try:
-        data = response.json()
-        organism = data.get("taxonomy", {}).get("scientificName", "").strip()
-        strain = data.get("strain", None)
-
-        if not strain or strain.strip() == "":
-            print(f"⚠️ No strain listed for {proteome_id}")
-            return organism  # Return just the organism
-
-        return f"{organism} {strain}"
-    except Exception as e:
-        print(f"Failed to parse JSON for {proteome_id}: {e}")
-        return None
-
-
-# Helper: update OS= field in FASTA header
-def modify_fasta_headers(fasta_path, new_os_name, output_path):
-    with open(fasta_path, "r") as infile, open(output_path, "w") as outfile:
-        for line in infile:
-            if line.startswith(">"):
-                # Replace only the OS=... part up to (but not including) OX=
-                line = re.sub(r"OS=.*?OX=", f"OS={new_os_name} OX=", line)
-            outfile.write(line)
+
+# Instead of rewriting a copy of every FASTA, the strain names go into a small sidecar table
+# (plus an accession → proteome map) that stage 2 applies while parsing the original files.
+# The manifest records what each proteome's accessions were scanned from.
+manifest_path = Path("../Data/proteome_strains_manifest.json")
+
+n_workers = os.cpu_count() or 1
 
 # Load proteome IDs
 with open(proteome_id_file) as f:
     proteome_ids = [line.strip() for line in f if line.strip()]
 
-# Main loop with tqdm
-for proteome_id in tqdm(proteome_ids, desc="Processing proteomes"):
-    fasta_path = fasta_folder / f"{proteome_id}.fasta"
-    output_path = output_folder / f"{proteome_id}.fasta"
-
-    if not fasta_path.exists():
+# Strain names already in the local annotation store are not fetched again
+# Each proteome's FASTA may be plain, gzip or bgzip
+fasta_paths = {}
+for proteome_id in proteome_ids:
+    fasta_path = find_fasta(fasta_folder, proteome_id)
+    if fasta_path is not None:
+        fasta_paths[proteome_id] = fasta_path
+    else:
         print(f"FASTA not found for {proteome_id}")
-        continue
+available_ids = list(fasta_paths)
+
+with AnnotationStore() as annotations:
+    strain_names = annotations.get_many("proteome_strain", available_ids, fetch_strain_names)
+
+# Only proteomes whose FASTA is new or changed are scanned for accessions again
+manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+old_map = (
+    pd.read_csv(protein_proteome_path, dtype=str, keep_default_na=False)
+    if os.path.exists(protein_proteome_path) else pd.DataFrame(columns=["Protein_ID", "Proteome_ID"])
+)
+# Only proteomes that have rows in the accession map may skip the scan; one that dropped out
+# of the sidecar tables on an earlier run is scanned again even if its FASTA is unchanged
+accessions = {pid: group["Protein_ID"].tolist() for pid, group in old_map.groupby("Proteome_ID", sort=False)}
 
-    strain_name = fetch_strain_name(proteome_id)
+strain_rows = []
+tasks = []
+for proteome_id in available_ids:
+    fasta_path = fasta_paths[proteome_id]
+
+    strain_name = strain_names.get(proteome_id)
     if not strain_name:
         print(f"Strain not found for {proteome_id}")
         continue
+    strain_rows.append((proteome_id, strain_name))
+
+    recorded = manifest.get(proteome_id)
+    if not (recorded and proteome_id in accessions
+            and (recorded["source_size"], recorded["source_mtime_ns"]) == file_stat(fasta_path)):
+        tasks.append((proteome_id, str(fasta_path)))
+
+with ProcessPoolExecutor(n_workers) as pool:
+    for proteome_id, (size, mtime_ns), proteome_accessions in tqdm(
+            pool.map(scan_proteome, tasks), total=len(tasks), desc="Scanning proteomes"):
+        manifest[proteome_id] = {"source_size": size, "source_mtime_ns": mtime_ns}
+        accessions[proteome_id] = proteome_accessions
+
+# Sidecar tables, in proteome_ids.txt order
+strain_df = pd.DataFrame(strain_rows, columns=["Proteome_ID", "Organism_Name"])
+organism = [organism_columns(name) if accessions[pid] else (None, "unknown strain") for pid, name in strain_rows]
+strain_df["Genus_Species"] = [genus_species for genus_species, _ in organism]
+strain_df["Strain"] = [strain for _, strain in organism]
+strain_df[strain_columns].to_csv(strain_table_path, index=False)
+
+map_df = pd.DataFrame(
+    [(accession, pid) for pid, _ in strain_rows for accession in accessions[pid]],
+    columns=["Protein_ID", "Proteome_ID"],
+)
+map_df.to_csv(protein_proteome_path, index=False)
 
-    modify_fasta_headers(fasta_path, strain_name, output_path)
-    sleep(0.3)  # gentle on UniProt's servers
+# The manifest only describes proteomes written to the sidecar tables above
+manifest = {pid: manifest[pid] for pid, _ in strain_rows}
+tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+tmp_path.write_text(json.dumps(manifest, indent=1))
+os.replace(tmp_path, manifest_path)
 
-print("✅ All headers updated.")
+print(f"✅ Strain names of {len(strain_df)} proteomes saved to {strain_table_path} "
+      f"({len(tasks)} scanned, {len(map_df)} proteins in {protein_proteome_path}).")
 
 
 # %%
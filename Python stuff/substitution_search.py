@@ -0,0 +1,149 @@
+#%% IMPORTS
+import numpy as np
+from Bio.Align import substitution_matrices
+from mismatch_search import encode, generate_9mers, kmer_length, protein_windows
+
+#%% SCORE TABLES
+def load_score_matrix(name="BLOSUM62"):
+    """
+    A substitution matrix as (alphabet, int16 score array, 256-entry byte → alphabet index table).
+    Lowercase residues score like uppercase; anything outside the alphabet scores as X.
+    """
+    matrix = substitution_matrices.load(name)
+    alphabet = matrix.alphabet
+    scores = np.array(matrix, dtype=np.int16)
+
+    residue_index = np.full(256, alphabet.index("X"), dtype=np.intp)
+    for i, letter in enumerate(alphabet):
+        residue_index[ord(letter)] = i
+        residue_index[ord(letter.lower())] = i
+    return alphabet, scores, residue_index
+
+
+def score_kmers(a, b, scores, residue_index):
+    """
+    Summed substitution score of two equal-length peptides.
+    """
+    return int(scores[residue_index[encode(a)], residue_index[encode(b)]].sum())
+
+#%% BRANCH-AND-BOUND SCORE ENGINE
+class ScoreEngine:
+    """
+    Finds every protein 9-mer / epitope 9-mer pair whose summed substitution score
+    is at least min_score.
+
+    Each position has a precomputed (residue, epitope) score table, so adding a position
+    to a whole block of pairs is one row gather. A pair is dropped as soon as it cannot
+    reach min_score even with the best possible residue at every remaining position.
+    The block is scored densely until at most sparse_fraction of its pairs are still alive,
+    then only those pairs are carried through the remaining positions.
+    """
+    def __init__(self, epitope_kmers, min_score, matrix="BLOSUM62", sparse_fraction=0.005, cache_bytes=1 << 19):
+        self.min_score = min_score
+        self.sparse_fraction = sparse_fraction
+        self.alphabet, self.scores, self.residue_index = load_score_matrix(matrix)
+
+        self.kmers = np.array([encode(kmer) for kmer in epitope_kmers], dtype=np.uint8).reshape(-1, kmer_length)
+        epitope_codes = self.residue_index[self.kmers]
+
+        # tables[j, a, e]: score of query residue a against epitope e at position j
+        self.tables = np.ascontiguousarray(self.scores[:, epitope_codes.T].transpose(1, 0, 2))
+
+        # bound_after[j, e]: best score epitope e can still gain from positions j..8
+        best = self.scores.max(axis=0)[epitope_codes]
+        self.bound_after = np.zeros((kmer_length + 1, len(self.kmers)), dtype=np.int16)
+        self.bound_after[:kmer_length] = np.cumsum(best[:, ::-1], axis=1)[:, ::-1].T
+
+        self.block_rows = max(1, cache_bytes // (2 * max(1, len(self.kmers))))
+
+    def search_many(self, proteins):
+        """
+        Columnar (protein index, position, entry, score) arrays over a list of proteins,
+        ordered by protein, position, then entry.
+        """
+        windows, window_starts, protein_idx, positions = protein_windows(proteins)
+        n_entries = len(self.kmers)
+        score_buffer = np.empty((self.block_rows, n_entries), dtype=np.int16)
+
+        hit_windows, hit_entries, hit_scores = [], [], []
+        for start in range(0, len(window_starts), self.block_rows):
+            codes = self.residue_index[windows[window_starts[start:start + self.block_rows]]]
+            block_scores = score_buffer[:len(codes)]
+
+            np.take(self.tables[0], codes[:, 0], axis=0, out=block_scores)
+            alive = block_scores >= self.min_score - self.bound_after[1]
+            j = 1
+            while j < kmer_length and np.count_nonzero(alive) > self.sparse_fraction * alive.size:
+                block_scores += self.tables[j][codes[:, j]]
+                j += 1
+                np.greater_equal(block_scores, self.min_score - self.bound_after[j], out=alive)
+
+            # From here on, only pairs that can still reach min_score are carried along
+            w, e = np.nonzero(alive)
+            pair_scores = block_scores[w, e]
+            for j in range(j, kmer_length):
+                pair_scores += self.tables[j][codes[w, j], e]
+                alive = pair_scores >= self.min_score - self.bound_after[j + 1][e]
+                w, e, pair_scores = w[alive], e[alive], pair_scores[alive]
+
+            hit_windows.append(w + start)
+            hit_entries.append(e)
+            hit_scores.append(pair_scores.astype(np.int64))
+
+        if not hit_windows:
+            return tuple(np.array([], dtype=np.int64) for _ in range(4))
+        w = np.concatenate(hit_windows)
+        return protein_idx[w], positions[w], np.concatenate(hit_entries).astype(np.int64), np.concatenate(hit_scores)
+
+#%% BRUTE-FORCE REFERENCE
+def brute_force_score_search(protein, epitope_kmers, min_score, matrix="BLOSUM62"):
+    """
+    Every (position, entry, score) pair by scoring each pair of 9-mers in full.
+    """
+    _, scores, residue_index = load_score_matrix(matrix)
+    hits = []
+    for pos, protein_kmer in enumerate(generate_9mers(protein)):
+        for entry, epitope_kmer in enumerate(epitope_kmers):
+            score = score_kmers(protein_kmer, epitope_kmer, scores, residue_index)
+            if score >= min_score:
+                hits.append((pos, entry, score))
+    return hits
+
+
+def check_against_brute_force(n_trials=30, alphabet="ACDEFGHIKLMNPQRSTVWYXUbz-*", seed=0):
+    """
+    Compares ScoreEngine.search_many with brute_force_score_search on random proteins and epitopes.
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(alphabet))
+
+    for trial in range(n_trials):
+        min_score = int(rng.integers(-10, 50))
+        protein = "".join(rng.choice(letters, int(rng.integers(5, 200))))
+        protein_kmers = generate_9mers(protein)
+
+        epitope_kmers = []
+        for _ in range(int(rng.integers(1, 150))):
+            if protein_kmers and rng.random() < 0.7:
+                kmer = list(protein_kmers[int(rng.integers(len(protein_kmers)))])
+                for pos in rng.choice(kmer_length, int(rng.integers(0, 7)), replace=False):
+                    kmer[pos] = rng.choice(letters)
+                epitope_kmers.append("".join(kmer))
+            else:
+                epitope_kmers.append("".join(rng.choice(letters, kmer_length)))
+
+        expected = brute_force_score_search(protein, epitope_kmers, min_score)
+
+        engine = ScoreEngine(epitope_kmers, min_score, sparse_fraction=float(rng.choice([0.0, 0.05, 0.5, 1.0])), cache_bytes=4096)
+        protein_idx, positions, entries, scores = engine.search_many([protein, "ACD", protein])
+        for i in (0, 2):
+            got = list(zip(*(a[protein_idx == i].tolist() for a in (positions, entries, scores))))
+            assert got == expected, f"trial {trial}: score engine disagrees with brute force"
+
+    print(f"✅ Score engine matches brute force on {n_trials} random trials")
+
+
+if __name__ == "__main__":
+    check_against_brute_force()
+
+# %%
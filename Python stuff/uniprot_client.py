@@ -0,0 +1,397 @@
+#%% IMPORTS
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+uniprot_url = "https://rest.uniprot.org"
+
+# Responses worth another try: rate limiting and transient server errors
+retry_statuses = {429, 500, 502, 503, 504}
+
+#%% RATE LIMITING
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of up to capacity.
+    acquire() blocks until a token is available; safe to share between threads.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1.0, rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+#%% CLIENT
+def subcellular_locations(entry):
+    """
+    "; "-joined SUBCELLULAR LOCATION values of a UniProt JSON entry, or None.
+    """
+    for comment in entry.get("comments", []):
+        if comment.get("commentType") == "SUBCELLULAR LOCATION":
+            locations = [
+                loc.get("location", {}).get("value")
+                for loc in comment.get("subcellularLocations", [])
+                if loc.get("location")
+            ]
+            return "; ".join(locations) if locations else None
+    return None
+
+
+class UniProtClient:
+    """
+    UniProt REST client that asks for batch_size accessions per /uniprotkb/stream query,
+    over one pooled keep-alive session. At most max_concurrency requests are in flight,
+    a token bucket keeps the request rate under rate per second, and 429/5xx responses
+    and connection errors are retried with exponential backoff (honouring Retry-After).
+    """
+    def __init__(self, base_url=uniprot_url, max_concurrency=4, rate=3.0, batch_size=100,
+                 max_retries=5, backoff=1.0, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.bucket = TokenBucket(rate)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+        self.stats_lock = threading.Lock()
+        self.n_requests = 0
+        self.n_retries = 0
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt * (0.5 + random.random())
+
+    def get(self, path, params=None, headers=None, stream=False):
+        """
+        GET base_url + path. Returns the response of the first attempt that is not
+        retryable; raises once max_retries retries are used up. With stream=True the body
+        is left unread, and the caller closes the response.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            response, error = None, None
+            with self.slots:
+                try:
+                    response = self.session.get(self.base_url + path, params=params, headers=headers,
+                                                stream=stream, timeout=self.timeout)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+            with self.stats_lock:
+                self.n_requests += 1
+
+            if response is not None and response.status_code not in retry_statuses:
+                return response
+            if attempt == self.max_retries:
+                break
+            if response is not None:
+                response.close()
+            with self.stats_lock:
+                self.n_retries += 1
+            time.sleep(self._retry_delay(response, attempt))
+
+        if response is None:
+            raise error
+        response.raise_for_status()
+        return response
+
+    def stream_entries(self, accessions, fields):
+        """
+        JSON entries for one batch of accessions, keyed by every accession each entry answers for.
+        """
+        query = f"accession:({' OR '.join(accessions)})"
+        response = self.get("/uniprotkb/stream", {"query": query, "fields": ",".join(fields), "format": "json"})
+        response.raise_for_status()
+
+        entries = {}
+        for entry in response.json().get("results", []):
+            for accession in [entry.get("primaryAccession")] + entry.get("secondaryAccessions", []):
+                entries[accession] = entry
+        return entries
+
+    def fetch_entry(self, accession):
+        """
+        One entry from /uniprotkb/{accession}.json (which also resolves merged accessions), or
+        None when UniProt answers 404. Any other failure raises, so it is never taken for
+        "not found".
+        """
+        response = self.get(f"/uniprotkb/{accession}.json")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def _attempt(self, fetch, key):
+        """
+        (key, fetch(key), True), or (key, None, False) when the lookup failed.
+        """
+        try:
+            return key, fetch(key), True
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error fetching {key}: {e}")
+            return key, None, False
+
+    def iter_entries(self, accessions, fields=("accession", "cc_subcellular_location")):
+        """
+        Yields {accession: JSON entry, or None for 404} for one batch at a time, in the order
+        batches complete, so callers can start on a batch while later ones are still in flight.
+        Accessions a batch did not return (or whose batch failed) are looked up one by one
+        with fetch_entry before their batch is yielded; those whose lookup failed are left out.
+        """
+        accessions = list(dict.fromkeys(str(a) for a in accessions))
+        batches = [accessions[i:i + self.batch_size] for i in range(0, len(accessions), self.batch_size)]
+
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            futures = {pool.submit(self.stream_entries, batch, fields): batch for batch in batches}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Fetching UniProt batches"):
+                batch = futures[future]
+                try:
+                    entries = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    print(f"Error fetching batch starting at {batch[0]}: {e}")
+                    entries = {}
+
+                missing = [a for a in batch if a not in entries]
+                attempts = pool.map(self._attempt, [self.fetch_entry] * len(missing), missing)
+                for accession, entry, ok in attempts:
+                    if ok:
+                        entries[accession] = entry
+                yield {a: entries[a] for a in batch if a in entries}
+
+    def fetch_entries(self, accessions, fields=("accession", "cc_subcellular_location")):
+        """
+        {accession: JSON entry, or None for 404}, in the order given. Accessions whose lookup
+        failed are left out.
+        """
+        accessions = list(dict.fromkeys(str(a) for a in accessions))
+        entries = {}
+        for batch_entries in self.iter_entries(accessions, fields):
+            entries.update(batch_entries)
+        return {a: entries[a] for a in accessions if a in entries}
+
+    def fetch_proteome(self, proteome_id):
+        """
+        One proteome record from /proteomes/{proteome_id}, or None when UniProt answers 404.
+        Any other failure raises.
+        """
+        response = self.get(f"/proteomes/{proteome_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_proteomes(self, proteome_ids):
+        """
+        {proteome ID: proteome record, or None for 404}, fetched max_concurrency at a time.
+        Proteomes whose lookup failed are left out.
+        """
+        proteome_ids = list(dict.fromkeys(str(p) for p in proteome_ids))
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            attempts = list(tqdm(pool.map(self._attempt, [self.fetch_proteome] * len(proteome_ids), proteome_ids),
+                                 total=len(proteome_ids), desc="Fetching proteomes"))
+        return {proteome_id: record for proteome_id, record, ok in attempts if ok}
+
+    def fetch_subcellular_locations(self, accessions):
+        """
+        {accession: "; "-joined subcellular locations or None}.
+        """
+        entries = self.fetch_entries(accessions)
+        return {a: subcellular_locations(entry) if entry else None for a, entry in entries.items()}
+
+#%% LOCAL STAND-IN SERVER
+def start_stand_in_server(entries, fail_every=3, latency=0.05, fastas=None, drop_every=0):
+    """
+    Serves /uniprotkb/stream, /uniprotkb/{accession}.json and /proteomes/{proteome ID} from
+    entries ({accession or proteome ID: JSON record}) on a free local port. Every request waits
+    latency seconds and every fail_every-th request gets a 429 with Retry-After: 0. Returns (server, base URL); server.state counts requests
+    and the highest number in flight at once. Stop it with server.shutdown().
+
+    With fastas ({proteome ID: FASTA text}), /uniprotkb/stream?query=proteome:ID&format=fasta
+    &compressed=true returns the gzipped FASTA with an ETag, honouring Range and If-Range, and
+    every drop_every-th such download closes the connection halfway through the body.
+    """
+    import gzip
+    import hashlib
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    state = {"requests": 0, "active": 0, "max_active": 0, "connections": 0, "downloads": 0}
+    lock = threading.Lock()
+
+    gzipped = {pid: gzip.compress(text.encode(), mtime=0) for pid, text in (fastas or {}).items()}
+    etags = {pid: f'"{hashlib.blake2b(data, digest_size=8).hexdigest()}"' for pid, data in gzipped.items()}
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, so pooled client connections are reused
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with lock:
+                state["connections"] += 1
+
+        def do_GET(self):
+            with lock:
+                state["requests"] += 1
+                n = state["requests"]
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+            try:
+                time.sleep(latency)
+                if fail_every and n % fail_every == 0:
+                    self._send(429, {"messages": ["Too many requests"]}, {"Retry-After": "0"})
+                    return
+
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                if url.path == "/uniprotkb/stream" and params.get("format") == ["fasta"]:
+                    self._send_fasta(params["query"][0].removeprefix("proteome:"))
+                elif url.path == "/uniprotkb/stream":
+                    query = params["query"][0]
+                    wanted = query[query.index("(") + 1:query.rindex(")")].split(" OR ")
+                    results = []
+                    for accession in wanted:
+                        entry = entries.get(accession)
+                        if entry is not None and entry not in results:
+                            results.append(entry)
+                    self._send(200, {"results": results})
+                elif url.path.startswith("/uniprotkb/") and url.path.endswith(".json"):
+                    entry = entries.get(url.path[len("/uniprotkb/"):-len(".json")])
+                    self._send(200, entry) if entry is not None else self._send(404, {"messages": ["Not found"]})
+                elif url.path.startswith("/proteomes/"):
+                    entry = entries.get(url.path[len("/proteomes/"):])
+                    self._send(200, entry) if entry is not None else self._send(404, {"messages": ["Not found"]})
+                else:
+                    self._send(404, {"messages": ["Not found"]})
+            finally:
+                with lock:
+                    state["active"] -= 1
+
+        def _send_fasta(self, proteome_id):
+            data = gzipped.get(proteome_id)
+            if data is None:
+                self._send(404, {"messages": ["Not found"]})
+                return
+            with lock:
+                state["downloads"] += 1
+                drop = drop_every and state["downloads"] % drop_every == 0
+
+            start = 0
+            ranged = self.headers.get("Range", "")
+            if ranged.startswith("bytes=") and self.headers.get("If-Range", etags[proteome_id]) == etags[proteome_id]:
+                start = int(ranged[len("bytes="):].split("-")[0])
+                if start >= len(data):
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(data)}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+            body = data[start:]
+            self.send_response(206 if start else 200)
+            self.send_header("Content-Type", "application/x-gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etags[proteome_id])
+            self.send_header("Accept-Ranges", "bytes")
+            if start:
+                self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            self.end_headers()
+            if drop and len(body) > 1:
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+        def _send(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def check_against_stand_in(n_entries=500, max_concurrency=4):
+    """
+    Fetches locations from the stand-in server through 429s and latency, and checks that
+    every answer is right and that no more than max_concurrency requests were in flight.
+    """
+    rng = random.Random(0)
+    locations = ["Cytoplasm", "Nucleus", "Cell membrane", "Secreted", "Mitochondrion"]
+
+    entries, expected = {}, {}
+    for i in range(n_entries):
+        accession = f"P{i:05d}"
+        chosen = rng.sample(locations, rng.randint(0, 2))
+        entry = {"primaryAccession": accession, "comments": []}
+        if chosen:
+            entry["comments"].append({
+                "commentType": "SUBCELLULAR LOCATION",
+                "subcellularLocations": [{"location": {"value": loc}} for loc in chosen],
+            })
+        entries[accession] = entry
+        expected[accession] = "; ".join(chosen) if chosen else None
+
+    # A merged accession, whose batch result comes back under its new primary accession
+    # and is then resolved through the single-entry endpoint, and some unknown accessions
+    entries["Q99999"] = entries["P00001"]
+    expected["Q99999"] = expected["P00001"]
+    expected.update({f"X{i:05d}": None for i in range(20)})
+
+    server, url = start_stand_in_server(entries, fail_every=3, latency=0.05)
+    try:
+        client = UniProtClient(url, max_concurrency=max_concurrency, rate=50, batch_size=25, backoff=0.01)
+        start = time.perf_counter()
+        got = client.fetch_subcellular_locations(list(expected))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    assert got == expected, "client results disagree with the stand-in server's entries"
+    assert server.state["max_active"] <= max_concurrency, "more requests in flight than max_concurrency"
+    print(f"✅ {len(expected)} accessions in {elapsed:.2f}s: {client.n_requests} requests, "
+          f"{client.n_retries} retries, at most {server.state['max_active']} in flight")
+
+
+if __name__ == "__main__":
+    check_against_stand_in()
+
+# %%
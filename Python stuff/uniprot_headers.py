@@ -0,0 +1,180 @@
+#%% IMPORTS
+import re
+import time
+import pandas as pd
+
+# Columns produced from a header, in wrangled_all_pathogen_prots.csv order
+header_columns = ["Protein_ID", "Genus_Species", "Strain", "Annotation", "pathogen_gene_name"]
+
+parenthesis_pattern = re.compile(r"\(.*?\)")
+protein_id_pattern = re.compile(r'\|([^|]+)\|')
+gene_name_pattern = re.compile(r'GN=([^\s]+)')
+
+#%% PER-HEADER PARSING
+def extract_genus_species_and_strain(organism_source):
+    """
+    Extracts genus + species as the first two words, and the rest as strain (if present).
+    """
+    cleaned = parenthesis_pattern.sub("", organism_source).strip() if "(" in organism_source else organism_source.strip()
+    parts = cleaned.split()
+
+    if len(parts) >= 2:
+        genus_species = ' '.join(parts[:2])
+        strain = ' '.join(parts[2:]) if len(parts) > 2 else None
+    else:
+        genus_species = cleaned
+        strain = "Unknown strain"
+
+    return genus_species, strain
+
+
+def extract_protein_id(header):
+    """
+    Protein_ID as stage 2 assigns it: the first |accession| part, else the first word.
+    """
+    protein_id_match = protein_id_pattern.search(header)
+    if protein_id_match:
+        return protein_id_match.group(1)
+    words = header.split(None, 1)
+    return words[0] if words else ""
+
+
+def legacy_parse_header(header, fallback_id=None):
+    """
+    The original per-field split/regex chain, used for headers outside the UniProt layout
+    and as the reference in benchmark().
+    """
+    # Extract the protein ID
+    protein_id_match = protein_id_pattern.search(header)
+    protein_id = protein_id_match.group(1) if protein_id_match else fallback_id
+
+    # Extract the full organism name
+    organism_source = header.split('OS=')[1].split(' OX=')[0] if "OS=" in header else None
+
+    # Extract genus/species and strain
+    genus_species, strain = extract_genus_species_and_strain(organism_source) if organism_source else (None, "unknown strain")
+
+    # Extract annotation
+    annotation = None
+    header_parts = header.split()
+    if len(header_parts) > 1:
+        possible_annotation = ' '.join(header_parts[1:])
+        annotation = possible_annotation.split('OS=')[0].strip()
+
+    # Extract gene name (GN=...)
+    gene_name_match = gene_name_pattern.search(header)
+    gene_name = gene_name_match.group(1) if gene_name_match else None
+
+    return [protein_id, genus_species, strain, annotation, gene_name]
+
+
+#%% BATCH PARSING
+def parse_header_rows(headers, fallback_ids):
+    """
+    Parses a batch of headers into header_columns rows with a handful of str.find calls each.
+    Every protein of a proteome shares its OS= string, so genus/strain is split once per organism.
+    """
+    organisms = {}
+    rows = []
+    append = rows.append
+
+    for header, fallback_id in zip(headers, fallback_ids):
+        # Only headers with a single " OS=" get the fast path; anything else keeps the old rules
+        os_pos = header.find(" OS=")
+        if os_pos < 0 or header.count("OS=") != 1:
+            append(legacy_parse_header(header, fallback_id))
+            continue
+        words = header[:os_pos].split()
+        if not words:
+            append(legacy_parse_header(header, fallback_id))
+            continue
+
+        bar = header.find("|", 3)
+        if bar > 3 and header.startswith(("sp|", "tr|")):
+            protein_id = header[3:bar]
+        else:
+            protein_id_match = protein_id_pattern.search(header)
+            protein_id = protein_id_match.group(1) if protein_id_match else fallback_id
+
+        ox_pos = header.find(" OX=", os_pos)
+        organism_source = header[os_pos + 4:ox_pos] if ox_pos >= 0 else header[os_pos + 4:]
+        genus_species_and_strain = organisms.get(organism_source)
+        if genus_species_and_strain is None:
+            genus_species_and_strain = extract_genus_species_and_strain(organism_source) if organism_source else (None, "unknown strain")
+            organisms[organism_source] = genus_species_and_strain
+
+        gene_name = None
+        if "GN=" in header:
+            gene_name_match = gene_name_pattern.search(header)
+            gene_name = gene_name_match.group(1) if gene_name_match else None
+
+        append([protein_id, *genus_species_and_strain, ' '.join(words[1:]), gene_name])
+
+    return rows
+
+
+def parse_headers(headers, fallback_ids=None):
+    """
+    Parses a whole chunk of headers into a DataFrame with header_columns.
+    fallback_ids defaults to the first word of each header, like SeqRecord.id.
+    """
+    if fallback_ids is None:
+        fallback_ids = [h.split(None, 1)[0] if h.strip() else "" for h in headers]
+    return pd.DataFrame(parse_header_rows(headers, fallback_ids), columns=header_columns)
+
+#%% BENCHMARK
+def benchmark(fasta_path, n_records=200_000, repeats=3):
+    """
+    Times the old SeqIO + split/regex chain against SimpleFastaParser + the batch parser
+    on the first n_records of fasta_path, and checks that both give identical rows.
+    """
+    from itertools import islice
+    from Bio import SeqIO
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    from fasta_io import open_fasta
+
+    def best_of(fn):
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = fn()
+            best = min(best, time.perf_counter() - start)
+        return best, out
+
+    def legacy_rows():
+        with open_fasta(fasta_path) as handle:
+            records = islice(SeqIO.parse(handle, "fasta"), n_records)
+            return [legacy_parse_header(r.description, r.id) + [str(r.seq)] for r in records]
+
+    def batch_rows():
+        with open_fasta(fasta_path) as handle:
+            records = list(islice(SimpleFastaParser(handle), n_records))
+        titles = [title for title, _ in records]
+        fallback_ids = [title.split(None, 1)[0] if title.strip() else "" for title in titles]
+        rows = parse_header_rows(titles, fallback_ids)
+        for row, (_, seq) in zip(rows, records):
+            row.append(seq)
+        return rows
+
+    with open_fasta(fasta_path) as handle:
+        titles = [title for title, _ in islice(SimpleFastaParser(handle), n_records)]
+    fallback_ids = [title.split(None, 1)[0] if title.strip() else "" for title in titles]
+
+    legacy_header_time, _ = best_of(lambda: [legacy_parse_header(h, f) for h, f in zip(titles, fallback_ids)])
+    batch_header_time, _ = best_of(lambda: parse_header_rows(titles, fallback_ids))
+    legacy_time, legacy_result = best_of(legacy_rows)
+    batch_time, batch_result = best_of(batch_rows)
+
+    assert batch_result == legacy_result, "batch parser disagrees with the legacy parser"
+
+    print(f"Records: {len(legacy_result)}")
+    print(f"Headers only, split/regex chain:  {legacy_header_time:.3f}s")
+    print(f"Headers only, batch parser:       {batch_header_time:.3f}s ({legacy_header_time / batch_header_time:.1f}x)")
+    print(f"SeqIO + split/regex chain:        {legacy_time:.3f}s")
+    print(f"SimpleFastaParser + batch parser: {batch_time:.3f}s ({legacy_time / batch_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark("../Data/all_proteomes.fasta")
+
+# %%